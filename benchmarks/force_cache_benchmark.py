@@ -0,0 +1,91 @@
+# coding=utf-8
+"""
+Micro-benchmark of the force parameter cache used by NCMCProtonDrive._update_forces.
+
+Compares blending the per-atom dictionaries stored on each titration state (the original cache layout)
+against blending the packed (state x atom x parameter) arrays of each residue.
+
+Usage:
+    python force_cache_benchmark.py [number of repeats]
+"""
+
+import sys
+import timeit
+
+from simtk import openmm, unit
+
+from protons import app
+from protons.app import AmberProtonDrive
+from protons.tests import get_test_data
+
+
+def setup_drive():
+    """Create a drive for the explicit solvent tyrosine test system."""
+    testsystems = get_test_data("tyr_explicit", "testsystems")
+    with open("{}/tyr.sys.xml".format(testsystems)) as handle:
+        system = openmm.XmlSerializer.deserialize(handle.read())
+    prmtop = app.AmberPrmtopFile("{}/tyr.prmtop".format(testsystems))
+    return AmberProtonDrive(
+        300.0 * unit.kelvin,
+        prmtop.topology,
+        system,
+        "{}/tyr.cpin".format(testsystems),
+        pressure=1.0 * unit.atmospheres,
+    )
+
+
+def dict_blend(drive, group_index, final, initial, fraction):
+    """Blend the parameters the way the dictionary based cache did, without setting them."""
+    group = drive.titrationGroups[group_index]
+    cache_initial, cache_final = group[initial].forces, group[final].forces
+    for force_index, force in enumerate(drive.forces_to_update):
+        names = ["charge", "sigma", "epsilon"]
+        if force.__class__.__name__ == "GBSAOBCForce":
+            names = ["charge", "radius", "scaleFactor"]
+        for atom_initial, atom_final in zip(
+            cache_initial[force_index]["atoms"], cache_final[force_index]["atoms"]
+        ):
+            atom = {key: atom_initial[key] for key in ["atom_index"]}
+            for name in names:
+                atom[name] = (1.0 - fraction) * atom_initial[
+                    name
+                ] + fraction * atom_final[name]
+        for exc_initial, exc_final in zip(
+            cache_initial[force_index].get("exceptions", list()),
+            cache_final[force_index].get("exceptions", list()),
+        ):
+            exc = {
+                key: exc_initial[key]
+                for key in ["exception_index", "particle1", "particle2"]
+            }
+            for name in ["chargeProd", "sigma", "epsilon"]:
+                exc[name] = (1.0 - fraction) * exc_initial[name] + fraction * exc_final[
+                    name
+                ]
+
+
+def packed_blend(drive, group_index, final, initial, fraction):
+    """Blend the parameters using the packed arrays, without setting them."""
+    for packed in drive.titrationGroups[group_index].packed_forces:
+        packed.blend_atoms(initial, final, fraction).tolist()
+        packed.blend_exceptions(initial, final, fraction).tolist()
+
+
+def main(repeats=10000):
+    drive = setup_drive()
+    timings = dict()
+    for name, func in [("dict", dict_blend), ("packed", packed_blend)]:
+        timings[name] = timeit.timeit(lambda: func(drive, 0, 1, 0, 0.5), number=repeats)
+    timings["update_forces"] = timeit.timeit(
+        lambda: drive._update_forces(0, 1, 0, 0.5), number=repeats
+    )
+    for name, seconds in timings.items():
+        print("{:>14}: {:10.3f} us per call".format(name, 1.0e6 * seconds / repeats))
+    print("Speedup of blending: {:.2f}x".format(timings["dict"] / timings["packed"]))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -5,8 +5,9 @@ from __future__ import print_function
 
 from simtk.openmm.app import *
 from .topology import Topology
-from .calibration import SAMSCalibrationEngine
+from .calibration import SAMSCalibrationEngine, SAMSConvergenceMonitor
 from .simulation import ConstantPHSimulation
+from .multiwalker import MultiWalkerSAMS
 from .driver import (
     ForceFieldProtonDrive,
     AmberProtonDrive,
@@ -22,6 +23,9 @@ from .samsreporter import SAMSReporter
 from .ncmcreporter import NCMCReporter
 from .metadatareporter import MetadataReporter
 from .titrationreporter import TitrationReporter
+from .statisticsreporter import StatisticsReporter
+from .reportbuffer import BackgroundWriter
+from .datasets import ProtonsDatasetCollection
 from simtk.unit import Quantity
 import numpy as np
 
@@ -7,14 +7,22 @@ import seaborn as sns
 from matplotlib import pyplot as plt
 import matplotlib as mpl
 import netCDF4
-from typing import List, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
 from protons.app.utils import OutdatedFileError
 from protons.app.driver import SAMSApproach
+from protons.app.datasets import ProtonsDatasetCollection
 
 sns.set_style("ticks")
 
+# Number of bootstrap samples that are evaluated per task
+_bootstrap_chunk_size = 50
 
-def calibration_dataset_to_arrays(dataset: netCDF4.Dataset):
+# A single netCDF4 file, or a collection of files that is presented as a single data set
+ProtonsDataset = Union[netCDF4.Dataset, ProtonsDatasetCollection]
+
+
+def calibration_dataset_to_arrays(dataset: ProtonsDataset):
     """Extracts the necessary arrays for BAR analysis on a protons netCDF DataSet.
 
     Parameters
@@ -74,7 +82,7 @@ def calibration_dataset_to_arrays(dataset: netCDF4.Dataset):
 
 
 def stitch_calibrations(
-    datasets: List[netCDF4.Dataset]
+    datasets: List[ProtonsDataset]
 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int, np.ndarray]:
     """Collect data from multiple netCDF datasets and return them as single arrays."""
     initial_states_collection: List[np.ndarray] = list()
@@ -113,10 +121,11 @@ def stitch_calibrations(
 
 
 def bar_all_states(
-    dataset: Union[netCDF4.Dataset, List[netCDF4.Dataset]],
+    dataset: Union[ProtonsDataset, List[ProtonsDataset]],
     bootstrap: bool = False,
     num_bootstrap_samples: int = 1000,
     to_first_state_only: bool = True,
+    nprocesses: int = 1,
 ):
     """
     Run BAR between the first state and all other states.
@@ -128,6 +137,7 @@ def bar_all_states(
     num_bootstrap_samples - int, the number of samples for bootstrapping
     to_first_state_only - only calculate values for pairswith first state by default, set to false for bar estimate
     between every pair of states
+    nprocesses - int, the number of processes used for bootstrapping
 
     Notes
     -----
@@ -141,13 +151,13 @@ def bar_all_states(
 
     """
 
-    if type(dataset) == netCDF4.Dataset:
+    if isinstance(dataset, (netCDF4.Dataset, ProtonsDatasetCollection)):
         initial_states, proposed_states, proposal_work, n_states, gk = calibration_dataset_to_arrays(
             dataset
         )
         group = dataset["Protons/SAMS/group_index"][0]
         approach = SAMSApproach(dataset["Protons/SAMS/approach"][0])
-    elif type(dataset) == list:
+    elif isinstance(dataset, list):
         initial_states, proposed_states, proposal_work, n_states, gk = stitch_calibrations(
             dataset
         )
@@ -158,46 +168,65 @@ def bar_all_states(
             f"Not sure how to handle type ({str(type(dataset))}) of dataset. Please provide a netCDF4 data set or a list of data sets."
         )
 
-    bars_per_transition = dict()
-    outer = range(1) if to_first_state_only else range(n_states)
-    for from_state in outer:
-        for to_state in range(n_states):
-            if from_state == to_state:
-                continue
+    # The work of every transition is gathered in a single pass over the data
+    transitions = _gather_all_transitions(
+        initial_states, proposed_states, proposal_work, gk, n_states
+    )
 
-            transition = "{}->{}".format(from_state, to_state)
-            log.debug(transition)
+    executor = None
+    if bootstrap and nprocesses > 1:
+        executor = ProcessPoolExecutor(max_workers=nprocesses)
 
-            # SAMS bias estimate has the opposite sign of the free energy difference
+    bars_per_transition = dict()
+    outer = range(1) if to_first_state_only else range(n_states)
+    try:
+        for from_state in outer:
+            for to_state in range(n_states):
+                if from_state == to_state:
+                    continue
 
-            if approach is SAMSApproach.ONESITE:
-                sams_estimate = -gk[group, to_state] + gk[group, from_state]
-            elif approach is SAMSApproach.MULTISITE:
-                sams_estimate = -gk[to_state] + gk[from_state]
-            else:
-                raise NotImplementedError(
-                    "This method has not been implemented yet for this approach."
-                )
+                transition = "{}->{}".format(from_state, to_state)
+                log.debug(transition)
 
-            forward, reverse = _gather_transitions(
-                from_state, to_state, initial_states, proposed_states, proposal_work, gk
-            )
+                # SAMS bias estimate has the opposite sign of the free energy difference
 
-            if bootstrap:
-                bar_estimate, bar_sd = _nonparametric_bootstrap_bar(
-                    forward, reverse, num_bootstrap_samples, sams_estimate
-                )
-            else:
+                if approach is SAMSApproach.ONESITE:
+                    sams_estimate = -gk[group, to_state] + gk[group, from_state]
+                elif approach is SAMSApproach.MULTISITE:
+                    sams_estimate = -gk[to_state] + gk[from_state]
+                else:
+                    raise NotImplementedError(
+                        "This method has not been implemented yet for this approach."
+                    )
+
+                forward = transitions[(from_state, to_state)]
+                reverse = transitions[(to_state, from_state)]
+                log.debug("%d forward, %d reverse", forward.size, reverse.size)
+
+                if bootstrap:
+                    bar_estimate, bar_sd = _nonparametric_bootstrap_bar(
+                        forward,
+                        reverse,
+                        num_bootstrap_samples,
+                        sams_estimate,
+                        executor=executor,
+                    )
+                else:
 
-                bar_estimate, bar_sd = bar.BAR(forward, reverse, DeltaF=sams_estimate)
+                    bar_estimate, bar_sd = bar.BAR(
+                        forward, reverse, DeltaF=sams_estimate
+                    )
 
-            bars_per_transition[transition] = (bar_estimate, bar_sd)
+                bars_per_transition[transition] = (bar_estimate, bar_sd)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     return bars_per_transition
 
 
 def extract_work_distributions(
-    dataset: netCDF4.Dataset, state1_idx: int, state2_idx: int, res_idx: int
+    dataset: ProtonsDataset, state1_idx: int, state2_idx: int, res_idx: int
 ) -> tuple:
     """Extract the forward and reverse work distributions for ncmc protocols between two states, for a given residue.
            
@@ -219,33 +248,31 @@ def extract_work_distributions(
     """
 
     ncmc = dataset["Protons/NCMC"]
-    forward_work = []
-    neg_reverse_work = []
 
+    # Every row is an update. The update variable itself restarts in every file of a collection.
     initial_states = ncmc["initial_state"][:, res_idx]
     proposed_states = ncmc["proposed_state"][:, res_idx]
     tot_work = ncmc["total_work"][:]
-    for update in ncmc["update"]:
-        update -= 1  # 1 indexed variable
-        init = initial_states[update]
-        prop = proposed_states[update]
 
-        # Forward distribution
-        if init == state1_idx:
-            if prop == state2_idx:
-                forward_work.append(tot_work[update])
-        # Reverse distribution
-        elif init == state2_idx:
-            if prop == state1_idx:
-                # Use negative value of the work
-                # so that the two distributions have the same sign.
-                neg_reverse_work.append(-tot_work[update])
+    # Masked entries never match a transition
+    forward = np.ma.filled(
+        (initial_states == state1_idx) & (proposed_states == state2_idx), False
+    )
+    reverse = np.ma.filled(
+        (initial_states == state2_idx) & (proposed_states == state1_idx), False
+    )
 
-    return np.asarray(forward_work), np.asarray(neg_reverse_work)
+    # Use negative value of the reverse work
+    # so that the two distributions have the same sign.
+    return np.asarray(tot_work[forward]), -np.asarray(tot_work[reverse])
 
 
 def _nonparametric_bootstrap_bar(
-    forward: np.ndarray, reverse: np.ndarray, nbootstraps: int, sams_estimate: float
+    forward: np.ndarray,
+    reverse: np.ndarray,
+    nbootstraps: int,
+    sams_estimate: float,
+    executor: Optional[ProcessPoolExecutor] = None,
 ):
     """Perform sampling with replacement on forward and reverse trajectories and perform BAR.
 
@@ -255,29 +282,163 @@ def _nonparametric_bootstrap_bar(
     reverse - array of work values for reverse proposals
     nbootstraps - number of bootstrap samples to run
     sams_estimate - initial deltaF guess from SAMS
+    executor - optional, evaluate the bootstrap samples in this process pool
 
     Returns
     -------
     mean, standard error
 
+    Notes
+    -----
+    Samples are evaluated in chunks, each with its own random seed drawn from ``np.random``.
+    The result does not depend on whether an executor is used.
     """
-    num_forward = forward.size
-    num_reverse = reverse.size
+    nchunks = max(1, int(np.ceil(nbootstraps / _bootstrap_chunk_size)))
+    sizes = [chunk.size for chunk in np.array_split(np.arange(nbootstraps), nchunks)]
+    seeds = np.random.randint(2 ** 31 - 1, size=nchunks)
+    arguments = (
+        [forward] * nchunks,
+        [reverse] * nchunks,
+        sizes,
+        [sams_estimate] * nchunks,
+        seeds,
+    )
 
-    strap_bars = list()
-    for bootstrap in range(nbootstraps):
-        # pick new set with the same length from forward trajectories using sampling with replacement
-        bootstrap_forward = forward[np.random.choice(num_forward, num_forward)]
-        # pick new set with the same length from reverse trajectories using sampling with replacement
-        bootstrap_reverse = reverse[np.random.choice(num_reverse, num_reverse)]
-        strap_bars.append(
-            bar.BAR(bootstrap_forward, bootstrap_reverse, DeltaF=sams_estimate)[0]
-        )
+    if executor is None:
+        chunks = map(_bootstrap_bar_samples, *arguments)
+    else:
+        chunks = executor.map(_bootstrap_bar_samples, *arguments)
+    strap_bars = np.concatenate(list(chunks))
 
     # standard deviation of the bootstrap samples corresponds to the standard error.
     return np.mean(strap_bars), np.std(strap_bars)
 
 
+def _bootstrap_bar_samples(
+    forward: np.ndarray,
+    reverse: np.ndarray,
+    nsamples: int,
+    sams_estimate: float,
+    seed: int,
+) -> np.ndarray:
+    """Return the BAR estimates for a number of bootstrap samples of the forward and reverse work.
+
+    Parameters
+    ----------
+    forward - array of work values for forward proposals
+    reverse - array of work values for reverse proposals
+    nsamples - number of bootstrap samples to evaluate
+    sams_estimate - initial deltaF guess from SAMS
+    seed - seed for the random number generator
+    """
+    random = np.random.RandomState(seed)
+    # pick new sets with the same length from the trajectories using sampling with replacement
+    forward_picks = random.randint(forward.size, size=(nsamples, forward.size))
+    reverse_picks = random.randint(reverse.size, size=(nsamples, reverse.size))
+    estimates = np.empty(nsamples, dtype=float)
+    for sample in range(nsamples):
+        estimates[sample] = bar.BAR(
+            forward[forward_picks[sample]],
+            reverse[reverse_picks[sample]],
+            DeltaF=sams_estimate,
+        )[0]
+    return estimates
+
+
+def _transition_arrays(
+    initial_states: np.ndarray,
+    proposed_states: np.ndarray,
+    proposal_work: np.ndarray,
+    gk: np.ndarray,
+):
+    """Return the initial and proposed states, and the work including delta g_k, of every complete update.
+
+    Parameters
+    ----------
+    initial_states - array, the sequence of the initial state of every proposal
+    proposed_states - array, the sequence of the proposed state of every proposal
+    proposal_work - array, the work value of the NCMC proposal, including the delta g_k
+    gk - array, the weights indexed by update, state
+
+    Returns
+    -------
+    array[int], array[int], array[float]
+    initial states, proposed states, and work values of updates without masked data
+    """
+    nupdates = gk.shape[0]
+    initial = np.ma.asarray(initial_states[:nupdates])
+    proposed = np.ma.asarray(proposed_states[:nupdates])
+    work = np.ma.asarray(proposal_work[:nupdates])
+    initial = _single_residue_states(initial)
+    proposed = _single_residue_states(proposed)
+
+    complete = ~(
+        np.ma.getmaskarray(initial)
+        | np.ma.getmaskarray(proposed)
+        | np.ma.getmaskarray(work)
+    )
+    initial = np.asarray(initial[complete], dtype=int)
+    proposed = np.asarray(proposed[complete], dtype=int)
+    weights = np.asarray(gk[:nupdates])[complete]
+    updates = np.arange(initial.size)
+    # subtract delta g_k
+    work = (
+        np.asarray(work[complete], dtype=float)
+        - weights[updates, proposed]
+        + weights[updates, initial]
+    )
+    return initial, proposed, work
+
+
+def _single_residue_states(states: np.ndarray) -> np.ndarray:
+    """Return the states of a single residue, indexed by update, from an array indexed by update(, residue)."""
+    if states.ndim > 1:
+        if states.shape[1] != 1:
+            raise ValueError("Transitions can only be gathered for a single residue.")
+        states = states[:, 0]
+    return states
+
+
+def _gather_all_transitions(
+    initial_states: np.ndarray,
+    proposed_states: np.ndarray,
+    proposal_work: np.ndarray,
+    gk: np.ndarray,
+    n_states: int,
+) -> Dict[Tuple[int, int], np.ndarray]:
+    """Gather the total work for the proposals between every pair of states.
+
+    Parameters
+    ----------
+    initial_states - array, the sequence of the initial state of every proposal
+    proposed_states - array, the sequence of the proposed state of every proposal
+    proposal_work - array, the work value of the NCMC proposal, including the delta g_k
+    gk - array, the weights indexed by update, state
+    n_states - int, the number of states
+
+    Returns
+    -------
+    dict of work values as arrays, with keys (initial state, proposed state)
+    """
+    initial, proposed, work = _transition_arrays(
+        initial_states, proposed_states, proposal_work, gk
+    )
+    # Sort the work by transition, keeping the order of the updates
+    pairs = initial * n_states + proposed
+    order = np.argsort(pairs, kind="stable")
+    bounds = np.searchsorted(pairs[order], np.arange(n_states * n_states + 1))
+    sorted_work = work[order]
+
+    transitions = dict()
+    for from_state in range(n_states):
+        for to_state in range(n_states):
+            pair = from_state * n_states + to_state
+            transitions[(from_state, to_state)] = sorted_work[
+                bounds[pair] : bounds[pair + 1]
+            ]
+    return transitions
+
+
 def _gather_transitions(
     from_state: int,
     to_state: int,
@@ -301,18 +462,11 @@ def _gather_transitions(
     array[float], array[float]
     forward, reverse work values as arrays
     """
-    forward = list()
-    reverse = list()
-
-    for i in range(0, gk.shape[0]):
-        # subtract delta g_k forward
-        if initial_states[i] == from_state and proposed_states[i] == to_state:
-            forward.append(proposal_work[i] - gk[i][to_state] + gk[i][from_state])
-        # subtract delta g_k reverse
-        elif initial_states[i] == to_state and proposed_states[i] == from_state:
-            reverse.append(proposal_work[i] - gk[i][from_state] + gk[i][to_state])
-    forward = np.array(forward)
-    reverse = np.array(reverse)
+    initial, proposed, work = _transition_arrays(
+        initial_states, proposed_states, proposal_work, gk
+    )
+    forward = work[(initial == from_state) & (proposed == to_state)]
+    reverse = work[(initial == to_state) & (proposed == from_state)]
     num_forward = forward.size
     num_reverse = reverse.size
     log.debug("forward", "reverse")
@@ -322,12 +476,13 @@ def _gather_transitions(
 
 
 def plot_calibration_weight_traces(
-    dataset: Union[netCDF4.Dataset, List[netCDF4.Dataset]],
+    dataset: Union[ProtonsDataset, List[ProtonsDataset]],
     ax: plt.Axes = None,
     bar: bool = True,
     error: str = "stdev",
     num_bootstrap_samples: int = 1000,
     zerobased: bool = False,
+    nprocesses: int = 1,
 ):
     """Plot the results of a calibration netCDF dataset.
 
@@ -339,6 +494,7 @@ def plot_calibration_weight_traces(
     error - str, if bar is True 'stdev' will plot the BAR error as 2 times standard deviation returned from BAR, 'bootstrap' will plot standard error from bootstrap.
     num_bootstrap_samples - Used if 'bootstrap' is used as error method. Number of bootstrap samples to draw.
     zerobased - if True, label states in zero based fashion in the plots. Defaults to 1-based
+    nprocesses - Used if 'bootstrap' is used as error method. Number of processes used for bootstrapping.
 
 
     Returns
@@ -373,15 +529,18 @@ def plot_calibration_weight_traces(
     ax.set_xlabel("Update", fontsize=18)
 
     ax.set_ylabel(r"$g_k/RT$ (unitless) relative to state 1", fontsize=18)
-    if type(dataset) == netCDF4.Dataset:
+    if isinstance(dataset, (netCDF4.Dataset, ProtonsDatasetCollection)):
         n_states, gk = calibration_dataset_to_arrays(dataset)[-2:]
-    elif type(dataset) == list:
+    elif isinstance(dataset, list):
         n_states, gk = stitch_calibrations(dataset)[-2:]
     cp = sns.color_palette("husl", n_states)
 
     if bar:
         bar_data = bar_all_states(
-            dataset, bootstrap=bootstrap, num_bootstrap_samples=num_bootstrap_samples
+            dataset,
+            bootstrap=bootstrap,
+            num_bootstrap_samples=num_bootstrap_samples,
+            nprocesses=nprocesses,
         )
     else:
         bar_data = None
@@ -411,7 +570,7 @@ def plot_calibration_weight_traces(
 
 
 def plot_residue_state_traces(
-    dataset: netCDF4.Dataset,
+    dataset: ProtonsDataset,
     residue_index: int,
     ax: plt.Axes = None,
     zerobased_states: bool = False,
@@ -421,7 +580,7 @@ def plot_residue_state_traces(
 
     Parameters
     ----------
-    dataset - netCDF4.Dataset, dataset containing Protons data
+    dataset - netCDF4.Dataset or ProtonsDatasetCollection, dataset containing Protons data
     residue_index - int, the index of the residue for which to plot a trace
     ax - matplotlib axes object, if None creates a new figure and axes
     zerobased_states - bool, default False. Label the states 0 or 1 based.
@@ -479,12 +638,12 @@ def plot_residue_state_traces(
     return ax
 
 
-def charge_taut_trace(dataset: netCDF4.Dataset):
+def charge_taut_trace(dataset: ProtonsDataset):
     """Return a trace of the total charge for each residue, and the tautomer of the charge.
 
     Parameters
     ----------
-    dataset - netCDF4.Dataset, a dataset containing Protons data.
+    dataset - netCDF4.Dataset or ProtonsDatasetCollection, a dataset containing Protons data.
 
     Returns
     -------
@@ -528,7 +687,7 @@ def charge_taut_trace(dataset: netCDF4.Dataset):
 
 
 def plot_heatmap(
-    dataset: netCDF4.Dataset,
+    dataset: ProtonsDataset,
     ax: plt.Axes = None,
     color: str = "charge",
     residues: list = None,
@@ -620,7 +779,7 @@ def plot_heatmap(
 
 
 def plot_tautomer_heatmap(
-    dataset: netCDF4.Dataset,
+    dataset: ProtonsDataset,
     ax: plt.Axes = None,
     residues: list = None,
     zerobased: bool = False,
@@ -700,11 +859,11 @@ def plot_tautomer_heatmap(
     return ax
 
 
-def calculate_ncmc_acceptance_rate(dataset: netCDF4.Dataset):
+def calculate_ncmc_acceptance_rate(dataset: ProtonsDataset):
     """Calculate the NCMC acceptance rate from a dataset containing Protons/NCMC data
     Parameters
     ----------
-    dataset - netCDF4.Dataset, should contain Protons/NCMC data
+    dataset - netCDF4.Dataset or ProtonsDatasetCollection, should contain Protons/NCMC data
 
     Returns
     -------
@@ -725,7 +884,7 @@ def calculate_ncmc_acceptance_rate(dataset: netCDF4.Dataset):
 
 
 def gather_trajectories(
-    datasets: List[netCDF4.Dataset],
+    datasets: Union[ProtonsDataset, List[ProtonsDataset]],
     from_state: int,
     to_state: int,
     cumulative: bool = True,
@@ -734,42 +893,50 @@ def gather_trajectories(
 
     Parameters
     ----------
-    datasets - A list of different netCDF datasets to retrieve NCMC work trajectories from
+    datasets - A list of different netCDF datasets to retrieve NCMC work trajectories from,
+        or a single dataset or ProtonsDatasetCollection
     from_state - The state from which the protocol was initiated
     to_state - The state to which the protocol is changing the system
     cumulative - Set to false if incremental work is desired, rather than cumulative work.
     """
+    if not isinstance(datasets, list):
+        datasets = [datasets]
+
     forward_trajectories = list()
     reverse_trajectories = list()
 
     for d, dataset in enumerate(datasets):
-        for update in dataset["Protons/NCMC/update"][:]:
-            x = update - 1
-            if (
-                from_state == dataset["Protons/NCMC/initial_state"][x, :]
-                and to_state == dataset["Protons/NCMC/proposed_state"][x, :]
-            ):
-
-                if cumulative:
-                    trajectory = dataset["Protons/NCMC/cumulative_work"][x, :]
-                else:
-                    trajectory = np.diff(dataset["Protons/NCMC/cumulative_work"][x, :])
-
-                forward_trajectories.append(trajectory)
-            elif (
-                to_state == dataset["Protons/NCMC/initial_state"][x, :]
-                and from_state == dataset["Protons/NCMC/proposed_state"][x, :]
-            ):
-                if cumulative:
-                    trajectory = dataset["Protons/NCMC/cumulative_work"][x, :]
-                else:
-                    trajectory = np.diff(dataset["Protons/NCMC/cumulative_work"][x, :])
-                reverse_trajectories.append(trajectory)
+        initial_states = _single_residue_states(
+            dataset["Protons/NCMC/initial_state"][:, :]
+        )
+        proposed_states = _single_residue_states(
+            dataset["Protons/NCMC/proposed_state"][:, :]
+        )
+        forward = np.ma.filled(
+            (initial_states == from_state) & (proposed_states == to_state), False
+        )
+        reverse = np.ma.filled(
+            (initial_states == to_state) & (proposed_states == from_state), False
+        )
+
+        # Only the work of the selected updates is read from the file.
+        for selection, trajectories in [
+            (forward, forward_trajectories),
+            (reverse, reverse_trajectories),
+        ]:
+            indices = np.flatnonzero(selection)
+            if indices.size == 0:
+                continue
+            work = dataset["Protons/NCMC/cumulative_work"][indices, :]
+            if not cumulative:
+                work = np.diff(work, axis=1)
+            trajectories.extend(work)
+
     return forward_trajectories, reverse_trajectories
 
 
 def plot_work_per_step(
-    datasets: List[netCDF4.Dataset],
+    datasets: Union[ProtonsDataset, List[ProtonsDataset]],
     from_state: int,
     to_state: int,
     color: str,
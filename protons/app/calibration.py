@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
+import logging
 import numpy as np
+from collections import defaultdict, deque
+from pymbar import bar
+from typing import Deque, Dict, List, Optional, Tuple
 
 from .driver import NCMCProtonDrive, _SAMSState, SAMSApproach, Stage, UpdateRule
 import simtk.unit as units
@@ -35,7 +39,11 @@ class SAMSCalibrationEngine:
         self.approach: SAMSApproach = driver.calibration_state.approach
         self.group_index = driver.calibration_state.group_index
         self._calibration_state: _SAMSState = driver.calibration_state
-        self.nstates = len(self._calibration_state.free_energies)
+        if self.approach is SAMSApproach.MULTISITE:
+            # Counted without building the array of all joint states
+            self.nstates = len(self._calibration_state)
+        else:
+            self.nstates = len(self._calibration_state.free_energies)
         return
 
     def adapt_zetas(
@@ -65,9 +73,6 @@ class SAMSCalibrationEngine:
 
         """
 
-        # zeta^{t-1}
-        zeta = self._calibration_state.free_energies
-
         # Stage dependend prep work
 
         # Only increase adaptation number if adaptation is expected
@@ -79,19 +84,20 @@ class SAMSCalibrationEngine:
             current_state = self._calibration_state.state_index(
                 self.driver.titrationStates
             )
-            counts = self._calibration_state.observed_counts
-            counts[current_state] += 1
-            self._calibration_state.observed_counts = counts
+            self._calibration_state.add_observed(current_state, 1.0)
             return self._calibration_state.max_absolute_deviation
 
         # Perform updates for all stages other than equilibrium
+        # zeta^{t-1/2} = zeta^{t-1} + update
         if update_rule is UpdateRule.BINARY:
-            update = self._binary_update(
+            # Only the free energy of the current state changes
+            current_state, update = self._binary_update(
                 group_index=self.group_index,
                 b=b,
                 stage=stage,
                 end_of_slowdecay=end_of_slowdecay,
             )
+            self._calibration_state.add_free_energy(current_state, update)
         elif update_rule is UpdateRule.GLOBAL:
             if self.approach is SAMSApproach.MULTISITE:
                 raise NotImplementedError(
@@ -103,29 +109,29 @@ class SAMSCalibrationEngine:
                 stage=stage,
                 end_of_slowdecay=end_of_slowdecay,
             )
+            self._calibration_state.free_energies = (
+                self._calibration_state.free_energies + update
+            )
         else:
             raise ValueError("Unknown adaptation update_rule: {}!".format(update_rule))
 
-        # zeta^{t-1/2}
-        zeta += update
         # zeta^{t} = zeta^{t-1/2} - zeta_1^{t-1/2}
-        zeta_t = zeta - zeta[0]
-
-        # Set reference free energy based on new zeta
-        self._calibration_state.free_energies = zeta_t
+        self._calibration_state.normalize_free_energies()
 
         # These need to be taken from full calibration run
         if self._calibration_state._current_adaptation > 0:
             target_deviation = self._calibration_state.max_absolute_deviation
-            log.debug(
-                "Adaptation step %8d : zeta_t = %s, N_k = %s, %2f%% deviation"
-                % (
-                    self._calibration_state._current_adaptation,
-                    str(zeta_t),
-                    str(self._calibration_state.observed_counts),
-                    target_deviation * 100,
+            # Formatting the full tables is expensive for multisite calibrations
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(
+                    "Adaptation step %8d : zeta_t = %s, N_k = %s, %2f%% deviation"
+                    % (
+                        self._calibration_state._current_adaptation,
+                        str(self._calibration_state.free_energies),
+                        str(self._calibration_state.observed_counts),
+                        target_deviation * 100,
+                    )
                 )
-            )
             return target_deviation
         else:
             log.debug(
@@ -140,7 +146,7 @@ class SAMSCalibrationEngine:
         b: float = 1.0,
         stage=Stage.FASTDECAY,
         end_of_slowdecay: int = 0,
-    ):
+    ) -> Tuple[int, float]:
         """
         Binary update scheme (equation 9) from DOI: 10.1080/10618600.2015.1113975
 
@@ -155,31 +161,28 @@ class SAMSCalibrationEngine:
             Iteration at which slow-decay phase was ended.
         Returns
         -------
-        np.ndarray - free energy updates
+        int - index of the current state
+        float - free energy update of the current state, the update of all other states is zero.
         """
-        # [1/pi_1...1/pi_i]
-        update = np.asarray(list(map(lambda x: 1 / x, self._calibration_state.targets)))
-        # delta(Lt)
-        delta = np.zeros_like(update)
         current_state = self._calibration_state.state_index(self.driver.titrationStates)
-        delta[current_state] = 1
-        update *= delta
-        update = np.dot(
-            self._gain_factor(b=b, stage=stage, end_of_slowdecay=end_of_slowdecay),
-            update,
+        # pi_i of the current state
+        target = self._calibration_state.target_of_index(current_state)
+        # delta(Lt) is one for the current state only, so the update is gain_i / pi_i
+        gain = min(
+            target,
+            self._gain_rate(b=b, stage=stage, end_of_slowdecay=end_of_slowdecay),
         )
+        update = gain / target
 
         # Update count of current state weights.
         # Use sqrt to make recent states count more
         # Only performed if past burn-in
         if self._calibration_state._current_adaptation > 0:
-            counts = self._calibration_state.observed_counts
-            counts[current_state] += np.sqrt(
-                self._calibration_state._current_adaptation
+            self._calibration_state.add_observed(
+                current_state, np.sqrt(self._calibration_state._current_adaptation)
             )
-            self._calibration_state.observed_counts = counts
 
-        return update
+        return current_state, update
 
     def _global_update(
         self, b=1.0, stage: Stage = Stage.FASTDECAY, end_of_slowdecay=0, group_index=0
@@ -205,16 +208,14 @@ class SAMSCalibrationEngine:
         pi_j = self._calibration_state.targets
         # [1/pi_1...1/pi_i]
         update = 1.0 / pi_j
-        ub_j = self.driver._get_reduced_potentials(group_index)
+        # Reduced potentials up to a constant suffice, since the weights are normalized
+        ub_j = self.driver._get_relative_reduced_potentials(group_index)
         # w_j(X;ζ⁽ᵗ⁻¹⁾)
         log_w_j = np.log(pi_j) - zeta - ub_j
         log_w_j -= logsumexp(log_w_j)
         w_j = np.exp(log_w_j)
         update *= w_j / pi_j
-        update = np.dot(
-            self._gain_factor(b=b, stage=stage, end_of_slowdecay=end_of_slowdecay),
-            update,
-        )
+        update *= self._gain_factor(b=b, stage=stage, end_of_slowdecay=end_of_slowdecay)
 
         # Update count of current state weights.
         # Use sqrt to make recent states count more
@@ -239,35 +240,249 @@ class SAMSCalibrationEngine:
 
         Returns
         -------
-        np.ndarray - gain factor matrix
+        np.ndarray - gain factor of every state, the diagonal of the gain matrix
+        """
+        pi_j = self._calibration_state.targets
+        return np.minimum(
+            pi_j, self._gain_rate(b=b, stage=stage, end_of_slowdecay=end_of_slowdecay)
+        )
+
+    def _gain_rate(self, b=1.0, stage=Stage.FASTDECAY, end_of_slowdecay=0) -> float:
         """
+        The decaying part of the gain factor, the gain of state j is min(pi_j, rate).
+
+        Parameters
+        ----------
+        b : float, optional (default : 1.0)
+             Decay factor β in two stage SAMS update scheme. Must be between 0.5 and 1.0.
+        stage : Sams two-stage phase. Options : Stage.SLOWDECAY or Stage.FASTDECAY
+        end_of_slowdecay: int, optional (default : 0)
+            Iteration at which slow_decay phase was ended.
 
+        Returns
+        -------
+        float - the rate for the current adaptation
+        """
         if not 0.5 <= b <= 1.0:
             raise ValueError("β needs to be between 1/2 and 1")
 
-        pi_j = self._calibration_state.targets
         n_adapt = self._calibration_state._current_adaptation
 
-        gain = np.zeros_like(pi_j)
-        for j in range(gain.size):
-            # Adaptation with a slow decay of the gain factor
-            if stage is Stage.SLOWDECAY:
-                gain[j] = min(pi_j[j], 1.0 / pow(n_adapt, b))
-            # Adaptation with a fast decay of the gain factor (asymptotic optimal convergence)
-            elif stage is Stage.FASTDECAY:
-                gain[j] = min(
-                    pi_j[j],
-                    1.0 / (n_adapt - end_of_slowdecay + pow(end_of_slowdecay, b)),
-                )
-            # Adaptation with no decay of the gain factor (sub-optimal, not proven to converge, for initial guess)
-            elif stage is Stage.NODECAY:
-                gain[j] = min(pi_j[j], 1.0)
-            # No adaptation, for equilibrium free energy estimates
-            elif stage is Stage.EQUILIBRIUM:
-                gain[j] = 0.0
-            else:
-                raise ValueError(
-                    "Invalid SAMS adaptation stage specified %s. Choose Stage.SLOWDECAY or Stage.FASTDECAY."
-                )
+        # Adaptation with a slow decay of the gain factor
+        if stage is Stage.SLOWDECAY:
+            return 1.0 / pow(n_adapt, b)
+        # Adaptation with a fast decay of the gain factor (asymptotic optimal convergence)
+        elif stage is Stage.FASTDECAY:
+            return 1.0 / (n_adapt - end_of_slowdecay + pow(end_of_slowdecay, b))
+        # Adaptation with no decay of the gain factor (sub-optimal, not proven to converge, for initial guess)
+        elif stage is Stage.NODECAY:
+            return 1.0
+        # No adaptation, for equilibrium free energy estimates
+        elif stage is Stage.EQUILIBRIUM:
+            return 0.0
+        else:
+            raise ValueError(
+                "Invalid SAMS adaptation stage specified %s. Choose Stage.SLOWDECAY or Stage.FASTDECAY."
+            )
+
+
+class SAMSConvergenceMonitor:
+    """Decides when a SAMS calibration has converged, so that it can be stopped early.
+
+    The monitor follows two measures of the uncertainty of the SAMS free energies (zeta).
+
+    * The standard deviation of zeta relative to the first state, over a window of recent adaptations.
+    * The agreement between SAMS and BAR estimates of the free energy difference between the first state and every
+      other state, using the work of the NCMC proposals. This is the estimate of
+      ``protons.app.analysis.bar_all_states``, updated during the run.
 
-        return np.diag(gain)
+    The calibration has converged once both the fluctuation of zeta and the BAR uncertainty are below ``tolerance``,
+    and BAR and SAMS agree within ``agreement``.
+
+    Notes
+    -----
+    Add the monitor to the update reporters of the simulation to collect the work of every update,
+    and call ``record_adaptation`` after every adaptation.
+    Only the calibrated residue is considered, a multisite calibration should contain a single residue.
+    """
+
+    def __init__(
+        self,
+        tolerance: float = 0.1,
+        agreement: float = 0.2,
+        window: int = 500,
+        check_interval: int = 100,
+        min_samples: int = 20,
+        min_stage: Stage = Stage.FASTDECAY,
+    ):
+        """Set up the convergence criteria.
+
+        Parameters
+        ----------
+        tolerance - the largest standard deviation of zeta, and the largest BAR uncertainty (in kT)
+        agreement - the largest difference between BAR and SAMS estimates (in kT)
+        window - the number of adaptations over which the standard deviation of zeta is calculated
+        check_interval - only evaluate the criteria every this many adaptations, since BAR is relatively expensive
+        min_samples - the minimum number of proposals in each direction between the first and any other state
+        min_stage - the calibration can not converge before reaching this stage
+        """
+        if window < 2:
+            raise ValueError("The window needs to contain at least 2 adaptations.")
+        if check_interval < 1:
+            raise ValueError("The check interval needs to be at least 1.")
+
+        self.tolerance = tolerance
+        self.agreement = agreement
+        self.check_interval = check_interval
+        self.min_samples = min_samples
+        self.min_stage = min_stage
+
+        # Work without the delta g_k, by (initial state, proposed state)
+        self._transitions: Dict[Tuple[int, int], List[float]] = defaultdict(list)
+        # zeta relative to the first state, for the latest adaptations
+        self._window: Deque[np.ndarray] = deque(maxlen=window)
+        self._stage: Stage = Stage.NODECAY
+        self._nadaptations = 0
+        self._last_check = 0
+        self._converged = False
+        self._last_attempt = None
+
+        # Results of the latest check
+        self.zeta_std: Optional[np.ndarray] = None
+        self.estimates: Dict[str, Tuple[float, float, float]] = dict()
+
+    def describeNextReport(self, simulation):
+        """Report after every update.
+
+        Returns
+        -------
+        tuple - the number of updates until the next report, and whether coordinates are needed
+        """
+        return tuple([1, False])
+
+    def report(self, simulation):
+        """Record the work of the latest update of the calibrated residue.
+
+        Parameters
+        ----------
+        simulation : ConstantPHSimulation
+        """
+        drv = simulation.drive
+        attempt = drv._last_attempt_data
+        # Attempts are only counted once, even if the simulation reports without updating.
+        if attempt is None or attempt is self._last_attempt:
+            return
+        self._last_attempt = attempt
+        if attempt._initial_states is None or attempt.work is None:
+            return
+
+        calibration_state = drv.calibration_state
+        if calibration_state is None:
+            raise ValueError("Proton drive has no calibration state attached.")
+        if calibration_state.approach is SAMSApproach.ONESITE:
+            group_index = calibration_state.group_index
+        elif len(drv.titrationGroups) == 1:
+            group_index = 0
+        else:
+            raise ValueError(
+                "Convergence can only be monitored for the calibration of a single residue."
+            )
+
+        initial = int(attempt.initial_states[group_index])
+        proposed = int(attempt.proposed_states[group_index])
+        if initial == proposed or not np.isfinite(attempt.work):
+            return
+        # The work includes the delta g_k of the calibrated residue
+        gk = calibration_state.free_energies
+        self.add_work(initial, proposed, attempt.work - gk[proposed] + gk[initial])
+
+    def add_work(self, initial_state: int, proposed_state: int, work: float):
+        """Add the work of a proposal between two states, without the delta g_k.
+
+        Parameters
+        ----------
+        initial_state - the state before the proposal
+        proposed_state - the proposed state
+        work - the NCMC work (in kT)
+        """
+        self._transitions[(initial_state, proposed_state)].append(float(work))
+
+    def record_adaptation(self, calibration_state: _SAMSState):
+        """Add the free energies after an adaptation."""
+        self.add_free_energies(
+            calibration_state.free_energies, calibration_state._stage
+        )
+
+    def add_free_energies(self, free_energies: np.ndarray, stage: Stage):
+        """Add the free energies after an adaptation.
+
+        Parameters
+        ----------
+        free_energies - zeta of every state of the calibrated residue
+        stage - the SAMS stage of the adaptation
+        """
+        # Fluctuations of earlier stages do not reflect the current gain
+        if stage is not self._stage:
+            self._window.clear()
+            self._stage = stage
+        free_energies = np.asarray(free_energies, dtype=float)
+        self._window.append(free_energies - free_energies[0])
+        self._nadaptations += 1
+
+    def converged(self) -> bool:
+        """Return True if the calibration has converged.
+
+        The criteria are evaluated every ``check_interval`` adaptations, in between the last result is returned.
+        """
+        if self._nadaptations - self._last_check >= self.check_interval:
+            self._last_check = self._nadaptations
+            self._converged = self._check()
+        return self._converged
+
+    def _check(self) -> bool:
+        """Evaluate the convergence criteria."""
+        if (
+            self._stage.value < self.min_stage.value
+            or len(self._window) < self._window.maxlen
+        ):
+            return False
+
+        zetas = np.asarray(self._window)
+        self.zeta_std = np.std(zetas, axis=0)
+        nstates = zetas.shape[1]
+
+        converged = bool(np.max(self.zeta_std) < self.tolerance)
+        self.estimates = dict()
+        for to_state in range(1, nstates):
+            forward = self._transitions[(0, to_state)]
+            reverse = self._transitions[(to_state, 0)]
+            if min(len(forward), len(reverse)) < self.min_samples:
+                return False
+
+            # SAMS bias estimate has the opposite sign of the free energy difference
+            sams_estimate = -zetas[-1, to_state]
+            try:
+                bar_estimate, bar_sd = bar.BAR(
+                    np.asarray(forward), np.asarray(reverse), DeltaF=sams_estimate
+                )
+            except Exception as error:
+                log.debug("BAR failed for 0->{}: {}".format(to_state, error))
+                return False
+
+            self.estimates["0->{}".format(to_state)] = (
+                bar_estimate,
+                bar_sd,
+                sams_estimate,
+            )
+            if not (
+                np.isfinite(bar_sd)
+                and bar_sd < self.tolerance
+                and abs(bar_estimate - sams_estimate) < self.agreement
+            ):
+                converged = False
+
+        log.debug(
+            "Convergence check at adaptation %d: max zeta std %.3f, %s"
+            % (self._nadaptations, np.max(self.zeta_std), str(self.estimates))
+        )
+        return converged
@@ -0,0 +1,283 @@
+# coding=utf-8
+"""Read-only views of multiple protons netCDF files as a single data set."""
+
+import glob
+import os
+import re
+import netCDF4
+import numpy as np
+from typing import Iterator, List, Optional, Tuple, Union
+
+# Default number of rows read at a time when iterating over a variable
+_default_chunk_size = 4096
+
+
+def _is_unlimited(variable: netCDF4.Variable) -> bool:
+    """Returns True if the first dimension of the variable is unlimited."""
+    if len(variable.dimensions) == 0:
+        return False
+    name = variable.dimensions[0]
+    # Dimensions can be defined in any of the parent groups
+    group = variable.group()
+    while group is not None:
+        if name in group.dimensions:
+            return group.dimensions[name].isunlimited()
+        group = group.parent
+    return False
+
+
+class _ConcatenatedVariable:
+    """A netCDF variable, concatenated over multiple files along its unlimited first dimension.
+
+    Data is only read from the files when the variable is indexed.
+    """
+
+    def __init__(self, variables: List[netCDF4.Variable], chunk_size: int):
+        """Set up the view.
+
+        Parameters
+        ----------
+        variables - the same variable from every file, in order
+        chunk_size - the number of rows read at a time when iterating
+        """
+        trailing = variables[0].shape[1:]
+        for variable in variables[1:]:
+            if variable.shape[1:] != trailing:
+                raise ValueError(
+                    "The shape of {} differs between files ({} vs {}).".format(
+                        variables[0].name, variable.shape[1:], trailing
+                    )
+                )
+        self._variables = variables
+        self._offsets = np.cumsum([0] + [variable.shape[0] for variable in variables])
+        self.chunk_size = chunk_size
+
+    @property
+    def name(self) -> str:
+        return self._variables[0].name
+
+    @property
+    def dimensions(self) -> Tuple[str, ...]:
+        return self._variables[0].dimensions
+
+    @property
+    def dtype(self):
+        return self._variables[0].dtype
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (int(self._offsets[-1]),) + self._variables[0].shape[1:]
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[...], dtype=dtype)
+
+    def __iter__(self):
+        for start, chunk in self.iter_chunks():
+            for row in chunk:
+                yield row
+
+    def iter_chunks(
+        self, chunk_size: Optional[int] = None
+    ) -> Iterator[Tuple[int, np.ndarray]]:
+        """Iterate over the rows of the variable in chunks, which never span multiple files.
+
+        Parameters
+        ----------
+        chunk_size - the maximum number of rows per chunk, defaults to the chunk size of the collection.
+
+        Yields
+        ------
+        the index of the first row of the chunk, array with the rows of the chunk
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        for offset, variable in zip(self._offsets, self._variables):
+            for start in range(0, variable.shape[0], chunk_size):
+                yield int(offset + start), variable[start : start + chunk_size]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) == 0 or key[0] is Ellipsis:
+            key = (slice(None),) + key
+        first, rest = key[0], key[1:]
+
+        if isinstance(first, (int, np.integer)):
+            index = int(first)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("Index {} is out of range.".format(first))
+            ifile = int(np.searchsorted(self._offsets, index, side="right")) - 1
+            return self._variables[ifile][(index - self._offsets[ifile],) + rest]
+
+        if isinstance(first, slice):
+            indices = np.arange(len(self))[first]
+        else:
+            indices = np.asarray(first)
+            if indices.dtype == bool:
+                indices = np.flatnonzero(indices)
+            indices = np.where(indices < 0, indices + len(self), indices).astype(int)
+            if indices.size > 0 and (indices.min() < 0 or indices.max() >= len(self)):
+                raise IndexError("Index out of range.")
+        return self._take(indices, rest)
+
+    def _take(self, indices: np.ndarray, rest: tuple):
+        """Read the given rows from every file, in the requested order."""
+        # Read every row only once, in increasing order.
+        unique, inverse = np.unique(indices, return_inverse=True)
+        parts = list()
+        for ifile, variable in enumerate(self._variables):
+            begin, end = np.searchsorted(
+                unique, self._offsets[ifile : ifile + 2], side="left"
+            )
+            if begin == end:
+                continue
+            local = unique[begin:end] - self._offsets[ifile]
+            if local[-1] - local[0] + 1 == local.size:
+                # Contiguous rows can be read as a slice.
+                parts.append(variable[(slice(local[0], local[-1] + 1),) + rest])
+            else:
+                parts.append(variable[(local,) + rest])
+        if len(parts) == 0:
+            shape = self._variables[0][(slice(0, 0),) + rest].shape
+            return np.ma.empty(shape, dtype=self.dtype)
+        return np.ma.concatenate(parts, axis=0)[inverse]
+
+
+class _CollectionGroup:
+    """A group of a ProtonsDatasetCollection, which gives access to its variables and subgroups."""
+
+    def __init__(self, collection: "ProtonsDatasetCollection", path: str):
+        self._collection = collection
+        self.path = path
+
+    def __getitem__(self, name: str):
+        return self._collection["{}/{}".format(self.path, name)]
+
+    def __contains__(self, name: str) -> bool:
+        return "{}/{}".format(self.path, name) in self._collection
+
+    @property
+    def variables(self) -> dict:
+        group = self._collection.datasets[0][self.path]
+        return {name: self[name] for name in group.variables}
+
+    @property
+    def groups(self) -> dict:
+        group = self._collection.datasets[0][self.path]
+        return {name: self[name] for name in group.groups}
+
+
+class ProtonsDatasetCollection:
+    """Presents multiple protons netCDF files, such as the output of successive runs, as a single data set.
+
+    Variables with an unlimited first dimension (the update or iteration dimension) are concatenated over all
+    files, in the order the files were provided. Data is read lazily, when the variable is indexed.
+    Other variables, such as metadata, are taken from the first file.
+
+    Notes
+    -----
+    The collection can be used by the functions in ``protons.app.analysis`` in place of a ``netCDF4.Dataset``.
+    """
+
+    def __init__(
+        self,
+        datasets: List[Union[str, netCDF4.Dataset]],
+        chunk_size: int = _default_chunk_size,
+    ):
+        """Open the collection.
+
+        Parameters
+        ----------
+        datasets - the filenames or opened netCDF4 datasets, in order.
+            Files that are passed by name are opened read-only, and closed by ``close``.
+        chunk_size - the number of rows read at a time when iterating over a variable.
+        """
+        if len(datasets) == 0:
+            raise ValueError("Please provide at least one data set.")
+        if chunk_size < 1:
+            raise ValueError("The chunk size needs to be at least 1.")
+        self.chunk_size = chunk_size
+        self.datasets: List[netCDF4.Dataset] = list()
+        self._opened: List[netCDF4.Dataset] = list()
+        for dataset in datasets:
+            if isinstance(dataset, str):
+                dataset = netCDF4.Dataset(dataset, "r")
+                self._opened.append(dataset)
+            self.datasets.append(dataset)
+        self._cache = dict()
+
+    @classmethod
+    def from_basename(
+        cls, basename: str, chunk_size: int = _default_chunk_size
+    ) -> "ProtonsDatasetCollection":
+        """Collect the ``{basename}-{runid}.nc`` files written by successive runs, ordered by run index.
+
+        Parameters
+        ----------
+        basename - the output basename of the runs, including the directory
+        chunk_size - the number of rows read at a time when iterating over a variable.
+        """
+        pattern = re.compile(r"^{}-(\d+)\.nc$".format(re.escape(basename)))
+        runs = list()
+        for filename in glob.glob("{}-*.nc".format(glob.escape(basename))):
+            match = pattern.match(filename)
+            if match is not None:
+                runs.append((int(match.group(1)), filename))
+        if len(runs) == 0:
+            raise FileNotFoundError(
+                "No output files found for {}.".format(os.path.abspath(basename))
+            )
+        return cls([filename for runid, filename in sorted(runs)], chunk_size)
+
+    def __getitem__(self, path: str):
+        path = path.strip("/")
+        if path in self._cache:
+            return self._cache[path]
+
+        item = self.datasets[0][path]
+        if isinstance(item, netCDF4.Variable):
+            if _is_unlimited(item):
+                item = _ConcatenatedVariable(
+                    [dataset[path] for dataset in self.datasets], self.chunk_size
+                )
+        else:
+            item = _CollectionGroup(self, path)
+        self._cache[path] = item
+        return item
+
+    def __contains__(self, path: str) -> bool:
+        try:
+            self.datasets[0][path.strip("/")]
+        except (KeyError, IndexError):
+            return False
+        return True
+
+    def __len__(self) -> int:
+        return len(self.datasets)
+
+    def set_auto_mask(self, value: bool):
+        """Enable or disable automatic conversion to masked arrays for every file."""
+        for dataset in self.datasets:
+            dataset.set_auto_mask(value)
+
+    def close(self):
+        """Close the files that were opened by the collection."""
+        for dataset in self._opened:
+            dataset.close()
+        self._opened = list()
+        self._cache = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
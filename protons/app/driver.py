@@ -36,6 +36,8 @@ from .integrators import GHMCIntegrator, GBAOABIntegrator
 from enum import Enum
 import itertools
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from scipy.special import logsumexp, erfcinv
 
 kB = (1.0 * unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA).in_units_of(
     unit.kilojoules_per_mole / unit.kelvin
@@ -55,6 +57,151 @@ class SamplingMethod(Enum):
     IMPORTANCE = 1
 
 
+class ParameterUpdateMethod(Enum):
+    """Enum for the ways in which force parameters are changed between titration states."""
+
+    # Set the parameters of all titratable particles in the forces, and push the forces to the context.
+    FORCE_PARAMETERS = 0
+
+    # Encode all titration states as NonbondedForce parameter offsets that are tied to global parameters.
+    # Changing states, or performing NCMC, only requires setting global parameters in the context.
+    GLOBAL_PARAMETER_OFFSETS = 1
+
+    # Set force parameters between states, but switch the NonbondedForce during NCMC using parameter offsets
+    # that are tied to a single global parameter. See ``NCMCProtonDrive.enable_ncmc_parameter_offsets``.
+    NCMC_PARAMETER_OFFSETS = 2
+
+
+class _PopulationTable:
+    """Log populations of the states of a residue, tabulated by pH, temperature and ionic strength.
+
+    The table is compiled once from the pKa data of a residue type. For every combination of temperature
+    and ionic strength, the log populations are stored as an array indexed by (pH, state), with the pH values sorted.
+    Tables are shared between residues with the same type and pKa data.
+
+    Notes
+    -----
+    Log populations at a pH between two tabulated values are interpolated linearly, and normalized.
+    Conditions without a temperature or ionic strength match any requested temperature or ionic strength.
+    """
+
+    # Compiled tables, by residue type and contents of the pKa data
+    _shared: Dict[Tuple[str, bytes], "_PopulationTable"] = dict()
+
+    def __init__(self, pka_data: DataFrame):
+        """Compile the table.
+
+        Parameters
+        ----------
+        pka_data - DataFrame with the columns "State", "pH", "Temperature (K)", "Ionic strength (mM)"
+            and "log population", with one row per state and condition.
+        """
+        self.nstates = int(pka_data["State"].max()) + 1
+        self._states = pka_data["State"].to_numpy(dtype=int)
+        self._pH = pka_data["pH"].to_numpy(dtype=float)
+        self._temperature = pka_data["Temperature (K)"].to_numpy(dtype=float)
+        self._ionic_strength = pka_data["Ionic strength (mM)"].to_numpy(dtype=float)
+        self._log_populations = pka_data["log population"].to_numpy(dtype=float)
+        # Arrays by requested (temperature, ionic strength)
+        self._conditions: Dict[
+            Tuple[Optional[float], Optional[float]],
+            Tuple[np.ndarray, np.ndarray, np.ndarray],
+        ] = dict()
+
+    @classmethod
+    def for_residue(cls, residue_type: str, pka_data: DataFrame) -> "_PopulationTable":
+        """Return the table for the pKa data of a residue type, compiling it if it was not seen before."""
+        key = (
+            residue_type,
+            pd.util.hash_pandas_object(pka_data, index=False).to_numpy().tobytes(),
+        )
+        if key not in cls._shared:
+            cls._shared[key] = cls(pka_data)
+        return cls._shared[key]
+
+    def _compile(
+        self, temperature: Optional[float], ionic_strength: Optional[float]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Arrays of the tabulated pH values, the log populations and whether they were tabulated, for a condition.
+
+        Returns
+        -------
+        np.ndarray - sorted pH values
+        np.ndarray - log populations, indexed by pH, state. NaN outside of the tabulated range of a state.
+        np.ndarray - bool, True if the log population was tabulated, rather than interpolated
+        """
+        rows = np.isfinite(self._pH)
+        if temperature is not None:
+            rows &= np.isnan(self._temperature) | (self._temperature == temperature)
+        if ionic_strength is not None:
+            rows &= np.isnan(self._ionic_strength) | (
+                self._ionic_strength == ionic_strength
+            )
+
+        pH_values = np.unique(self._pH[rows])
+        log_populations = np.full((pH_values.size, self.nstates), np.nan)
+        tabulated = np.zeros((pH_values.size, self.nstates), dtype=bool)
+        for state in range(self.nstates):
+            state_rows = np.flatnonzero(rows & (self._states == state))
+            # The first row of every pH is used
+            state_pH, first = np.unique(self._pH[state_rows], return_index=True)
+            if state_pH.size == 0:
+                continue
+            values = self._log_populations[state_rows[first]]
+            inside = (pH_values >= state_pH[0]) & (pH_values <= state_pH[-1])
+            log_populations[inside, state] = np.interp(
+                pH_values[inside], state_pH, values
+            )
+            tabulated[np.searchsorted(pH_values, state_pH), state] = True
+        return pH_values, log_populations, tabulated
+
+    def log_populations(
+        self,
+        pH: float,
+        temperature: Optional[float] = None,
+        ionic_strength: Optional[float] = None,
+    ) -> np.ndarray:
+        """Return the log population of every state under the given condition.
+
+        Parameters
+        ----------
+        pH - the pH
+        temperature - optional, the temperature in Kelvin
+        ionic_strength - optional, the ionic strength in millimolar
+
+        Raises
+        ------
+        ValueError - if the pH is outside of the tabulated range for any of the states.
+        """
+        condition = (temperature, ionic_strength)
+        if condition not in self._conditions:
+            self._conditions[condition] = self._compile(temperature, ionic_strength)
+        pH_values, log_populations, tabulated = self._conditions[condition]
+
+        index = int(np.searchsorted(pH_values, pH))
+        if index < pH_values.size and pH_values[index] == pH:
+            values = log_populations[index]
+            # Values interpolated for some of the states are normalized
+            normalize = not np.all(tabulated[index])
+        elif 0 < index < pH_values.size:
+            low, high = pH_values[index - 1], pH_values[index]
+            fraction = (pH - low) / (high - low)
+            values = (1.0 - fraction) * log_populations[
+                index - 1
+            ] + fraction * log_populations[index]
+            normalize = True
+        else:
+            raise ValueError("pH {} is outside of the tabulated range.".format(pH))
+
+        if np.any(np.isnan(values)):
+            raise ValueError(
+                "pH {} is outside of the tabulated range of some states.".format(pH)
+            )
+        if normalize:
+            values = values - logsumexp(values)
+        return np.array(values)
+
+
 class _TitratableResidue:
     """Representation of a single residue with multiple titration states."""
 
@@ -80,6 +227,10 @@ class _TitratableResidue:
         self._state = None
         self._pka_data = None
         self._residue_pka = None
+        # Compiled pKa data, built on demand
+        self._population_table: Optional[_PopulationTable] = None
+        # Array representation of the cached force parameters of all states, built on demand
+        self._packed_forces = None
 
         return
 
@@ -166,28 +317,34 @@ class _TitratableResidue:
         return obj
 
     @classmethod
-    def from_serialized_xml(cls, xmltree):
+    def from_serialized_xml(
+        cls,
+        xmltree,
+        packed_forces: Optional[List["_PackedForceParameters"]] = None,
+    ):
         """Create a titratable residue from a serialized titratable residue.
 
         Parameters
         ----------
         xmltree - etree.ElementTree or compatible lxml class, should only contain one residue.
+        packed_forces - optional, the force parameters of all states, packed into arrays.
+            Use this for residues that were serialized without force parameters (see ``serialize``).
 
         Returns
         -------
         obj - a newly instantiated _TitratableResidue object.
 
         """
-
-        # prevent accidental modification of the user supplied file.
-        xmltree = copy.deepcopy(xmltree)
+        # The supplied tree is only read, never modified.
+        if hasattr(xmltree, "getroot"):
+            xmltree = xmltree.getroot()
         obj = cls()
 
         # The indices of the residue atoms in the system
         atom_indices = list()
 
-        res = xmltree.xpath("/TitratableResidue")[0]
-        for atom in xmltree.xpath("/TitratableResidue/atom"):
+        res = xmltree
+        for atom in res.xpath("atom"):
             atom_indices.append(int(atom.get("index")))
         obj.atom_indices = atom_indices
 
@@ -199,7 +356,7 @@ class _TitratableResidue:
         obj.residue_type = str(res.get("type"))
         # NonbondedForce exceptions associated with this titration state
         exception_indices = list()
-        for exception in xmltree.xpath("/TitratableResidue/exception"):
+        for exception in res.xpath("exception"):
             exception_indices.append(int(exception.get("index")))
 
         obj.exception_indices = exception_indices
@@ -208,7 +365,7 @@ class _TitratableResidue:
         obj._residue_pka = None
 
         # parse the pka data block as if an html table
-        pka_data = xmltree.xpath("/TitratableResidue/pka_data")
+        pka_data = res.xpath("pka_data")
         if len(pka_data):
             pka_data = copy.deepcopy(pka_data[0])
             pka_data.tag = "table"
@@ -221,7 +378,7 @@ class _TitratableResidue:
         if obj._pka_data is not None and obj._residue_pka is not None:
             raise ValueError("You can only provide pka_data, or residue_pka, not both.")
 
-        states = xmltree.xpath("/TitratableResidue/TitrationState")
+        states = res.xpath("TitrationState")
         obj.titration_states = [None] * len(states)
 
         for state in states:
@@ -230,6 +387,18 @@ class _TitratableResidue:
                 state
             )
 
+        if packed_forces is not None:
+            for packed in packed_forces:
+                if packed.atom_parameters.shape[0] != len(states):
+                    raise ValueError(
+                        "The packed forces of residue {} do not match its {} states.".format(
+                            obj.name, len(states)
+                        )
+                    )
+            obj._packed_forces = packed_forces
+            for state_index, state in enumerate(obj.titration_states):
+                state.set_packed_forces(packed_forces, state_index)
+
         # Set the titration state of this residue
         obj.state = int(res.get("state"))
 
@@ -238,11 +407,36 @@ class _TitratableResidue:
     def add_state(self, state):
         """Adds a _TitrationState to the residue."""
         self.titration_states.append(state)
+        self._packed_forces = None
+
+    @property
+    def packed_forces(self) -> List["_PackedForceParameters"]:
+        """Force parameters of all titration states, packed into arrays per force.
+
+        Notes
+        -----
+        The packed arrays are built from the ``forces`` cache of every state the first time they are needed.
+        Call ``invalidate_packed_forces`` after modifying the force cache of any of the states.
+        """
+        if self._packed_forces is None:
+            self._packed_forces = _PackedForceParameters.from_titration_states(
+                self.titration_states
+            )
+        return self._packed_forces
+
+    def invalidate_packed_forces(self):
+        """Discard the packed force parameters so they will be rebuilt from the states on next use."""
+        self._packed_forces = None
 
-    def serialize(self):
+    def serialize(self, include_forces: bool = True):
         """
         Create an xml representation of this residue.
 
+        Parameters
+        ----------
+        include_forces - serialize the cached force parameters of the states.
+            Leave them out if they are stored separately as arrays, see ``NCMCProtonDrive.force_cache_arrays``.
+
         Returns
         -------
         res - lxml tree containing residue information
@@ -273,7 +467,8 @@ class _TitratableResidue:
 
         res.TitrationState = E.TitrationState()
         res.TitrationState[:] = [
-            state.serialize(index) for index, state in enumerate(self.titration_states)
+            state.serialize(index, include_forces=include_forces)
+            for index, state in enumerate(self.titration_states)
         ][:]
 
         return res
@@ -285,53 +480,34 @@ class _TitratableResidue:
         ----------
         pH - float, the pH for which populations should be returned
         temperature - float, the temperature in Kelvin that should be used  to find the log populations if available.
-            Optional, soft requirement. Won't throw error if not matched.
+            Optional, soft requirement. Conditions without a temperature match any temperature.
         ionic_strength - float, the ionic strength in millimolar that should be used to find the log populations if available.
-            Optional, soft requirement. Won't throw error if not matched.
+            Optional, soft requirement. Conditions without an ionic strength match any ionic strength.
         strict - bool, default True. If there are no pH dependent weights, throw an error. Else, just return default weights.
 
         Notes
         -----
         Temperature, and ionic strength are soft requirements.
+        The pKa data is compiled into a ``_PopulationTable`` on first use.
+        Log populations between two tabulated pH values are interpolated.
 
         """
-        log_weights = np.empty(len(self))
-        # look up weights in the dictionary
+        # look up weights in the compiled table
         if self._pka_data is not None:
-            # Search an appropriate log population value from the dataframe that was constructed.
-            # Temperature and Ionic strength aren't always provided.
-            for state, group in self._pka_data.groupby("State"):
-                # Get the first element where the pH matches, the temperature potentially matches, and the ionic strenght potentially matches
-                state = int(state)
-                pH_match = group["pH"] == pH
-                temperature_match = True
-                ionic_strength_match = True
-                if temperature is not None:
-                    temperature_match = group["Temperature (K)"].isin(
-                        [temperature, None]
-                    )
-
-                if ionic_strength is not None:
-                    ionic_strength_match = group["Ionic strength (mM)"].isin(
-                        ionic_strength, None
-                    )
-
-                matches = group.loc[pH_match & temperature_match & ionic_strength_match]
-
-                # If there are no matches, throw an error
-                if len(matches) == 0:
-                    raise ValueError(
-                        "There is no matching pH/temperature condition available for residue {}.".format(
-                            self.name
-                        )
+            if self._population_table is None:
+                self._population_table = _PopulationTable.for_residue(
+                    self.residue_type, self._pka_data
+                )
+            try:
+                log_weights = self._population_table.log_populations(
+                    pH, temperature=temperature, ionic_strength=ionic_strength
+                )
+            except ValueError:
+                raise ValueError(
+                    "There is no matching pH/temperature condition available for residue {}.".format(
+                        self.name
                     )
-                # get the first one
-                else:
-                    first_row = next(matches.iterrows())
-                    # index 1 is the row values, get the log population
-                    log_population = first_row[1]["log population"]
-
-                log_weights[state] = log_population
+                )
 
         # calculate residue weights from pka object
         elif self._residue_pka is not None:
@@ -490,6 +666,8 @@ class _TitrationState:
             None
         )  # Number of anions to maintain charge compared to other states
         self._forces = list()
+        # Packed force parameters and the index of this state, used if the forces have not been unpacked yet
+        self._packed_source = None
         self._target_weight = None
         # MC moves should be functions that take the positions, and return updated positions,
         # and a log (reverse/forward) proposal probability ratio
@@ -544,8 +722,8 @@ class _TitrationState:
 
         obj = cls()
 
-        # prevent accidental modification
-        state = copy.deepcopy(state_element)
+        # The element is only read, never modified.
+        state = state_element
         obj.proton_count = int(state.get("proton_count"))
         obj._cation_count = int(state.get("cation_count"))
         obj._anion_count = int(state.get("anion_count"))
@@ -661,12 +839,36 @@ class _TitrationState:
 
     @property
     def forces(self):
+        if self._forces is None:
+            # Unpack the parameters of this state from the arrays on first use
+            packed_forces, state_index = self._packed_source
+            self._forces = [
+                packed.state_force_dict(state_index) for packed in packed_forces
+            ]
+            self._packed_source = None
         return self._forces
 
     @forces.setter
     def forces(self, force_params):
         self._forces = copy.deepcopy(force_params)
 
+    def set_packed_forces(
+        self, packed_forces: List["_PackedForceParameters"], state_index: int
+    ):
+        """Use force parameters that were packed into arrays, instead of a dictionary based cache.
+
+        Parameters
+        ----------
+        packed_forces - the packed force parameters of the residue, one object per force
+        state_index - the index of this state in the residue
+
+        Notes
+        -----
+        The dictionaries of the ``forces`` property are only created when they are accessed.
+        """
+        self._forces = None
+        self._packed_source = (packed_forces, state_index)
+
     @property
     def target_weight(self):
         return self._target_weight
@@ -675,9 +877,14 @@ class _TitrationState:
     def target_weight(self, weight):
         self._target_weight = weight
 
-    def serialize(self, index=None):
+    def serialize(self, index=None, include_forces: bool = True):
         """Serialize a state into xml etree.
 
+        Parameters
+        ----------
+        index - optional, the index of the state in the residue
+        include_forces - serialize the cached force parameters
+
         Returns
         -------
         state - objectify tree
@@ -712,7 +919,7 @@ class _TitrationState:
         # Each dictionary contains the parameters for either an atom, or an exception.
         # For atom it contains 'charge', 'sigma', 'epsilon', and 'atom_index'.
         # For exception it contains  'exception_index' 'particle1' 'particle2' 'chargeProd' 'sigma', and 'epsilon'
-        for f_index, force in enumerate(self._forces):
+        for f_index, force in enumerate(self.forces if include_forces else list()):
             force_xml = E.force(
                 index=str(
                     f_index
@@ -766,56 +973,1173 @@ class _TitrationState:
         if not isinstance(other, _TitrationState):
             return False
 
-        float_atol = 1.0e-10
-        if not np.isclose(
-            self._target_weight, other._target_weight, rtol=0.0, atol=float_atol
-        ):
-            return False
+        float_atol = 1.0e-10
+        if not np.isclose(
+            self._target_weight, other._target_weight, rtol=0.0, atol=float_atol
+        ):
+            return False
+
+        if not np.isclose(
+            self.proton_count, other.proton_count, rtol=0.0, atol=float_atol
+        ):
+            return False
+
+        if not np.isclose(self.g_k, other.g_k, rtol=0.0, atol=float_atol):
+            return False
+
+        if len(self.charges) != len(other.charges):
+            return False
+
+        # Check if all stored charges are equal
+        if not np.all(
+            np.isclose(self.charges, other.charges, atol=float_atol, rtol=0.0)
+        ):
+            return False
+
+        # check if all force parameters are equal
+        for own_force, other_force in zip(self.forces, other.forces):
+            own_atoms, other_atoms = own_force["atoms"], other_force["atoms"]
+            own_exceptions, other_exceptions = (
+                own_force["exceptions"],
+                other_force["exceptions"],
+            )
+
+            for own_atom, other_atom in zip(own_atoms, other_atoms):
+                for key in own_atom.keys():
+                    if not np.isclose(
+                        own_atom[key], other_atom[key], rtol=0.0, atol=float_atol
+                    ):
+                        return False
+
+            for own_exception, other_exception in zip(own_exceptions, other_exceptions):
+                for key in own_exception.keys():
+                    if not np.isclose(
+                        own_exception[key],
+                        other_exception[key],
+                        rtol=0.0,
+                        atol=float_atol,
+                    ):
+                        return False
+
+        # Everything that was checked seems equal.
+        return True
+
+
+class _PackedForceParameters:
+    """Array representation of the cached parameters of one force, for all states of a titratable residue.
+
+    Notes
+    -----
+    Parameters are stored unitless (in the md unit system), in arrays of shape (state, atom, parameter)
+    and (state, exception, parameter) so that blending two states is a single vectorized operation.
+    """
+
+    # Names of the per particle parameters by force type, in the order they are passed to setParticleParameters
+    particle_parameter_names = {
+        "NonbondedForce": ("charge", "sigma", "epsilon"),
+        "GBSAOBCForce": ("charge", "radius", "scaleFactor"),
+    }
+    exception_parameter_names = ("chargeProd", "sigma", "epsilon")
+
+    def __init__(self, force_classname: str):
+        """Instantiate an empty _PackedForceParameters, use ``from_titration_states`` instead."""
+        if force_classname not in self.particle_parameter_names:
+            raise Exception("Don't know how to update force type '%s'" % force_classname)
+        self.force_classname = force_classname
+        self.atom_indices = np.empty(0, dtype=np.int64)
+        self.atom_parameters = np.empty((0, 0, 3), dtype=np.float64)
+        self.exception_indices = np.empty(0, dtype=np.int64)
+        self.exception_particles = np.empty((0, 2), dtype=np.int64)
+        self.exception_parameters = np.empty((0, 0, 3), dtype=np.float64)
+
+    @classmethod
+    def from_titration_states(
+        cls, titration_states: List["_TitrationState"]
+    ) -> List["_PackedForceParameters"]:
+        """Pack the force caches of a list of titration states, returning one object per force.
+
+        Parameters
+        ----------
+        titration_states - list of _TitrationState objects that have had their forces cached.
+
+        Returns
+        -------
+        list of _PackedForceParameters, in the same order as the forces of the states.
+        """
+        if len(titration_states) == 0 or len(titration_states[0].forces) == 0:
+            return list()
+
+        # The name of the force class is not cached, but can be recognized from the parameter names.
+        packed = list()
+        for force_index, reference in enumerate(titration_states[0].forces):
+            if "radius" in reference["atoms"][0]:
+                obj = cls("GBSAOBCForce")
+            else:
+                obj = cls("NonbondedForce")
+            parameter_names = obj.particle_parameter_names[obj.force_classname]
+
+            obj.atom_indices = np.asarray(
+                [atom["atom_index"] for atom in reference["atoms"]], dtype=np.int64
+            )
+            obj.atom_parameters = np.asarray(
+                [
+                    [
+                        [atom[name] for name in parameter_names]
+                        for atom in state.forces[force_index]["atoms"]
+                    ]
+                    for state in titration_states
+                ],
+                dtype=np.float64,
+            )
+
+            exceptions = reference.get("exceptions", list())
+            if len(exceptions):
+                obj.exception_indices = np.asarray(
+                    [exc["exception_index"] for exc in exceptions], dtype=np.int64
+                )
+                obj.exception_particles = np.asarray(
+                    [[exc["particle1"], exc["particle2"]] for exc in exceptions],
+                    dtype=np.int64,
+                )
+                obj.exception_parameters = np.asarray(
+                    [
+                        [
+                            [exc[name] for name in cls.exception_parameter_names]
+                            for exc in state.forces[force_index]["exceptions"]
+                        ]
+                        for state in titration_states
+                    ],
+                    dtype=np.float64,
+                )
+            else:
+                obj.exception_parameters = np.empty(
+                    (len(titration_states), 0, 3), dtype=np.float64
+                )
+            packed.append(obj)
+
+        return packed
+
+    @classmethod
+    def to_arrays(
+        cls, packed_groups: List[List["_PackedForceParameters"]]
+    ) -> Dict[str, np.ndarray]:
+        """Concatenate the packed parameters of multiple residues into a few flat arrays.
+
+        Parameters
+        ----------
+        packed_groups - the packed forces of every residue, all residues need to have the same number of forces.
+
+        Returns
+        -------
+        dict of arrays, which can be stored using ``numpy.savez``, and unpacked using ``from_arrays``.
+        """
+        nforces = {len(packed) for packed in packed_groups}
+        if len(nforces) > 1:
+            raise ValueError("All residues need to have the same number of forces.")
+        nforces = nforces.pop() if nforces else 0
+
+        arrays = dict(
+            ngroups=np.asarray(len(packed_groups)), nforces=np.asarray(nforces)
+        )
+        for force_index in range(nforces):
+            forces = [packed[force_index] for packed in packed_groups]
+            prefix = "force{}_".format(force_index)
+            arrays[prefix + "classname"] = np.asarray(
+                [force.force_classname for force in forces], dtype=str
+            )
+            arrays[prefix + "nstates"] = np.asarray(
+                [force.atom_parameters.shape[0] for force in forces], dtype=np.int64
+            )
+            arrays[prefix + "natoms"] = np.asarray(
+                [force.atom_indices.size for force in forces], dtype=np.int64
+            )
+            arrays[prefix + "nexceptions"] = np.asarray(
+                [force.exception_indices.size for force in forces], dtype=np.int64
+            )
+            # Rows of all residues, states and atoms/exceptions are stacked
+            arrays[prefix + "atom_indices"] = np.concatenate(
+                [force.atom_indices for force in forces]
+            )
+            arrays[prefix + "atom_parameters"] = np.concatenate(
+                [force.atom_parameters.reshape(-1, 3) for force in forces]
+            )
+            arrays[prefix + "exception_indices"] = np.concatenate(
+                [force.exception_indices for force in forces]
+            )
+            arrays[prefix + "exception_particles"] = np.concatenate(
+                [force.exception_particles.reshape(-1, 2) for force in forces]
+            )
+            arrays[prefix + "exception_parameters"] = np.concatenate(
+                [force.exception_parameters.reshape(-1, 3) for force in forces]
+            )
+        return arrays
+
+    @classmethod
+    def from_arrays(
+        cls, arrays: Dict[str, np.ndarray]
+    ) -> List[List["_PackedForceParameters"]]:
+        """Split the arrays created by ``to_arrays`` into the packed parameters of every residue.
+
+        Parameters
+        ----------
+        arrays - dict (or NpzFile) of arrays created by ``to_arrays``
+
+        Returns
+        -------
+        list with the packed forces of every residue
+        """
+        ngroups = int(arrays["ngroups"])
+        packed_groups = [list() for _ in range(ngroups)]
+        for force_index in range(int(arrays["nforces"])):
+            prefix = "force{}_".format(force_index)
+            classnames = arrays[prefix + "classname"].tolist()
+            nstates = arrays[prefix + "nstates"]
+            natoms = arrays[prefix + "natoms"]
+            nexceptions = arrays[prefix + "nexceptions"]
+
+            def split(name, counts):
+                """Split the stacked rows of an array by residue."""
+                return np.split(arrays[prefix + name], np.cumsum(counts)[:-1])
+
+            atom_indices = split("atom_indices", natoms)
+            atom_parameters = split("atom_parameters", nstates * natoms)
+            exception_indices = split("exception_indices", nexceptions)
+            exception_particles = split("exception_particles", nexceptions)
+            exception_parameters = split("exception_parameters", nstates * nexceptions)
+
+            for group_index in range(ngroups):
+                obj = cls(classnames[group_index])
+                states = int(nstates[group_index])
+                obj.atom_indices = atom_indices[group_index]
+                obj.atom_parameters = atom_parameters[group_index].reshape(
+                    states, int(natoms[group_index]), 3
+                )
+                obj.exception_indices = exception_indices[group_index]
+                obj.exception_particles = exception_particles[group_index]
+                obj.exception_parameters = exception_parameters[group_index].reshape(
+                    states, int(nexceptions[group_index]), 3
+                )
+                packed_groups[group_index].append(obj)
+
+        return packed_groups
+
+    def state_force_dict(self, state_index: int) -> Dict[str, List[Dict[str, Any]]]:
+        """Return the parameters of one state in the dictionary format of ``_TitrationState.forces``."""
+        parameter_names = self.particle_parameter_names[self.force_classname]
+        atoms = [
+            dict(atom_index=atom_index, **dict(zip(parameter_names, params)))
+            for atom_index, params in zip(
+                self.atom_indices.tolist(), self.atom_parameters[state_index].tolist()
+            )
+        ]
+        exceptions = [
+            dict(
+                exception_index=exception_index,
+                particle1=particle1,
+                particle2=particle2,
+                **dict(zip(self.exception_parameter_names, params))
+            )
+            for exception_index, (particle1, particle2), params in zip(
+                self.exception_indices.tolist(),
+                self.exception_particles.tolist(),
+                self.exception_parameters[state_index].tolist(),
+            )
+        ]
+        return dict(atoms=atoms, exceptions=exceptions)
+
+    def blend_atoms(
+        self, initial_state: int, final_state: int, fraction: float = 1.0
+    ) -> np.ndarray:
+        """Return the (atom, parameter) array linearly interpolated between two states."""
+        return (1.0 - fraction) * self.atom_parameters[
+            initial_state
+        ] + fraction * self.atom_parameters[final_state]
+
+    def blend_exceptions(
+        self, initial_state: int, final_state: int, fraction: float = 1.0
+    ) -> np.ndarray:
+        """Return the (exception, parameter) array linearly interpolated between two states."""
+        return (1.0 - fraction) * self.exception_parameters[
+            initial_state
+        ] + fraction * self.exception_parameters[final_state]
+
+    def apply(
+        self,
+        force: mm.Force,
+        initial_state: int,
+        final_state: int,
+        fraction: float = 1.0,
+    ):
+        """Set the blended parameters of two states on the force.
+
+        Parameters
+        ----------
+        force - the OpenMM force object that these parameters were cached from.
+        initial_state - index of the initial titration state
+        final_state - index of the final titration state
+        fraction - float, 0.0 means fully in the initial state, 1.0 fully in the final state.
+        """
+        atom_parameters = self.blend_atoms(initial_state, final_state, fraction)
+        for atom_index, params in zip(
+            self.atom_indices.tolist(), atom_parameters.tolist()
+        ):
+            force.setParticleParameters(atom_index, *params)
+
+        if self.force_classname == "NonbondedForce" and self.exception_indices.size:
+            exception_parameters = self.blend_exceptions(
+                initial_state, final_state, fraction
+            )
+            for exception_index, (particle1, particle2), params in zip(
+                self.exception_indices.tolist(),
+                self.exception_particles.tolist(),
+                exception_parameters.tolist(),
+            ):
+                force.setExceptionParameters(
+                    exception_index, particle1, particle2, *params
+                )
+
+
+class _ParameterOffsets:
+    """NonbondedForce parameter offsets of titratable residues, tied to global parameters.
+
+    Offsets are used in two ways, which are mutually exclusive for a force:
+
+    * NCMC switching (``add_ncmc_offsets``): a single global parameter, with offsets registered once for every atom
+      and exception of the titratable residues. Before an NCMC protocol, the offsets of the changing residues are
+      set to the difference between the final and initial state parameters and pushed to the context once.
+      Every perturbation step then only changes the value of the global parameter.
+    * Titration state encoding (``add_group``): the force holds the parameters of the first state (state 0) of
+      every residue. For every other state k, a global parameter is added, with offsets equal to the parameter
+      difference between state k and state 0. Weighting the initial and final state global parameters by
+      (1 - lambda) and lambda yields exactly the linear interpolation of parameters used by the default method.
+
+    Notes
+    -----
+    Offsets that are already present in the force, e.g. in a system that was serialized after attaching a drive,
+    are reused. This requires a version of OpenMM that supports NonbondedForce parameter offsets (7.4 or later).
+    """
+
+    ncmc_parameter_name = "protons_ncmc_lambda"
+    state_parameter_name_format = "protons_group{}_state{}"
+
+    def __init__(self, force: mm.NonbondedForce, force_index: int):
+        """Index the global parameters and offsets of a NonbondedForce.
+
+        Parameters
+        ----------
+        force - the NonbondedForce that is titrated, offsets are added to it.
+        force_index - the index of the force in the force cache of the titration states
+        """
+        if not hasattr(force, "addParticleParameterOffset"):
+            raise RuntimeError(
+                "Parameter offsets require a version of OpenMM that supports NonbondedForce parameter offsets."
+            )
+        self.force = force
+        self.force_index = force_index
+        # Global parameter index in the force, by name, to keep the default values in sync.
+        self._parameter_indices: Dict[str, int] = {
+            force.getGlobalParameterName(index): index
+            for index in range(force.getNumGlobalParameters())
+        }
+        # Map from (global parameter, atom/exception index) to the index of its offset
+        self._particle_offsets: Dict[Tuple[str, int], int] = dict()
+        self._exception_offsets: Dict[Tuple[str, int], int] = dict()
+        for offset_index in range(force.getNumParticleParameterOffsets()):
+            parameter, atom_index = force.getParticleParameterOffset(offset_index)[:2]
+            self._particle_offsets[(parameter, atom_index)] = offset_index
+        for offset_index in range(force.getNumExceptionParameterOffsets()):
+            parameter, exception_index = force.getExceptionParameterOffset(
+                offset_index
+            )[:2]
+            self._exception_offsets[(parameter, exception_index)] = offset_index
+        # Residues that currently have nonzero NCMC offsets
+        self._changing_groups: List[_TitratableResidue] = list()
+        # The global parameter names of each state, by group index. None for state 0.
+        self.parameter_names: Dict[int, List[Optional[str]]] = dict()
+        # Whether the force was modified, in which case existing contexts need to be reinitialized
+        self.modified_force = False
+
+    def _add_global_parameter(self, name: str):
+        """Add a global parameter with default value zero, unless the force already has it."""
+        if name not in self._parameter_indices:
+            self._parameter_indices[name] = self.force.addGlobalParameter(name, 0.0)
+            self.modified_force = True
+
+    def _set_offsets(
+        self,
+        name: str,
+        atom_indices: np.ndarray,
+        atom_scales: np.ndarray,
+        exception_indices: np.ndarray,
+        exception_scales: np.ndarray,
+    ):
+        """Set the offset scales of atoms and exceptions for a global parameter, adding offsets that do not exist."""
+        force = self.force
+        for atom_index, scales in zip(atom_indices.tolist(), atom_scales.tolist()):
+            offset_index = self._particle_offsets.get((name, atom_index))
+            if offset_index is None:
+                self._particle_offsets[
+                    (name, atom_index)
+                ] = force.addParticleParameterOffset(name, atom_index, *scales)
+                self.modified_force = True
+            else:
+                force.setParticleParameterOffset(
+                    offset_index, name, atom_index, *scales
+                )
+        for exception_index, scales in zip(
+            exception_indices.tolist(), exception_scales.tolist()
+        ):
+            offset_index = self._exception_offsets.get((name, exception_index))
+            if offset_index is None:
+                self._exception_offsets[
+                    (name, exception_index)
+                ] = force.addExceptionParameterOffset(name, exception_index, *scales)
+                self.modified_force = True
+            else:
+                force.setExceptionParameterOffset(
+                    offset_index, name, exception_index, *scales
+                )
+
+    def add_ncmc_offsets(self, titration_groups: List[_TitratableResidue]):
+        """Register zero offsets on the NCMC global parameter for the atoms and exceptions of the titration groups.
+
+        Parameters
+        ----------
+        titration_groups - the residues that are switched during NCMC.
+        """
+        name = self.ncmc_parameter_name
+        self._add_global_parameter(name)
+        for group in titration_groups:
+            packed = group.packed_forces[self.force_index]
+            self._set_offsets(
+                name,
+                packed.atom_indices,
+                np.zeros_like(packed.atom_parameters[0]),
+                packed.exception_indices,
+                np.zeros_like(packed.exception_parameters[0]),
+            )
+
+    def set_deltas(
+        self,
+        titration_groups: List[_TitratableResidue],
+        initial_states: List[int],
+        final_states: List[int],
+    ):
+        """Set the NCMC offsets of the given residues to the difference between their final and initial parameters.
+
+        Notes
+        -----
+        Push the force to the context using ``updateParametersInContext`` after calling this.
+        """
+        for group, initial, final in zip(
+            titration_groups, initial_states, final_states
+        ):
+            packed = group.packed_forces[self.force_index]
+            self._set_offsets(
+                self.ncmc_parameter_name,
+                packed.atom_indices,
+                packed.atom_parameters[final] - packed.atom_parameters[initial],
+                packed.exception_indices,
+                packed.exception_parameters[final]
+                - packed.exception_parameters[initial],
+            )
+            self._changing_groups.append(group)
+
+    def clear(self):
+        """Reset the NCMC offsets of all residues that were changed to zero.
+
+        Notes
+        -----
+        Push the force to the context using ``updateParametersInContext`` after calling this.
+        """
+        for group in self._changing_groups:
+            packed = group.packed_forces[self.force_index]
+            self._set_offsets(
+                self.ncmc_parameter_name,
+                packed.atom_indices,
+                np.zeros_like(packed.atom_parameters[0]),
+                packed.exception_indices,
+                np.zeros_like(packed.exception_parameters[0]),
+            )
+        self._changing_groups = list()
+
+    def __contains__(self, group_index: int) -> bool:
+        return group_index in self.parameter_names
+
+    def add_group(self, group_index: int, group: _TitratableResidue):
+        """Add global parameters and offsets for all states of a residue, and set its base parameters to state 0.
+
+        Parameters
+        ----------
+        group_index - index of the residue in the drive
+        group - the residue, with force parameters cached for all states
+        """
+        packed = group.packed_forces[self.force_index]
+        # The force contains the parameters of the reference state
+        packed.apply(self.force, 0, 0)
+
+        names = [None]
+        for state_index in range(1, len(group)):
+            name = self.state_parameter_name_format.format(group_index, state_index)
+            names.append(name)
+            self._add_global_parameter(name)
+            # Only parameters that differ from the reference state need an offset
+            atom_delta = packed.atom_parameters[state_index] - packed.atom_parameters[0]
+            atoms = np.any(atom_delta != 0.0, axis=1)
+            exception_delta = (
+                packed.exception_parameters[state_index]
+                - packed.exception_parameters[0]
+            )
+            exceptions = np.any(exception_delta != 0.0, axis=1)
+            self._set_offsets(
+                name,
+                packed.atom_indices[atoms],
+                atom_delta[atoms],
+                packed.exception_indices[exceptions],
+                exception_delta[exceptions],
+            )
+        self.parameter_names[group_index] = names
+
+    def set_group_parameters(
+        self,
+        group_index: int,
+        initial_state: int,
+        final_state: int,
+        fraction: float = 1.0,
+        context: Optional[mm.Context] = None,
+    ):
+        """Set the global parameters of a residue to a (blend of) titration state(s).
+
+        Parameters
+        ----------
+        group_index - index of the residue in the drive
+        initial_state - index of the initial titration state
+        final_state - index of the final titration state
+        fraction - float, 0.0 means fully in the initial state, 1.0 fully in the final state.
+        context - if provided, the parameters are also set in this context.
+        """
+        names = self.parameter_names[group_index]
+        values = [0.0] * len(names)
+        values[initial_state] += 1.0 - fraction
+        values[final_state] += fraction
+        for name, value in zip(names[1:], values[1:]):
+            # Defaults are used by any context created later on
+            self.force.setGlobalParameterDefaultValue(
+                self._parameter_indices[name], value
+            )
+            if context is not None:
+                context.setParameter(name, value)
+
+
+class _SideContextEnergyEvaluator:
+    """Evaluates the energies of all titration states of a residue in a separate context.
+
+    Notes
+    -----
+    The side context contains a copy of the system with only the forces that change between titration states.
+    Energies are therefore only defined up to a constant, which is identical for all states of a residue.
+    States are switched using global parameter offsets if OpenMM supports them, and by updating force parameters
+    otherwise. The context of the drive is never modified.
+    """
+
+    def __init__(self, drive: "NCMCProtonDrive"):
+        """Create a side context for the drive, using the same platform and platform properties as its context.
+
+        Parameters
+        ----------
+        drive - NCMCProtonDrive with a context attached.
+        """
+        self.drive = drive
+        system = copy.deepcopy(drive.system)
+
+        # Only keep the forces that are updated by the drive, in the same order.
+        force_classes = {force.__class__.__name__ for force in drive.forces_to_update}
+        for force_index in reversed(range(system.getNumForces())):
+            if system.getForce(force_index).__class__.__name__ not in force_classes:
+                system.removeForce(force_index)
+        self.forces = [system.getForce(index) for index in range(system.getNumForces())]
+        if len(self.forces) != len(drive.forces_to_update):
+            raise ValueError("Could not match the forces of the system and the drive.")
+
+        self.offsets: _ParameterOffsets = None
+        if hasattr(mm.NonbondedForce, "addParticleParameterOffset"):
+            for force_index, force in enumerate(self.forces):
+                if force.__class__.__name__ == "NonbondedForce":
+                    self.offsets = _ParameterOffsets(force, force_index)
+                    for group_index, group in enumerate(drive.titrationGroups):
+                        self.offsets.add_group(group_index, group)
+                    break
+
+        platform = drive.context.getPlatform()
+        properties = {
+            name: platform.getPropertyValue(drive.context, name)
+            for name in platform.getPropertyNames()
+        }
+        self.context = mm.Context(
+            system, mm.VerletIntegrator(1.0 * unit.femtoseconds), platform, properties
+        )
+        # Titration states that the side context is currently in, None if unknown.
+        self._states: List[Optional[int]] = [None] * len(drive.titrationGroups)
+        # Whether force parameters were changed without pushing them to the side context
+        self._needs_push = False
+
+    def reduced_potentials(self, group_index: int) -> np.ndarray:
+        """Return the reduced potentials of all states of a residue, at the current positions of the drive.
+
+        Parameters
+        ----------
+        group_index - index of the residue
+
+        Returns
+        -------
+        np.ndarray - reduced potential of every state of the residue, up to a constant.
+        """
+        drive = self.drive
+        snapshot = drive.context.getState(getPositions=True)
+        self.context.setPeriodicBoxVectors(*snapshot.getPeriodicBoxVectors())
+        self.context.setPositions(snapshot.getPositions(asNumpy=True))
+
+        # Bring all other residues into their current state
+        for index, group in enumerate(drive.titrationGroups):
+            self._set_state(index, group.state_index)
+        self._push()
+
+        group = drive.titrationGroups[group_index]
+        reduced_potentials = np.empty(len(group))
+        for state_index in range(len(group)):
+            self._set_state(group_index, state_index)
+            self._push()
+            energy = self.context.getState(getEnergy=True).getPotentialEnergy()
+            reduced_potentials[state_index] = (
+                strip_in_unit_system(energy) * drive.beta_unitless
+            )
+
+        return reduced_potentials
+
+    def _set_state(self, group_index: int, state_index: int):
+        """Set the parameters of a residue in the side context, if it is not already in that state."""
+        if self._states[group_index] == state_index:
+            return
+        packed_forces = self.drive.titrationGroups[group_index].packed_forces
+        for force_index, force in enumerate(self.forces):
+            if self.offsets is not None and force is self.offsets.force:
+                self.offsets.set_group_parameters(
+                    group_index, state_index, state_index, context=self.context
+                )
+            else:
+                packed_forces[force_index].apply(force, state_index, state_index)
+                self._needs_push = True
+        self._states[group_index] = state_index
+
+    def _push(self):
+        """Push updated force parameters to the side context."""
+        if not self._needs_push:
+            return
+        for force in self.forces:
+            if self.offsets is None or force is not self.offsets.force:
+                force.updateParametersInContext(self.context)
+        self._needs_push = False
+
+
+class _TitrationStateTables:
+    """Current titration state of every residue as an array, with lookup tables of state properties.
+
+    Notes
+    -----
+    Tables have shape (residue, state), and are padded with zeros for residues with fewer states.
+    Residues without a state yet are recorded as state -1, and do not contribute to totals.
+    Totals over all residues are updated incrementally when the state of a residue changes.
+    """
+
+    def __init__(self, titration_groups: List[_TitratableResidue]):
+        """Build the tables from the current states and state properties of a list of residues."""
+        ngroups = len(titration_groups)
+        max_states = max([len(group) for group in titration_groups], default=0)
+        self.nstates = np.asarray(
+            [len(group) for group in titration_groups], dtype=np.int64
+        )
+        self.g_k = np.zeros((ngroups, max_states), dtype=np.float64)
+        self.charges = np.zeros((ngroups, max_states), dtype=np.int64)
+        self.proton_counts = np.zeros((ngroups, max_states), dtype=np.int64)
+        self.anion_counts = np.zeros((ngroups, max_states), dtype=np.int64)
+        self.cation_counts = np.zeros((ngroups, max_states), dtype=np.int64)
+        self.states = np.full(ngroups, -1, dtype=np.int64)
+        self.total_g_k = 0.0
+        self.total_charge = 0
+
+        for group_index, group in enumerate(titration_groups):
+            for state_index, state in enumerate(group):
+                self.charges[group_index, state_index] = state.total_charge
+                self.proton_counts[group_index, state_index] = state.proton_count
+                # Counts can be None for drives without ion information
+                self.anion_counts[group_index, state_index] = state.anion_count or 0
+                self.cation_counts[group_index, state_index] = state.cation_count or 0
+            self.update_g_k(group_index, group)
+            if group.state_index is not None:
+                self.states[group_index] = group.state_index
+        self._update_totals()
+
+    def __len__(self) -> int:
+        return self.states.size
+
+    def _update_totals(self):
+        """Recalculate the totals over all residues from scratch."""
+        assigned = np.flatnonzero(self.states >= 0)
+        self.total_g_k = float(self.g_k[assigned, self.states[assigned]].sum())
+        self.total_charge = int(self.charges[assigned, self.states[assigned]].sum())
+
+    def update_g_k(self, group_index: int, group: _TitratableResidue):
+        """Refresh the g_k values of a single residue from its states."""
+        state = self.states[group_index]
+        if state >= 0:
+            self.total_g_k -= self.g_k[group_index, state]
+        self.g_k[group_index, : len(group)] = [
+            np.nan if g_k is None else g_k for g_k in group.g_k_values
+        ]
+        if state >= 0:
+            self.total_g_k += self.g_k[group_index, state]
+
+    def set_state(self, group_index: int, state_index: int):
+        """Record a new state for a residue, updating the totals."""
+        old_state = self.states[group_index]
+        if old_state >= 0:
+            self.total_g_k -= self.g_k[group_index, old_state]
+            self.total_charge -= self.charges[group_index, old_state]
+        self.total_g_k += self.g_k[group_index, state_index]
+        self.total_charge += self.charges[group_index, state_index]
+        self.states[group_index] = state_index
+
+    def totals(
+        self,
+        table: np.ndarray,
+        initial_states: List[int],
+        final_states: List[int],
+        group_indices: Optional[List[int]] = None,
+    ):
+        """Return the totals of a table property over residues, before and after a change of states.
+
+        Parameters
+        ----------
+        table - one of the (residue, state) tables, e.g. ``charges``
+        initial_states - state of every residue before the change
+        final_states - state of every residue after the change
+        group_indices - optional, only consider these residues. By default, residues that changed state.
+
+        Returns
+        -------
+        tuple of the initial total and final total over the residues.
+        """
+        initial_states = np.asarray(initial_states, dtype=np.int64)
+        final_states = np.asarray(final_states, dtype=np.int64)
+        if group_indices is None:
+            group_indices = np.flatnonzero(initial_states != final_states)
+        else:
+            group_indices = np.asarray(group_indices, dtype=np.int64)
+        initial = table[group_indices, initial_states[group_indices]].sum().item()
+        final = table[group_indices, final_states[group_indices]].sum().item()
+        return initial, final
+
+
+class _NCMCWorker:
+    """A copy of the system of a drive in its own context, used to run independent NCMC protocols.
+
+    Notes
+    -----
+    The worker keeps its own copy of the system, with its own force objects, and a copy of the NCMC integrator
+    with a separate random number seed. Protocols start from the positions, velocities and box vectors
+    that are passed in, so the context of the drive is never modified.
+    """
+
+    def __init__(
+        self,
+        drive: "NCMCProtonDrive",
+        platform: mm.Platform,
+        properties: Dict[str, str],
+        seed: int,
+    ):
+        """Create a worker context for a drive.
+
+        Parameters
+        ----------
+        drive - the NCMCProtonDrive, with a context attached.
+        platform - the platform to create the worker context on.
+        properties - platform properties for the worker context.
+        seed - random number seed for the NCMC integrator of this worker.
+        """
+        self.drive = drive
+        system = copy.deepcopy(drive.system)
+
+        # Turn the center of mass remover off, otherwise it contributes to the work
+        force_classes = {force.__class__.__name__ for force in drive.forces_to_update}
+        self.forces = list()
+        for force_index in range(system.getNumForces()):
+            force = system.getForce(force_index)
+            if force.__class__.__name__ == "CMMotionRemover":
+                force.setFrequency(0)
+            elif force.__class__.__name__ in force_classes:
+                self.forces.append(force)
+
+        # Pack the parameters up front, so threads only read them.
+        for group in drive.titrationGroups:
+            group.packed_forces
+
+        self.offsets: _ParameterOffsets = None
+        if drive._global_parameter_offsets is not None:
+            force_index = drive._global_parameter_offsets.force_index
+            self.offsets = _ParameterOffsets(self.forces[force_index], force_index)
+            for group_index, group in enumerate(drive.titrationGroups):
+                self.offsets.add_group(group_index, group)
+
+        self.is_ghmc = isinstance(drive.ncmc_integrator, GHMCIntegrator)
+        self.integrator = copy.deepcopy(drive.ncmc_integrator)
+        self.integrator.setRandomNumberSeed(seed)
+        self.context = mm.Context(system, self.integrator, platform, properties)
+        # Titration states of the residues in the worker context, None if unknown.
+        self._states: List[Optional[int]] = [None] * len(drive.titrationGroups)
+
+    def _set_parameters(
+        self,
+        group_index: int,
+        initial_state: int,
+        final_state: int,
+        fraction: float = 1.0,
+    ):
+        """Set (blended) parameters for a residue in the worker forces. Push them using ``_push``."""
+        packed_forces = self.drive.titrationGroups[group_index].packed_forces
+        for force_index, force in enumerate(self.forces):
+            if self.offsets is not None and force is self.offsets.force:
+                self.offsets.set_group_parameters(
+                    group_index,
+                    initial_state,
+                    final_state,
+                    fraction=fraction,
+                    context=self.context,
+                )
+            else:
+                packed_forces[force_index].apply(
+                    force, initial_state, final_state, fraction=fraction
+                )
+
+    def _push(self):
+        """Push the worker force parameters to the worker context."""
+        for force in self.forces:
+            if self.offsets is None or force is not self.offsets.force:
+                force.updateParametersInContext(self.context)
+
+    def synchronize(self, states: List[int]):
+        """Bring all residues of the worker into the given titration states."""
+        changed = False
+        for group_index, state_index in enumerate(states):
+            if self._states[group_index] != state_index:
+                self._set_parameters(group_index, state_index, state_index)
+                self._states[group_index] = state_index
+                changed = True
+        if changed:
+            self._push()
+
+    def _log_probability(self, state: mm.State) -> float:
+        """Log probability of a configuration, excluding the g_k of the titration states."""
+        drive = self.drive
+        log_p = -drive.beta * (state.getPotentialEnergy() + state.getKineticEnergy())
+        if drive.pressure is not None:
+            volume = state.getPeriodicBoxVolume()
+            log_p -= drive.beta * drive.pressure * volume * unit.AVOGADRO_CONSTANT_NA
+        return log_p
+
+    def run(
+        self,
+        initial_states: List[int],
+        final_states: List[int],
+        changing_groups: List[int],
+        positions: np.ndarray,
+        velocities: np.ndarray,
+        box_vectors: np.ndarray,
+    ) -> Dict[str, Any]:
+        """Run an NCMC protocol from the given configuration, between two sets of titration states.
+
+        Parameters
+        ----------
+        initial_states - titration state of every residue at the start of the protocol
+        final_states - titration state of every residue at the end of the protocol
+        changing_groups - the residues that change state
+        positions, velocities, box_vectors - the starting configuration, in the md unit system.
+
+        Returns
+        -------
+        dict with the protocol work (in kT, excluding g_k), the change in log probability of the configuration
+        (excluding g_k), the final positions, velocities and box vectors, and the statistics per perturbation step.
+        """
+        drive = self.drive
+        self.synchronize(initial_states)
+        self.context.setPeriodicBoxVectors(*box_vectors)
+        self.context.setPositions(positions)
+        self.context.setVelocities(velocities)
+        log_p_initial = self._log_probability(self.context.getState(getEnergy=True))
+
+        integrator = self.integrator
+        if self.is_ghmc:
+            integrator.setGlobalVariableByName("ntrials", 0)
+            integrator.setGlobalVariableByName("naccept", 0)
+        integrator.setGlobalVariableByName("first_step", 0)
+        integrator.setGlobalVariableByName("protocol_work", 0)
+
+        stats = [(0.0, 0.0, 0.0)] * drive.perturbations_per_trial
+        propagations_per_step = drive._propagations_for(changing_groups)
+        if np.any(np.asarray(initial_states) != np.asarray(final_states)):
+            integrator.step(propagations_per_step)
+            for step in range(drive.perturbations_per_trial):
+                titration_lambda = float(step + 1) / float(
+                    drive.perturbations_per_trial
+                )
+                for group_index in changing_groups:
+                    self._set_parameters(
+                        group_index,
+                        initial_states[group_index],
+                        final_states[group_index],
+                        fraction=titration_lambda,
+                    )
+                self._push()
+                integrator.step(propagations_per_step)
+                work = (
+                    integrator.getGlobalVariableByName("protocol_work")
+                    * drive.beta_unitless
+                )
+                if self.is_ghmc:
+                    stats[step] = (
+                        work,
+                        integrator.getGlobalVariableByName("naccept"),
+                        integrator.getGlobalVariableByName("ntrials"),
+                    )
+                else:
+                    stats[step] = (work, 0, 0)
+
+            for group_index in changing_groups:
+                self._states[group_index] = final_states[group_index]
+
+        state = self.context.getState(
+            getPositions=True, getVelocities=True, getEnergy=True
+        )
+        return dict(
+            work=integrator.getGlobalVariableByName("protocol_work")
+            * drive.beta_unitless,
+            delta_log_p=self._log_probability(state) - log_p_initial,
+            positions=state.getPositions(asNumpy=True),
+            velocities=state.getVelocities(asNumpy=True),
+            box_vectors=state.getPeriodicBoxVectors(asNumpy=True),
+            stats=stats,
+        )
+
+
+class _ProtocolLengthController:
+    """Tunes the length of NCMC protocols per residue toward a target acceptance rate.
+
+    Notes
+    -----
+    The number of perturbation steps stays fixed, and the number of propagation steps in between
+    perturbations is tuned for each residue. Protocols that change several residues use the longest of them.
+
+    Tuning assumes the work distribution of a transition is Gaussian, with a mean of half its variance,
+    for which the mean acceptance rate is erfc(sigma / (2 sqrt(2))), and that the variance scales inversely
+    with the protocol length.
 
-        if not np.isclose(
-            self.proton_count, other.proton_count, rtol=0.0, atol=float_atol
-        ):
-            return False
+    The schedule is changed only during warm-up. Once frozen, the protocol length depends only on the residues
+    that change, which preserves detailed balance. Samples collected during warm-up should be discarded.
+    """
 
-        if not np.isclose(self.g_k, other.g_k, rtol=0.0, atol=float_atol):
-            return False
+    def __init__(
+        self,
+        ngroups: int,
+        propagations_per_step: int,
+        target_acceptance: float = 0.5,
+        warmup_attempts: int = 500,
+        tune_interval: int = 20,
+        max_propagations_per_step: Optional[int] = None,
+    ):
+        """Set up the controller.
 
-        if len(self.charges) != len(other.charges):
-            return False
+        Parameters
+        ----------
+        ngroups - number of titratable residues in the drive
+        propagations_per_step - initial number of propagation steps in between perturbations, for all residues
+        target_acceptance - the acceptance rate to tune toward, between 0 and 1
+        warmup_attempts - number of attempts after which the schedule is frozen
+        tune_interval - number of attempts of a residue in between updates of its protocol length
+        max_propagations_per_step - optional, upper bound on the number of propagation steps
+        """
+        if not 0.0 < target_acceptance < 1.0:
+            raise ValueError("The target acceptance rate needs to be between 0 and 1.")
+        if tune_interval < 2:
+            raise ValueError("The tune interval needs to be at least 2 attempts.")
+        self.target_acceptance = target_acceptance
+        # The standard deviation of the work that results in the target acceptance rate
+        self.target_variance = (2.0 * np.sqrt(2.0) * erfcinv(target_acceptance)) ** 2
+        self.warmup_attempts = warmup_attempts
+        self.tune_interval = tune_interval
+        self.max_propagations_per_step = max_propagations_per_step
+        self.propagations_per_step = np.full(
+            ngroups, propagations_per_step, dtype=np.int64
+        )
+        self.nattempts: int = 0
+        self.frozen: bool = False
+        # Attempts since the last update, per residue
+        self._group_attempts = np.zeros(ngroups, dtype=np.int64)
+        self._group_acceptance = np.zeros(ngroups, dtype=np.float64)
+        # Works per transition (group, initial state, final state) since the last update
+        self._transition_works: Dict[Tuple[int, int, int], List[float]] = defaultdict(
+            list
+        )
 
-        # Check if all stored charges are equal
-        if not np.all(
-            np.isclose(self.charges, other.charges, atol=float_atol, rtol=0.0)
-        ):
-            return False
+    def propagations_for(self, group_indices: List[int]) -> int:
+        """Return the number of propagation steps in between perturbations for a change of these residues."""
+        if len(group_indices) == 0:
+            return int(self.propagations_per_step.max())
+        return int(self.propagations_per_step[np.asarray(group_indices)].max())
 
-        # check if all force parameters are equal
-        for own_force, other_force in zip(self._forces, other._forces):
-            own_atoms, other_atoms = own_force["atoms"], other_force["atoms"]
-            own_exceptions, other_exceptions = (
-                own_force["exceptions"],
-                other_force["exceptions"],
+    def record(
+        self,
+        group_indices: List[int],
+        initial_states: List[int],
+        final_states: List[int],
+        work: float,
+        logp_accept: float,
+    ):
+        """Record the outcome of an NCMC attempt, and update protocol lengths during warm-up.
+
+        Parameters
+        ----------
+        group_indices - the residues that changed state
+        initial_states - state of every residue at the start of the attempt
+        final_states - state of every residue at the end of the attempt
+        work - the work of the attempt, in kT
+        logp_accept - the log acceptance probability of the attempt
+        """
+        if self.frozen or len(group_indices) == 0:
+            return
+        acceptance = min(1.0, math.exp(min(0.0, logp_accept)))
+        for group_index in group_indices:
+            self._transition_works[
+                (group_index, initial_states[group_index], final_states[group_index])
+            ].append(work)
+            self._group_attempts[group_index] += 1
+            self._group_acceptance[group_index] += acceptance
+            if self._group_attempts[group_index] >= self.tune_interval:
+                self._tune(group_index)
+
+        self.nattempts += 1
+        if self.nattempts >= self.warmup_attempts:
+            self.frozen = True
+            self._transition_works.clear()
+            log.info(
+                "Froze NCMC protocol lengths after %d attempts: %s",
+                self.nattempts,
+                str(self.propagations_per_step.tolist()),
             )
 
-            for own_atom, other_atom in zip(own_atoms, other_atoms):
-                for key in own_atom.keys():
-                    if not np.isclose(
-                        own_atom[key], other_atom[key], rtol=0.0, atol=float_atol
-                    ):
-                        return False
+    def _tune(self, group_index: int):
+        """Update the protocol length of a residue from the statistics since the last update."""
+        acceptance = self._group_acceptance[group_index] / self._group_attempts[
+            group_index
+        ]
+        variances = [
+            np.var(works, ddof=1)
+            for (index, initial, final), works in self._transition_works.items()
+            if index == group_index and len(works) > 1
+        ]
+        current = self.propagations_per_step[group_index]
+        if variances:
+            scale = np.mean(variances) / self.target_variance
+        elif acceptance < self.target_acceptance:
+            scale = 2.0
+        else:
+            scale = 0.5
+        # Limit the change per update, the variance estimates are noisy.
+        proposed = int(round(current * min(2.0, max(0.5, scale))))
+        proposed = max(1, proposed)
+        if self.max_propagations_per_step is not None:
+            proposed = min(proposed, self.max_propagations_per_step)
+        log.debug(
+            "Residue %d acceptance %.3f, propagations per step %d -> %d",
+            group_index,
+            acceptance,
+            current,
+            proposed,
+        )
+        self.propagations_per_step[group_index] = proposed
+
+        # Statistics belong to the previous protocol length.
+        self._group_attempts[group_index] = 0
+        self._group_acceptance[group_index] = 0.0
+        for key in [key for key in self._transition_works if key[0] == group_index]:
+            del self._transition_works[key]
+
+    def to_xml(self) -> etree.Element:
+        """Serialize the schedule, and the warm-up statistics, to xml."""
+        root = etree.Element("ProtocolLengthController")
+        root.set("target_acceptance", repr(self.target_acceptance))
+        root.set("warmup_attempts", str(self.warmup_attempts))
+        root.set("tune_interval", str(self.tune_interval))
+        if self.max_propagations_per_step is not None:
+            root.set("max_propagations_per_step", str(self.max_propagations_per_step))
+        root.set("nattempts", str(self.nattempts))
+        root.set("frozen", str(int(self.frozen)))
+
+        for group_index, propagations in enumerate(self.propagations_per_step):
+            residue = etree.SubElement(root, "Residue")
+            residue.set("idx", str(group_index))
+            residue.set("propagations_per_step", str(propagations))
+            residue.set("attempts", str(self._group_attempts[group_index]))
+            residue.set("acceptance", repr(self._group_acceptance[group_index]))
+
+        for (group_index, initial, final), works in self._transition_works.items():
+            transition = etree.SubElement(root, "Transition")
+            transition.set("idx", str(group_index))
+            transition.set("initial", str(initial))
+            transition.set("final", str(final))
+            transition.text = " ".join(repr(work) for work in works)
+        return root
 
-            for own_exception, other_exception in zip(own_exceptions, other_exceptions):
-                for key in own_exception.keys():
-                    if not np.isclose(
-                        own_exception[key],
-                        other_exception[key],
-                        rtol=0.0,
-                        atol=float_atol,
-                    ):
-                        return False
+    @classmethod
+    def from_xml(cls, root: etree.Element) -> "_ProtocolLengthController":
+        """Instantiate this object from xml."""
+        if not root.tag == "ProtocolLengthController":
+            raise ValueError(
+                "Wrong XML element provided. Expected 'ProtocolLengthController', got '{}'".format(
+                    root.tag
+                )
+            )
+        residues = root.xpath("./Residue")
+        max_propagations = root.get("max_propagations_per_step")
+        if max_propagations is not None:
+            max_propagations = int(max_propagations)
+        instance = cls(
+            len(residues),
+            1,
+            target_acceptance=float(root.get("target_acceptance")),
+            warmup_attempts=int(root.get("warmup_attempts")),
+            tune_interval=int(root.get("tune_interval")),
+            max_propagations_per_step=max_propagations,
+        )
+        instance.nattempts = int(root.get("nattempts"))
+        instance.frozen = bool(int(root.get("frozen")))
 
-        # Everything that was checked seems equal.
-        return True
+        for residue in residues:
+            group_index = int(residue.get("idx"))
+            instance.propagations_per_step[group_index] = int(
+                residue.get("propagations_per_step")
+            )
+            instance._group_attempts[group_index] = int(residue.get("attempts"))
+            instance._group_acceptance[group_index] = float(residue.get("acceptance"))
+
+        for transition in root.xpath("./Transition"):
+            key = (
+                int(transition.get("idx")),
+                int(transition.get("initial")),
+                int(transition.get("final")),
+            )
+            instance._transition_works[key] = [
+                float(work) for work in (transition.text or "").split()
+            ]
+        return instance
 
 
 class SAMSApproach(Enum):
@@ -853,8 +2177,159 @@ class UpdateRule(Enum):
     GLOBAL = 1
 
 
+class _SparseJointTable:
+    """Values for the joint titration states of multiple residues, only stored for states that were modified.
+
+    The value of a state that was not modified is the sum of a per residue value for the state of each residue.
+    Joint states are numbered like the elements of a C-ordered array with one dimension per residue.
+    """
+
+    def __init__(
+        self,
+        state_counts: List[int],
+        residue_values: Optional[List[np.ndarray]] = None,
+    ):
+        """Set up an empty table.
+
+        Parameters
+        ----------
+        state_counts - list of the number of states that each titratable residue has.
+        residue_values - optional, per residue arrays with a value for each state. Defaults to zeros.
+        """
+        self.shape: Tuple[int, ...] = tuple(int(count) for count in state_counts)
+        # Python integers do not overflow for large numbers of residues
+        self.size: int = 1
+        for count in self.shape:
+            self.size *= count
+        self._residue_values: List[np.ndarray] = list()
+        self._values: Dict[int, float] = dict()
+        # Subtracted from every value, so all values can be shifted at once
+        self._offset: float = 0.0
+        self.set_residue_values(residue_values)
+
+    def set_residue_values(self, residue_values: Optional[List[np.ndarray]]):
+        """Set the per residue values, and discard all stored values."""
+        if residue_values is None:
+            residue_values = [np.zeros(count, dtype=np.float64) for count in self.shape]
+        if [len(values) for values in residue_values] != list(self.shape):
+            raise ValueError("The residue values do not match the number of states.")
+        self._residue_values = [
+            np.asarray(values, dtype=np.float64) for values in residue_values
+        ]
+        self._values = dict()
+        self._offset = 0.0
+
+    @property
+    def residue_values(self) -> List[np.ndarray]:
+        """The per residue values, which give the value of joint states that were not modified."""
+        return self._residue_values
+
+    @property
+    def offset(self) -> float:
+        """The value that has been subtracted from all joint states."""
+        return self._offset
+
+    def index(self, titration_states: List[int]) -> int:
+        """Return the index of a joint state."""
+        if len(titration_states) != len(self.shape):
+            raise ValueError(
+                "The number of titration states provided does not match the dimensionality of the table."
+            )
+        index = 0
+        for state, count in zip(titration_states, self.shape):
+            if not 0 <= state < count:
+                raise IndexError("Titration state {} is out of range.".format(state))
+            index = index * count + int(state)
+        return index
+
+    def titration_states(self, index: int) -> List[int]:
+        """Return the titration state of each residue for a joint state index."""
+        states = list()
+        for count in reversed(self.shape):
+            index, state = divmod(index, count)
+            states.append(state)
+        return states[::-1]
+
+    def _raw_value(self, index: int) -> float:
+        """The value of a joint state, before subtracting the offset."""
+        if index in self._values:
+            return self._values[index]
+        return float(
+            sum(
+                values[state]
+                for values, state in zip(
+                    self._residue_values, self.titration_states(index)
+                )
+            )
+        )
+
+    def __getitem__(self, index: int) -> float:
+        return self._raw_value(index) - self._offset
+
+    def __setitem__(self, index: int, value: float):
+        self._values[index] = value + self._offset
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, index: int, value: float):
+        """Add to the value of a single joint state."""
+        self._values[index] = self._raw_value(index) + value
+
+    def subtract_from_all(self, value: float):
+        """Subtract a value from the values of all joint states."""
+        self._offset += value
+
+    def changes_since(self, other: "_SparseJointTable") -> Tuple[float, Dict[int, float]]:
+        """Return the changes since a copy of this table was made.
+
+        Returns
+        -------
+        float - the change of all values
+        dict - the additional change of individual values, by index
+        """
+        shift = other._offset - self._offset
+        changes = dict()
+        for index in set(self._values) | set(other._values):
+            change = self[index] - other[index] - shift
+            if change != 0.0:
+                changes[index] = change
+        return shift, changes
+
+    def stored(self) -> Dict[int, float]:
+        """The values of all joint states that were modified, by index."""
+        return {index: value - self._offset for index, value in self._values.items()}
+
+    def to_dense(self) -> np.ndarray:
+        """Return the values of all joint states as a flat array."""
+        dense = np.zeros(self.shape, dtype=np.float64)
+        for residue, values in enumerate(self._residue_values):
+            shape = [1] * len(self.shape)
+            shape[residue] = -1
+            dense += values.reshape(shape)
+        dense = dense.reshape(-1)
+        if self._values:
+            indices = np.fromiter(self._values.keys(), dtype=np.int64)
+            dense[indices] = np.fromiter(self._values.values(), dtype=np.float64)
+        return dense - self._offset
+
+    def from_dense(self, values: np.ndarray):
+        """Set the values of all joint states from a flat array."""
+        if values.size != self.size:
+            raise ValueError("The number of values does not match the size of the table.")
+        self.set_residue_values(None)
+        nonzero = np.flatnonzero(values)
+        self._values = dict(zip(nonzero.tolist(), values[nonzero].tolist()))
+
+
 class _SAMSState:
-    """A table to contain SAMS free energies (zeta or g_k) and targets (pi) for constant-pH residues."""
+    """A table to contain SAMS free energies (zeta or g_k) and targets (pi) for constant-pH residues.
+
+    Notes
+    -----
+    For SAMSApproach.MULTISITE, free energies and observed counts are stored in a ``_SparseJointTable``,
+    so that only the joint states that were visited take up memory. Targets are uniform unless they are set.
+    """
 
     def __init__(
         self,
@@ -884,13 +2359,16 @@ class _SAMSState:
         """
 
         # Contains SAMS free energy estimates
-        self._free_energy_table: np.ndarray = None
-        # Target weights
-        self._target_table: np.ndarray = None
+        self._free_energy_table = None
+        # Target weights, for multisite None means that all joint states have equal targets.
+        self._target_table: Optional[np.ndarray] = None
         # Observed histogram counts
-        self._observed_table: np.ndarray = None
+        self._observed_table = None
+        # Multisite only, sum and maximum of the observed counts
+        self._observed_total: float = 0.0
+        self._observed_max: float = 0.0
 
-        # Indices in flattened array
+        # Indices in flattened array (one site only, multisite computes them from the states)
         self._index_table: np.ndarray = None
 
         # state of the free energy calculation
@@ -943,15 +2421,11 @@ class _SAMSState:
 
         elif approach is SAMSApproach.MULTISITE:
             # Every value in the table is one joint titration state
+            # Only visited joint states are stored, the number of joint states grows exponentially.
 
             # Default value set to 0, but can be tweaked later with initial guesses.
-            self._free_energy_table = np.zeros(state_counts, dtype=np.float64)
-            # These should be equal for multisite sams
-            total_count = int(np.prod(state_counts))
-            self._target_table = np.ones(state_counts, dtype=np.float64) / (total_count)
-            self._observed_table = np.zeros(state_counts, dtype=np.float64)
-            # For looking up index in the flattened array.
-            self._index_table = np.arange(total_count).reshape(state_counts)
+            self._free_energy_table = _SparseJointTable(state_counts)
+            self._observed_table = _SparseJointTable(state_counts)
 
     def free_energy(self, titration_states: List[int]) -> float:
         """Return the sams free energy value for the provided titration state.
@@ -976,11 +2450,9 @@ class _SAMSState:
 
         # In case of the multisite sams approach, the sams weight is the one value in the table matching the joint state
         elif self.approach is SAMSApproach.MULTISITE:
-            if len(titration_states) != len(self._free_energy_table.shape):
-                raise ValueError(
-                    "The number of titration states provided does not match the dimensionality of the table."
-                )
-            return self._free_energy_table[tuple(titration_states)]
+            return self._free_energy_table[
+                self._free_energy_table.index(titration_states)
+            ]
 
     def target(self, titration_states: List[int]) -> np.float64:
         """Return the target weight for the supplied state."""
@@ -997,14 +2469,20 @@ class _SAMSState:
 
         # In case of the multisite sams approach, the sams weight is the one value in the table matching the joint state
         elif self.approach is SAMSApproach.MULTISITE:
-            if len(titration_states) != len(self._free_energy_table.shape):
-                raise ValueError(
-                    "The number of titration states provided does not match the dimensionality of the table."
-                )
-            weight = self._target_table[tuple(titration_states)]
+            weight = self.target_of_index(
+                self._free_energy_table.index(titration_states)
+            )
 
         return weight
 
+    def target_of_index(self, index: int) -> np.float64:
+        """Return the target weight for the state with the given index in the flattened arrays."""
+        if self.approach is SAMSApproach.ONESITE:
+            return self._target_table[self.group_index][index]
+        elif self._target_table is None:
+            return np.float64(1.0 / len(self._free_energy_table))
+        return self._target_table[index]
+
     def observed(self, titration_states: List[int]) -> np.float64:
         """Return the histogram count for the supplied state."""
         # In case of the one site sams approach, the sams weight is the total weight of every titration state
@@ -1020,11 +2498,7 @@ class _SAMSState:
 
         # In case of the multisite sams approach, the sams weight is the one value in the table matching the joint state
         elif self.approach is SAMSApproach.MULTISITE:
-            if len(titration_states) != len(self._observed_table.shape):
-                raise ValueError(
-                    "The number of titration states provided does not match the dimensionality of the table."
-                )
-            counts = self._observed_table[tuple(titration_states)]
+            counts = self._observed_table[self._observed_table.index(titration_states)]
 
         return counts
 
@@ -1034,7 +2508,10 @@ class _SAMSState:
         if self.approach is SAMSApproach.ONESITE:
             return self._target_table[self.group_index]
         elif self.approach is SAMSApproach.MULTISITE:
-            return self._target_table.flatten()
+            if self._target_table is None:
+                size = len(self._free_energy_table)
+                return np.full(size, 1.0 / size, dtype=np.float64)
+            return self._target_table.copy()
 
     @property
     def observed_counts(self) -> np.ndarray:
@@ -1042,7 +2519,16 @@ class _SAMSState:
         if self.approach is SAMSApproach.ONESITE:
             return self._observed_table[self.group_index]
         elif self.approach is SAMSApproach.MULTISITE:
-            return self._observed_table.flatten()
+            return self._observed_table.to_dense()
+
+    def add_observed(self, index: int, count: float):
+        """Add to the histogram count of the state with the given index in the flattened arrays."""
+        if self.approach is SAMSApproach.ONESITE:
+            self._observed_table[self.group_index][index] += count
+        elif self.approach is SAMSApproach.MULTISITE:
+            self._observed_table.add(index, count)
+            self._observed_total += count
+            self._observed_max = max(self._observed_max, self._observed_table[index])
 
     @property
     def deviation_from_target(self) -> np.ndarray:
@@ -1054,6 +2540,17 @@ class _SAMSState:
     @property
     def max_absolute_deviation(self) -> float:
         """Return the maximum absolute deviation between sampled and target histogram."""
+        if self.approach is SAMSApproach.MULTISITE and self._target_table is None:
+            # With equal targets, the largest deviation is found from the extreme counts
+            target = 1.0 / len(self._observed_table)
+            total = max(1.0, self._observed_total)
+            visited = self._observed_table.stored()
+            if len(visited) < len(self._observed_table):
+                # States that were never observed deviate by their target
+                minimum = 0.0
+            else:
+                minimum = min(visited.values())
+            return max(self._observed_max / total - target, target - minimum / total)
         return np.max(np.abs(self.deviation_from_target))
 
     @property
@@ -1062,7 +2559,33 @@ class _SAMSState:
         if self.approach is SAMSApproach.ONESITE:
             return self._free_energy_table[self.group_index]
         elif self.approach is SAMSApproach.MULTISITE:
-            return self._free_energy_table.flatten()
+            return self._free_energy_table.to_dense()
+
+    def add_free_energy(self, index: int, value: float):
+        """Add to the free energy of the state with the given index in the flattened arrays."""
+        if self.approach is SAMSApproach.ONESITE:
+            self._free_energy_table[self.group_index][index] += value
+        elif self.approach is SAMSApproach.MULTISITE:
+            self._free_energy_table.add(index, value)
+
+    def normalize_free_energies(self):
+        """Subtract the free energy of the first state from all free energies."""
+        if self.approach is SAMSApproach.ONESITE:
+            row = self._free_energy_table[self.group_index]
+            self._free_energy_table[self.group_index] = row - row[0]
+        elif self.approach is SAMSApproach.MULTISITE:
+            self._free_energy_table.subtract_from_all(self._free_energy_table[0])
+
+    def set_residue_free_energies(self, residue_free_energies: List[np.ndarray]):
+        """Multisite only, set the free energy of every joint state to the sum of the free energies of its residue states.
+
+        Parameters
+        ----------
+        residue_free_energies - for every residue, an array with the free energy of each of its states.
+        """
+        if self.approach is not SAMSApproach.MULTISITE:
+            raise ValueError("Residue free energies are only used for multisite SAMS.")
+        self._free_energy_table.set_residue_values(residue_free_energies)
 
     @free_energies.setter
     def free_energies(self, free_energies: np.ndarray):
@@ -1073,9 +2596,7 @@ class _SAMSState:
         if self.approach is SAMSApproach.ONESITE:
             self._free_energy_table[self.group_index] = free_energies
         elif self.approach is SAMSApproach.MULTISITE:
-            self._free_energy_table = free_energies.reshape(
-                self._free_energy_table.shape
-            )
+            self._free_energy_table.from_dense(free_energies)
 
     @targets.setter
     def targets(self, targets):
@@ -1086,7 +2607,12 @@ class _SAMSState:
         if self.approach is SAMSApproach.ONESITE:
             self._target_table[self.group_index] = targets
         elif self.approach is SAMSApproach.MULTISITE:
-            self._target_table = targets.reshape(self._target_table.shape)
+            if targets.size != len(self._free_energy_table):
+                raise ValueError("The number of targets does not match the table.")
+            if np.all(targets == targets[0]):
+                self._target_table = None
+            else:
+                self._target_table = np.array(targets, dtype=np.float64)
 
     @observed_counts.setter
     def observed_counts(self, counts):
@@ -1097,14 +2623,123 @@ class _SAMSState:
         if self.approach is SAMSApproach.ONESITE:
             self._observed_table[self.group_index] = counts
         elif self.approach is SAMSApproach.MULTISITE:
-            self._observed_table = counts.reshape(self._observed_table.shape)
+            self._observed_table.from_dense(counts)
+            self._observed_total = float(np.sum(counts))
+            self._observed_max = float(np.max(counts)) if counts.size else 0.0
 
     def reset_observed_counts(self):
         """Reset the observed counts to zero."""
-        self.observed_counts = np.zeros_like(self.observed_counts)
+        if self.approach is SAMSApproach.MULTISITE:
+            self._observed_table.set_residue_values(None)
+            self._observed_total = 0.0
+            self._observed_max = 0.0
+        else:
+            self.observed_counts = np.zeros_like(self.observed_counts)
 
         return
 
+    def update_stage(self, last_deviation: float):
+        """Move to the next stage of SAMS if its criteria are met.
+
+        Parameters
+        ----------
+        last_deviation - the maximum absolute deviation from the target histogram after the last adaptation.
+        """
+        # If the histogram is flat below the criterion
+        # Flatness is defined as the sum of absolute deviations
+        # if minimum iterations have been performed, start SAMS decay
+        if self._current_adaptation >= 0 and self._stage is Stage.NODECAY:
+            log.info("Burn-in iterations complete, starting SAMS.")
+            self._stage = Stage.SLOWDECAY
+            self.reset_observed_counts()
+        # If flatter than criterion, decay the gain faster
+        elif (
+            last_deviation < self._flatness_criterion
+            and self._stage == Stage.SLOWDECAY
+            and self._current_adaptation > self._min_slow
+        ):
+            log.info(
+                "Histogram flat below {}. Initiating the fast-decay phase at iteration {}.".format(
+                    self._flatness_criterion, self._current_adaptation
+                )
+            )
+            self._stage = Stage.FASTDECAY
+            self.reset_observed_counts()
+            self._end_of_slowdecay = int(self._current_adaptation)
+        # If 3x flatter than criterion, stop adapting
+        elif (
+            last_deviation < self._flatness_criterion / 3
+            and self._stage == Stage.FASTDECAY
+            and self._current_adaptation > self._end_of_slowdecay + self._min_fast
+        ):
+            log.info(
+                "Histogram flat below {}. Initiating the equilibrium phase at iteration {}.".format(
+                    self._flatness_criterion / 3, self._current_adaptation
+                )
+            )
+            self.end_adaptation()
+
+    def end_adaptation(self):
+        """Stop adapting the free energies, and start the equilibrium stage."""
+        self._stage = Stage.EQUILIBRIUM
+        self.reset_observed_counts()
+
+    def changes_since(self, snapshot: "_SAMSState") -> Dict[str, Any]:
+        """Return the changes of the free energies, histogram counts and adaptation number since a snapshot.
+
+        Parameters
+        ----------
+        snapshot - a copy of this state, from before the changes.
+
+        Returns
+        -------
+        dict with
+            free_energy_shift - change of the free energy of every state
+            free_energies - additional change of the free energy of individual states, by index
+            observed - change of the histogram counts, by index
+            adaptations - number of adaptations
+        """
+        if self.approach is SAMSApproach.ONESITE:
+            shift = 0.0
+            free_energies = self.free_energies - snapshot.free_energies
+            free_energy_changes = dict(enumerate(free_energies.tolist()))
+            counts = self.observed_counts - snapshot.observed_counts
+            count_changes = dict(enumerate(counts.tolist()))
+        else:
+            shift, free_energy_changes = self._free_energy_table.changes_since(
+                snapshot._free_energy_table
+            )
+            count_changes = self._observed_table.changes_since(
+                snapshot._observed_table
+            )[1]
+        return dict(
+            free_energy_shift=shift,
+            free_energies=free_energy_changes,
+            observed=count_changes,
+            adaptations=self._current_adaptation - snapshot._current_adaptation,
+        )
+
+    def merge_changes(self, changes: List[Dict[str, Any]]):
+        """Add the changes made by multiple copies of this state, see ``changes_since``.
+
+        Parameters
+        ----------
+        changes - the changes of every copy, since it was last made equal to this state.
+        """
+        for change in changes:
+            if change["free_energy_shift"] != 0.0:
+                self._free_energy_table.subtract_from_all(-change["free_energy_shift"])
+            for index, value in change["free_energies"].items():
+                self.add_free_energy(index, value)
+            for index, count in change["observed"].items():
+                self.add_observed(index, count)
+            self._current_adaptation += change["adaptations"]
+        self.normalize_free_energies()
+
+    def assign(self, other: "_SAMSState"):
+        """Make this state equal to another state, keeping references to this object valid."""
+        self.__dict__.update(copy.deepcopy(other.__dict__))
+
     def state_index(self, titration_states) -> int:
         """Find the index of the current titration state in the flattened arrays."""
         if self.approach is SAMSApproach.ONESITE:
@@ -1116,7 +2751,7 @@ class _SAMSState:
             return self._index_table[self.group_index][state]
 
         elif self.approach is SAMSApproach.MULTISITE:
-            return self._index_table[tuple(titration_states)]
+            return self._free_energy_table.index(titration_states)
 
     def __len__(self) -> int:
         """Returns the number of free energy values present inside this table."""
@@ -1126,7 +2761,7 @@ class _SAMSState:
                 size += row.size
 
         elif self.approach is SAMSApproach.MULTISITE:
-            size = self._free_energy_table.size
+            size = len(self._free_energy_table)
 
         return size
 
@@ -1158,17 +2793,33 @@ class _SAMSState:
                 root.append(res)
 
         elif self.approach is SAMSApproach.MULTISITE:
-            for d, dimension in enumerate(self._free_energy_table.shape):
+            free_energies = self._free_energy_table
+            for d, dimension in enumerate(free_energies.shape):
                 dim_elem = etree.Element("Dimension")
                 dim_elem.set("idx", str(d))
                 dim_elem.set("size", str(dimension))
                 root.append(dim_elem)
 
-            for idx in self._index_table.flat:
+            if self._target_table is not None:
+                # Every joint state has its own target, so all are stored
+                indices = range(len(free_energies))
+            else:
+                # Other states are described by the per residue free energies, and have no counts
+                indices = sorted(
+                    set(free_energies.stored()) | set(self._observed_table.stored())
+                )
+                root.set("sparse", "1")
+                root.set("offset", repr(free_energies.offset))
+                for d, values in enumerate(free_energies.residue_values):
+                    root.xpath("Dimension")[d].set(
+                        "free_energies", " ".join(repr(value) for value in values)
+                    )
+
+            for idx in indices:
                 state = etree.Element("State")
-                state.set("FreeEnergy", str(self._free_energy_table.flat[idx]))
-                state.set("Target", str(self._target_table.flat[idx]))
-                state.set("Observed", str(self._observed_table.flat[idx]))
+                state.set("FreeEnergy", str(free_energies[idx]))
+                state.set("Target", str(self.target_of_index(idx)))
+                state.set("Observed", str(self._observed_table[idx]))
                 state.set("idx", str(idx))
                 root.append(state)
 
@@ -1239,18 +2890,34 @@ class _SAMSState:
 
             instance = cls(state_counts, approach, group_index)
 
-            free_energies = np.zeros_like(instance.free_energies)
-            targets = np.ones_like(instance.targets)
-            counts = np.zeros_like(instance.observed_counts)
-            for state in root.xpath("State"):
-                idx = int(state.get("idx"))
-                free_energies[idx] = np.float64(state.get("FreeEnergy"))
-                targets[idx] = np.float64(state.get("Target"))
-                counts[idx] = np.float64(state.get("Observed"))
-
-            instance.free_energies = free_energies
-            instance.targets = targets
-            instance.observed_counts = counts
+            if root.get("sparse") == "1":
+                # Only visited states are listed, targets are equal.
+                residue_free_energies = [None] * len(dims)
+                for dim in dims:
+                    residue_free_energies[int(dim.get("idx"))] = np.fromstring(
+                        dim.get("free_energies"), dtype=np.float64, sep=" "
+                    )
+                instance.set_residue_free_energies(residue_free_energies)
+                instance._free_energy_table.subtract_from_all(float(root.get("offset")))
+                for state in root.xpath("State"):
+                    idx = int(state.get("idx"))
+                    instance._free_energy_table[idx] = float(state.get("FreeEnergy"))
+                    count = float(state.get("Observed"))
+                    if count != 0.0:
+                        instance.add_observed(idx, count)
+            else:
+                free_energies = np.zeros_like(instance.free_energies)
+                targets = np.ones_like(instance.targets)
+                counts = np.zeros_like(instance.observed_counts)
+                for state in root.xpath("State"):
+                    idx = int(state.get("idx"))
+                    free_energies[idx] = np.float64(state.get("FreeEnergy"))
+                    targets[idx] = np.float64(state.get("Target"))
+                    counts[idx] = np.float64(state.get("Observed"))
+
+                instance.free_energies = free_energies
+                instance.targets = targets
+                instance.observed_counts = counts
 
         else:
             raise NotImplementedError(
@@ -1290,6 +2957,9 @@ class _TitrationAttemptData(object):
         self._initial_positions = None
         self._initial_velocities = None
         self._initial_box_vectors = None
+        # The openmm State at the start of the attempt, used to restore the context on rejection.
+        # Positions, velocities and box vectors are only converted to arrays when requested.
+        self._initial_openmm_state = None
 
         self._proposed_charge = None
         self._proposed_states = None
@@ -1300,11 +2970,28 @@ class _TitrationAttemptData(object):
 
         return
 
+    @property
+    def initial_openmm_state(self) -> mm.State:
+        """The openmm State at the start of the attempt, containing positions, velocities and parameters."""
+        return self._initial_openmm_state
+
+    @initial_openmm_state.setter
+    def initial_openmm_state(self, state: mm.State):
+        """Store the state, and clear any initial positions, velocities and box vectors from before."""
+        self._initial_openmm_state = state
+        self._initial_positions = None
+        self._initial_velocities = None
+        self._initial_box_vectors = None
+
     @property
     def initial_positions(self) -> np.ndarray:
         """
         The positions at the start of the attempt.
         """
+        if self._initial_positions is None and self._initial_openmm_state is not None:
+            self.initial_positions = self._initial_openmm_state.getPositions(
+                asNumpy=True
+            )
         return self._initial_positions
 
     @initial_positions.setter
@@ -1327,6 +3014,10 @@ class _TitrationAttemptData(object):
     @property
     def initial_velocities(self) -> np.ndarray:
         """The velocities at the start of the attempt."""
+        if self._initial_velocities is None and self._initial_openmm_state is not None:
+            self.initial_velocities = self._initial_openmm_state.getVelocities(
+                asNumpy=True
+            )
         return np.asarray(self._initial_velocities)
 
     @initial_velocities.setter
@@ -1347,6 +3038,10 @@ class _TitrationAttemptData(object):
     @property
     def initial_box_vectors(self) -> np.ndarray:
         """The box vectors at the start of the attempt."""
+        if self._initial_box_vectors is None and self._initial_openmm_state is not None:
+            self.initial_box_vectors = self._initial_openmm_state.getPeriodicBoxVectors(
+                asNumpy=True
+            )
         return self._initial_box_vectors
 
     @initial_box_vectors.setter
@@ -1614,8 +3309,10 @@ class NCMCProtonDrive(_BaseDrive):
     .. todo::
 
       * Add alternative proposal types, including schemes that avoid proposing self-transitions (or always accept them):
-        - Parallel Monte Carlo schemes: Compute N proposals at once, and pick using Gibbs sampling or Metropolized Gibbs?
-      * Add automatic tuning of switching times for optimal acceptance.
+        - Parallel Monte Carlo schemes: N proposals at once are picked using multiple-try Metropolis,
+          see ``enable_parallel_proposals``. Gibbs sampling or Metropolized Gibbs are not supported.
+      * Automatic tuning of switching times for optimal acceptance is available during warm-up,
+        see ``enable_adaptive_protocol_length``.
     """
 
     def __init__(
@@ -1627,6 +3324,7 @@ class NCMCProtonDrive(_BaseDrive):
         perturbations_per_trial: int = 0,
         propagations_per_step: int = 1,
         sampling_method: SamplingMethod = SamplingMethod.MCMC,
+        parameter_update_method: ParameterUpdateMethod = ParameterUpdateMethod.FORCE_PARAMETERS,
     ):
         """
         Initialize a Monte Carlo titration driver for simulation of protonation states and tautomers.
@@ -1647,6 +3345,8 @@ class NCMCProtonDrive(_BaseDrive):
             Number of propagation steps in between perturbation steps.
         sampling_method : The method of sampling that is used.
             See the SamplingMethod enum for the set of supported options (including MCMC and importance sampling).
+        parameter_update_method : The method used to change force parameters between states.
+            See the ParameterUpdateMethod enum for the set of supported options.
         """
         # Store parameters.
         self.system = system
@@ -1662,11 +3362,15 @@ class NCMCProtonDrive(_BaseDrive):
         self.ncmc_stats_per_step = [None] * perturbations_per_trial
         self.propagations_per_step = propagations_per_step
         self._last_attempt_data = _TitrationAttemptData()
+        # Store the coordinates at the end of NCMC attempts, only needed when they are reported.
+        # Reporters declare this need through ``describeNextReport``, see ``ConstantPHSimulation``.
+        self.record_proposed_coordinates: bool = False
         self.nattempted: int = 0
         self.naccepted: int = 0
         self.nrejected: int = 0
         self.topology = topology
         self.sampling_method = sampling_method
+        self.parameter_update_method = parameter_update_method
 
         # Sets of residues that are pooled together to sample exclusively from them
         self.residue_pools = dict()
@@ -1677,6 +3381,16 @@ class NCMCProtonDrive(_BaseDrive):
         self.ncmc_integrator = None
         self.context = None
 
+        # Evaluates energies of all states of a residue without modifying the context, created on first use.
+        self._state_energy_evaluator: _SideContextEnergyEvaluator = None
+
+        # Tunes the number of propagation steps per residue, see ``enable_adaptive_protocol_length``.
+        self._protocol_controller: _ProtocolLengthController = None
+
+        # Contexts used to run several NCMC proposals at once, see ``enable_parallel_proposals``.
+        self._ncmc_workers: List[_NCMCWorker] = list()
+        self._ncmc_executor: ThreadPoolExecutor = None
+
         # If performing a calibration, free energy / g_k values can be read out of this table instead.
         # Use the enable_calibration to instantiate this.
         self.calibration_state: _SAMSState = None
@@ -1715,6 +3429,8 @@ class NCMCProtonDrive(_BaseDrive):
 
         # Initialize titration group records.
         self.titrationGroups: List[_TitratableResidue] = list()
+        # Array representation of states and state properties, built from the groups on first use.
+        self._state_tables: _TitrationStateTables = None
 
         # Keep track of forces and whether they've been cached.
         self.precached_forces = False
@@ -1735,49 +3451,183 @@ class NCMCProtonDrive(_BaseDrive):
             if force.__class__.__name__ in force_classes_to_update:
                 self.forces_to_update.append(force)
 
+        # Parameter offsets of the NonbondedForce, used by the offset based parameter update methods.
+        # Residues are added when their forces are first updated, or when a context is attached for NCMC offsets.
+        self._parameter_offsets: _ParameterOffsets = None
+        if parameter_update_method is not ParameterUpdateMethod.FORCE_PARAMETERS:
+            self._setup_parameter_offsets()
+
         return
 
-    def state_to_xml(self) -> str:
+    def _setup_parameter_offsets(self):
+        """Prepare the NonbondedForce for switching titration states using parameter offsets."""
+        for force_index, force in enumerate(self.forces_to_update):
+            if force.__class__.__name__ == "NonbondedForce":
+                self._parameter_offsets = _ParameterOffsets(force, force_index)
+                break
+        else:
+            raise ValueError(
+                "Parameter offsets require the system to contain a NonbondedForce."
+            )
+
+    @property
+    def _global_parameter_offsets(self) -> Optional[_ParameterOffsets]:
+        """The parameter offsets that encode all titration states, if used."""
+        if (
+            self.parameter_update_method
+            is ParameterUpdateMethod.GLOBAL_PARAMETER_OFFSETS
+        ):
+            return self._parameter_offsets
+        return None
+
+    @property
+    def _ncmc_parameter_offsets(self) -> Optional[_ParameterOffsets]:
+        """The parameter offsets that switch residues during NCMC, if used."""
+        if self.parameter_update_method is ParameterUpdateMethod.NCMC_PARAMETER_OFFSETS:
+            return self._parameter_offsets
+        return None
+
+    def state_to_xml(self, include_forces: bool = True) -> str:
         """Store residues handled by the drive as xml.
 
+        Parameters
+        ----------
+        include_forces - store the cached force parameters of the residues.
+            Leave them out if they are stored separately using ``force_cache_arrays``.
+
         Returns
         -------
         str - xml representation of the residues inside of the drive.
         """
+        return etree.tostring(
+            self.state_to_element(include_forces=include_forces),
+            encoding="utf-8",
+            pretty_print=True,
+        )
+
+    def state_to_element(self, include_forces: bool = True) -> etree.Element:
+        """Store residues handled by the drive as an xml element, see ``state_to_xml``.
+
+        The element is a copy of the current state of the drive, which can be converted to text later.
+        """
         xmltree = etree.Element("NCMCProtonDrive")
         xmltree.set("temperature_kelvin", str(self.temperature / unit.kelvin))
         if self.pressure is not None:
             xmltree.set("pressure_bar", str(self.pressure / unit.bar))
 
         xmltree.set("sampling_method", str(self.sampling_method.value))
+        xmltree.set("parameter_update_method", str(self.parameter_update_method.value))
 
         for res in self.titrationGroups:
-            xmltree.append(res.serialize())
+            xmltree.append(res.serialize(include_forces=include_forces))
 
         if self.calibration_state is not None:
             xmltree.append(self.calibration_state.to_xml())
 
-        return etree.tostring(xmltree, encoding="utf-8", pretty_print=True)
+        if self._protocol_controller is not None:
+            xmltree.append(self._protocol_controller.to_xml())
+
+        return xmltree
+
+    def force_cache_arrays(self) -> Dict[str, np.ndarray]:
+        """Return the cached force parameters of all residues, packed into a few flat arrays.
+
+        Notes
+        -----
+        The arrays can be stored with ``numpy.savez``, and restored much faster than the xml representation.
+        Pass them to ``state_from_xml_tree`` together with xml from ``state_to_xml(include_forces=False)``.
+        """
+        for group in self.titrationGroups:
+            if any(isinstance(state, _TautomerState) for state in group):
+                raise ValueError(
+                    "The force parameters of tautomer states can not be packed into arrays."
+                )
+        return _PackedForceParameters.to_arrays(
+            [group.packed_forces for group in self.titrationGroups]
+        )
+
+    def state_from_xml_tree(
+        self, xmltree, force_arrays: Optional[Dict[str, np.ndarray]] = None
+    ):
+        """Add residues from previously serialized residues.
 
-    def state_from_xml_tree(self, xmltree):
-        """Add residues from previously serialized residues."""
+        Parameters
+        ----------
+        xmltree - the xml created by ``state_to_xml``
+        force_arrays - optional, the force parameters from ``force_cache_arrays``, for xml without force parameters.
+        """
         # TODO replace this with a class method?
         if type(xmltree) == str:
             xmltree = etree.fromstring(xmltree)
         drive_xml = xmltree.xpath("//NCMCProtonDrive")[0]
 
         self.sampling_method = SamplingMethod(int(drive_xml.get("sampling_method")))
+        # Files from older versions do not record the update method
+        update_method = drive_xml.get("parameter_update_method")
+        if update_method is not None:
+            self.parameter_update_method = ParameterUpdateMethod(int(update_method))
+            if (
+                self.parameter_update_method
+                is not ParameterUpdateMethod.FORCE_PARAMETERS
+                and self._parameter_offsets is None
+            ):
+                self._setup_parameter_offsets()
 
-        for res in drive_xml.xpath("TitratableResidue"):
-            self.titrationGroups.append(_TitratableResidue.from_serialized_xml(res))
+        residues = drive_xml.xpath("TitratableResidue")
+        if force_arrays is None:
+            packed_groups = [None] * len(residues)
+        else:
+            packed_groups = _PackedForceParameters.from_arrays(force_arrays)
+            if len(packed_groups) != len(residues):
+                raise ValueError(
+                    "The force arrays describe {} residues, the xml {}.".format(
+                        len(packed_groups), len(residues)
+                    )
+                )
+        for res, packed_forces in zip(residues, packed_groups):
+            self.titrationGroups.append(
+                _TitratableResidue.from_serialized_xml(res, packed_forces=packed_forces)
+            )
+        self._state_tables = None
 
         sams_state = drive_xml.xpath("SAMSState")
         if len(sams_state):
             self.calibration_state = _SAMSState.from_xml(sams_state[0])
 
+        protocol_controller = drive_xml.xpath("ProtocolLengthController")
+        if len(protocol_controller):
+            self._protocol_controller = _ProtocolLengthController.from_xml(
+                protocol_controller[0]
+            )
+
     @property
     def titrationStates(self):
-        return [group.state_index for group in self.titrationGroups]
+        tables = self._tables
+        if np.any(tables.states < 0):
+            return [group.state_index for group in self.titrationGroups]
+        return tables.states.tolist()
+
+    @property
+    def _tables(self) -> _TitrationStateTables:
+        """Array representation of the titration states, rebuilt if residues were added."""
+        if self._state_tables is None or len(self._state_tables) != len(
+            self.titrationGroups
+        ):
+            self._state_tables = _TitrationStateTables(self.titrationGroups)
+        return self._state_tables
+
+    def _set_group_state(self, titration_group_index: int, titration_state_index: int):
+        """Record the state of a residue, without changing any parameters."""
+        self.titrationGroups[titration_group_index].state = titration_state_index
+        if self._state_tables is not None:
+            self._state_tables.set_state(titration_group_index, titration_state_index)
+
+    def _update_group_g_k(self, titration_group_index: int):
+        """Refresh the stored g_k values of a residue, after they were changed."""
+        if self._state_tables is not None:
+            self._state_tables.update_g_k(
+                titration_group_index, self.titrationGroups[titration_group_index]
+            )
 
     def attach_context(self, context):
         """Attaches a context to the Drive. The Drive requires a context with an NCMC integrator to be attached before it is functional.
@@ -1799,6 +3649,7 @@ class NCMCProtonDrive(_BaseDrive):
 
         self.compound_integrator = context._integrator
         self.context = context
+        self._state_energy_evaluator = None
 
         # Check compatibility of integrator.
         if not isinstance(self.compound_integrator, mm.CompoundIntegrator):
@@ -1823,9 +3674,93 @@ class NCMCProtonDrive(_BaseDrive):
                 "The NCMC integrator does not have a 'first_step' attribute."
             )
 
+        if self._ncmc_parameter_offsets is not None:
+            self._add_ncmc_parameter_offsets()
+
+        if self._global_parameter_offsets is not None:
+            self._add_global_parameter_offsets(range(len(self.titrationGroups)))
+            for group_index, group in enumerate(self.titrationGroups):
+                self._global_parameter_offsets.set_group_parameters(
+                    group_index,
+                    group.state_index,
+                    group.state_index,
+                    context=self.context,
+                )
+
         for force_index, force in enumerate(self.forces_to_update):
             force.updateParametersInContext(self.context)
 
+    def enable_ncmc_parameter_offsets(self):
+        """Perform NCMC perturbations by changing a global parameter instead of updating all force parameters.
+
+        Notes
+        -----
+        The titratable atoms and exceptions receive parameter offsets in the NonbondedForce, which are created once
+        when a context is attached. If a context is already attached, it is reinitialized, preserving its state.
+        During an NCMC protocol the offsets are set to the parameter difference of the changing residues,
+        and each perturbation step only sets the global parameter, rather than pushing every particle parameter
+        to the context. Forces other than the NonbondedForce (e.g. GBSAOBCForce) are still updated every step.
+
+        This selects ``ParameterUpdateMethod.NCMC_PARAMETER_OFFSETS``, which can also be passed to the constructor.
+        Requires a version of OpenMM that supports NonbondedForce parameter offsets.
+        """
+        if self._global_parameter_offsets is not None:
+            raise ValueError(
+                "NCMC parameter offsets can not be combined with global parameter offsets, which already switch states using global parameters."
+            )
+        self.parameter_update_method = ParameterUpdateMethod.NCMC_PARAMETER_OFFSETS
+        if self._parameter_offsets is None:
+            self._setup_parameter_offsets()
+        if self.context is not None:
+            self._add_ncmc_parameter_offsets()
+
+    def _add_ncmc_parameter_offsets(self):
+        """Register the NCMC parameter offsets of all residues, and reinitialize the attached context if needed."""
+        offsets = self._parameter_offsets
+        offsets.modified_force = False
+        offsets.add_ncmc_offsets(self.titrationGroups)
+
+        if self.context is not None and offsets.modified_force:
+            self._reinitialize_context()
+
+    def _add_global_parameter_offsets(self, group_indices: List[int]):
+        """Encode the states of residues that are not yet included as global parameter offsets.
+
+        Notes
+        -----
+        All states of the residues need to have their forces cached.
+        """
+        offsets = self._global_parameter_offsets
+        offsets.modified_force = False
+        for group_index in group_indices:
+            if group_index not in offsets:
+                offsets.add_group(group_index, self.titrationGroups[group_index])
+
+        if self.context is not None and offsets.modified_force:
+            self._reinitialize_context()
+
+    def _reinitialize_context(self):
+        """Reinitialize the attached context after modifying the system, preserving its state."""
+        state = self.context.getState(
+            getPositions=True, getVelocities=True, getParameters=True
+        )
+        self.context.reinitialize()
+        self.context.setState(state)
+
+    def _forces_to_push(self, ions_changed: bool = False) -> List[Tuple[int, mm.Force]]:
+        """Return the (index, force) pairs whose parameters need to be pushed to the context after a state change.
+
+        Parameters
+        ----------
+        ions_changed - if True, ion parameters were modified, which requires pushing the NonbondedForce.
+        """
+        offsets = self._global_parameter_offsets
+        return [
+            (force_index, force)
+            for force_index, force in enumerate(self.forces_to_update)
+            if offsets is None or ions_changed or force is not offsets.force
+        ]
+
     def enable_neutralizing_ions(
         self,
         swapper: Swapper,
@@ -1939,18 +3874,10 @@ class NCMCProtonDrive(_BaseDrive):
             self.calibration_state.free_energies = np.asarray(residue.g_k_values)
             self.calibration_state.targets = np.asarray(residue.target_weights)
         elif approach is SAMSApproach.MULTISITE:
-            free_energies = self.calibration_state.free_energies
-            for index in self.calibration_state._index_table.flatten():
-                free_energy = 0
-                for residue, state in enumerate(
-                    np.where(self.calibration_state._index_table == index)
-                ):
-                    state_idx = int(state)
-                    free_energy += (
-                        self.titrationGroups[residue].titration_states[state_idx].g_k
-                    )
-                free_energies[index] = free_energy
-            self.calibration_state.free_energies = free_energies
+            # The initial free energy of a joint state is the sum of the g_k values of its residue states
+            self.calibration_state.set_residue_free_energies(
+                [np.asarray(group.g_k_values) for group in self.titrationGroups]
+            )
 
     def define_pools(self, dict_of_pools):
         """
@@ -2083,8 +4010,11 @@ class NCMCProtonDrive(_BaseDrive):
             # Perform a number of protonation state update trials.
             for attempt in range(nattempts):
                 self._attempt_number = attempt
-                attempt_data = self._propose_random_change(proposal, residue_pool)
-                self._perform_attempt(attempt_data)
+                if self._ncmc_workers:
+                    self._perform_multiple_try_attempt(proposal, residue_pool)
+                else:
+                    attempt_data = self._propose_random_change(proposal, residue_pool)
+                    self._perform_attempt(attempt_data)
 
             return
 
@@ -2149,6 +4079,7 @@ class NCMCProtonDrive(_BaseDrive):
                         self.titrationGroups[group_index][state_index].g_k = gk_dict[
                             residue_type
                         ][state_index]
+                    self._update_group_g_k(group_index)
 
     def reset_statistics(self):
         """
@@ -2176,8 +4107,9 @@ class NCMCProtonDrive(_BaseDrive):
         ValueError - if the target weight for a given pH is not supplied.
         """
 
-        for residue in self.titrationGroups:
+        for group_index, residue in enumerate(self.titrationGroups):
             residue.set_populations(pH)
+            self._update_group_g_k(group_index)
 
     def _get14scaling(self, system):
         """
@@ -2242,6 +4174,11 @@ class NCMCProtonDrive(_BaseDrive):
         exception_indices : list
             list of exception indices for NonbondedForce
 
+        Notes
+        -----
+        Exceptions are looked up in the atom to exception map that is built by ``_set14exceptions``,
+        rather than by scanning all exceptions of the system for every group.
+
         Todo
         ----
 
@@ -2255,10 +4192,21 @@ class NCMCProtonDrive(_BaseDrive):
             for index in range(system.getNumForces())
         }
         force = forces["NonbondedForce"]
-        # Build a list of exception indices involving any of the specified particles.
-        exception_indices = list()
-        for exception_index in range(force.getNumExceptions()):
-            # TODO this call to getExceptionParameters is expensive. Perhaps this could be cached somewhere per force.
+        # Collect the exception indices involving any of the specified particles, in ascending order.
+        offsets = self._atom_exception_offsets
+        candidates = [
+            self._atom_exception_map[offsets[particle] : offsets[particle + 1]]
+            for particle in particle_indices
+        ]
+        if len(candidates) == 0:
+            return list()
+        exception_indices = np.unique(np.concatenate(candidates)).tolist()
+
+        for exception_index in exception_indices:
+            # BEGIN UGLY HACK
+            # chargeprod and sigma cannot be identically zero or else we risk the error:
+            # Exception: updateParametersInContext: The number of non-excluded exceptions has changed
+            # TODO: Once OpenMM interface permits this, omit this code.
             [
                 particle1,
                 particle2,
@@ -2266,35 +4214,14 @@ class NCMCProtonDrive(_BaseDrive):
                 sigma,
                 epsilon,
             ] = force.getExceptionParameters(exception_index)
-            if (particle1 in particle_indices) or (particle2 in particle_indices):
-                if (particle2 in self.atomExceptions[particle1]) or (
-                    particle1 in self.atomExceptions[particle2]
-                ):
-                    exception_indices.append(exception_index)
-                    # BEGIN UGLY HACK
-                    # chargeprod and sigma cannot be identically zero or else we risk the error:
-                    # Exception: updateParametersInContext: The number of non-excluded exceptions has changed
-                    # TODO: Once OpenMM interface permits this, omit this code.
-                    [
-                        particle1,
-                        particle2,
-                        chargeProd,
-                        sigma,
-                        epsilon,
-                    ] = force.getExceptionParameters(exception_index)
-                    if 2 * chargeProd == chargeProd:
-                        chargeProd = sys.float_info.epsilon
-                    if 2 * epsilon == epsilon:
-                        epsilon = sys.float_info.epsilon
-                    force.setExceptionParameters(
-                        exception_index,
-                        particle1,
-                        particle2,
-                        chargeProd,
-                        sigma,
-                        epsilon,
-                    )
-                    # END UGLY HACK
+            if 2 * chargeProd == chargeProd:
+                chargeProd = sys.float_info.epsilon
+            if 2 * epsilon == epsilon:
+                epsilon = sys.float_info.epsilon
+            force.setExceptionParameters(
+                exception_index, particle1, particle2, chargeProd, sigma, epsilon
+            )
+            # END UGLY HACK
 
         return exception_indices
 
@@ -2306,12 +4233,23 @@ class NCMCProtonDrive(_BaseDrive):
         ----------
         system - OpenMM System object
 
+        Notes
+        -----
+        Besides ``atomExceptions``, this builds a map from every atom to the indices of its 1-4 exceptions,
+        stored in compressed form: the exceptions of atom i are
+        ``_atom_exception_map[_atom_exception_offsets[i]:_atom_exception_offsets[i + 1]]``.
+
         Returns
         -------
 
         """
+        num_particles = system.getNumParticles()
+        self._atom_exception_offsets = np.zeros(num_particles + 1, dtype=np.int64)
+        self._atom_exception_map = np.empty(0, dtype=np.int64)
         for force in system.getForces():
             if force.__class__.__name__ == "NonbondedForce":
+                exception_atoms = list()
+                exception_indices = list()
                 for index in range(force.getNumExceptions()):
                     [
                         atom1,
@@ -2327,6 +4265,17 @@ class NCMCProtonDrive(_BaseDrive):
                     if abs(unitless_epsilon) > 1.0e-15:
                         self.atomExceptions[atom1].append(atom2)
                         self.atomExceptions[atom2].append(atom1)
+                        exception_atoms.extend((atom1, atom2))
+                        exception_indices.extend((index, index))
+
+                # Sort the exceptions by atom, and store where the exceptions of each atom start.
+                exception_atoms = np.asarray(exception_atoms, dtype=np.int64)
+                exception_indices = np.asarray(exception_indices, dtype=np.int64)
+                order = np.argsort(exception_atoms, kind="stable")
+                self._atom_exception_map = exception_indices[order]
+                self._atom_exception_offsets = np.searchsorted(
+                    exception_atoms[order], np.arange(num_particles + 1)
+                )
         return
 
     @staticmethod
@@ -2474,6 +4423,7 @@ class NCMCProtonDrive(_BaseDrive):
             pka_data=pka_data,
         )
         self.titrationGroups.append(group)
+        self._state_tables = None
         return group_index
 
     def get_num_titration_states(self, titration_group_index):
@@ -2559,6 +4509,7 @@ class NCMCProtonDrive(_BaseDrive):
             cooh_movers,
         )
         self.titrationGroups[titration_group_index].add_state(state)
+        self._state_tables = None
         return
 
     def get_titration_state(self, titration_group_index: int) -> int:
@@ -2664,8 +4615,8 @@ class NCMCProtonDrive(_BaseDrive):
         updateIons : update the ions/waters using saltswap alongside the titration state.
         """
 
-        initial_titration_states = np.asarray(copy.deepcopy(self.titrationStates))
-        final_titration_states = np.asarray(copy.deepcopy(self.titrationStates))
+        initial_titration_states = self._tables.states.copy()
+        final_titration_states = initial_titration_states.copy()
         final_titration_states[titration_group_index] = titration_state_index
 
         if np.all(initial_titration_states == final_titration_states):
@@ -2696,9 +4647,11 @@ class NCMCProtonDrive(_BaseDrive):
 
         # The context needs to be updated after the force parameters are updated
         if self.context is not None and updateContextParameters:
-            for force_index, force in enumerate(self.forces_to_update):
+            for force_index, force in self._forces_to_push(
+                ions_changed=updateIons and self.swapper is not None
+            ):
                 force.updateParametersInContext(self.context)
-        self.titrationGroups[titration_group_index].state = titration_state_index
+        self._set_group_state(titration_group_index, titration_state_index)
 
         return
 
@@ -2716,6 +4669,7 @@ class NCMCProtonDrive(_BaseDrive):
         -----
         * Please ensure that the context is updated after calling this function, by using
         `force.updateParametersInContext(context)` for each force that has been updated.
+        * With global parameter offsets, the NonbondedForce parameters are set in the attached context directly.
 
         Parameters
         ----------
@@ -2735,6 +4689,7 @@ class NCMCProtonDrive(_BaseDrive):
         * Every titration state has a list called forces, which stores parameters for all forces that need updating.
         * Inside each list entry is a dictionary that always contains an entry called `atoms`, with single atom parameters by name.
         * NonbondedForces also have an entry called `exceptions`, containing exception parameters.
+        * For speed, these are packed per residue into arrays (see `_PackedForceParameters`) before blending.
 
         """
         # `initial_titration_state_index` should have no effect if not specified, so set it identical to
@@ -2742,83 +4697,31 @@ class NCMCProtonDrive(_BaseDrive):
         if initial_titration_state_index is None:
             initial_titration_state_index = final_titration_state_index
 
-        # Retrieve cached force parameters fro this titration state.
-        cache_initial = self.titrationGroups[titration_group_index][
-            initial_titration_state_index
-        ].forces
-        cache_final = self.titrationGroups[titration_group_index][
-            final_titration_state_index
-        ].forces
+        # Retrieve the array representation of the cached force parameters of this group.
+        packed_forces = self.titrationGroups[titration_group_index].packed_forces
 
-        # Modify charges and exceptions.
+        # Modify charges and exceptions, using appropriately blended parameters
+        # TODO : if we ever change LJ parameters, we need to look into softcore potentials
+        # and separate out the changes in charge, and sigma/eps into different steps.
+        offsets = self._global_parameter_offsets
         for force_index, force in enumerate(self.forces_to_update):
-            # Get name of force class.
-            force_classname = force.__class__.__name__
-            # Get atom indices and charges.
-
-            # Update forces using appropriately blended parameters
-            for (atom_initial, atom_final) in zip(
-                cache_initial[force_index]["atoms"], cache_final[force_index]["atoms"]
-            ):
-                atom = {key: atom_initial[key] for key in ["atom_index"]}
-                if force_classname == "NonbondedForce":
-                    # TODO : if we ever change LJ parameters, we need to look into softcore potentials
-                    # and separate out the changes in charge, and sigma/eps into different steps.
-                    for parameter_name in ["charge", "sigma", "epsilon"]:
-                        atom[parameter_name] = (
-                            (1.0 - fractional_titration_state)
-                            * atom_initial[parameter_name]
-                            + fractional_titration_state * atom_final[parameter_name]
-                        )
-                    force.setParticleParameters(
-                        atom["atom_index"],
-                        atom["charge"],
-                        atom["sigma"],
-                        atom["epsilon"],
-                    )
-                elif force_classname == "GBSAOBCForce":
-                    for parameter_name in ["charge", "radius", "scaleFactor"]:
-                        atom[parameter_name] = (
-                            (1.0 - fractional_titration_state)
-                            * atom_initial[parameter_name]
-                            + fractional_titration_state * atom_final[parameter_name]
-                        )
-                    force.setParticleParameters(
-                        atom["atom_index"],
-                        atom["charge"],
-                        atom["radius"],
-                        atom["scaleFactor"],
-                    )
-                else:
-                    raise Exception(
-                        "Don't know how to update force type '%s'" % force_classname
-                    )
-
-            # Update exceptions
-            # TODO: Handle Custom forces.
-            if force_classname == "NonbondedForce":
-                for (exc_initial, exc_final) in zip(
-                    cache_initial[force_index]["exceptions"],
-                    cache_final[force_index]["exceptions"],
-                ):
-                    exc = {
-                        key: exc_initial[key]
-                        for key in ["exception_index", "particle1", "particle2"]
-                    }
-                    for parameter_name in ["chargeProd", "sigma", "epsilon"]:
-                        exc[parameter_name] = (
-                            (1.0 - fractional_titration_state)
-                            * exc_initial[parameter_name]
-                            + fractional_titration_state * exc_final[parameter_name]
-                        )
-                    force.setExceptionParameters(
-                        exc["exception_index"],
-                        exc["particle1"],
-                        exc["particle2"],
-                        exc["chargeProd"],
-                        exc["sigma"],
-                        exc["epsilon"],
-                    )
+            # States encoded by offsets only require global parameters to be set
+            if offsets is not None and force is offsets.force:
+                self._add_global_parameter_offsets([titration_group_index])
+                offsets.set_group_parameters(
+                    titration_group_index,
+                    initial_titration_state_index,
+                    final_titration_state_index,
+                    fraction=fractional_titration_state,
+                    context=self.context,
+                )
+            else:
+                packed_forces[force_index].apply(
+                    force,
+                    initial_titration_state_index,
+                    final_titration_state_index,
+                    fraction=fractional_titration_state,
+                )
 
     def _cache_force(self, titration_group_index, titration_state_index):
         """
@@ -2951,6 +4854,7 @@ class NCMCProtonDrive(_BaseDrive):
         self.titrationGroups[titration_group_index][
             titration_state_index
         ].forces = f_params
+        titration_group.invalidate_packed_forces()
 
     def _perform_ncmc_protocol(
         self,
@@ -3028,65 +4932,125 @@ class NCMCProtonDrive(_BaseDrive):
         # The "work" in the acceptance test has a contribution from the titratable group weights.
         g_initial = self.calculate_gk()
 
-        # PROPAGATION
-        ncmc_integrator.step(self.propagations_per_step)
-
-        for step in range(self.perturbations_per_trial):
-
-            # Get the fractional stage of the the protocol
-            titration_lambda = float(step + 1) / float(self.perturbations_per_trial)
-            # perturbation
-            for titration_group_index in titration_group_indices:
-                self._update_forces(
-                    titration_group_index,
-                    final_titration_states[titration_group_index],
-                    initial_titration_state_index=initial_titration_states[
-                        titration_group_index
+        # With parameter offsets, the NonbondedForce is switched using a global parameter,
+        # and only needs to be pushed to the context if ions are changed alongside.
+        offsets = self._ncmc_parameter_offsets
+        forces_to_push = self._forces_to_push(ions_changed=update_salt)
+        try:
+            if offsets is not None:
+                offsets.set_deltas(
+                    [self.titrationGroups[index] for index in titration_group_indices],
+                    [
+                        initial_titration_states[index]
+                        for index in titration_group_indices
+                    ],
+                    [
+                        final_titration_states[index]
+                        for index in titration_group_indices
                     ],
-                    fractional_titration_state=titration_lambda,
                 )
+                self.context.setParameter(offsets.ncmc_parameter_name, 0.0)
+                offsets.force.updateParametersInContext(self.context)
+                forces_to_push = [
+                    (force_index, force)
+                    for force_index, force in forces_to_push
+                    if force is not offsets.force
+                ]
 
-            if update_salt:
-                update_fractional_stateVector(
-                    self.swapper,
-                    final_salt_vector,
-                    fraction=titration_lambda,
-                    set_vector_indices=False,
-                )
+            propagations_per_step = self._propagations_for(titration_group_indices)
+
+            # PROPAGATION
+            ncmc_integrator.step(propagations_per_step)
+
+            for step in range(self.perturbations_per_trial):
+
+                # Get the fractional stage of the the protocol
+                titration_lambda = float(step + 1) / float(self.perturbations_per_trial)
+                # perturbation
+                if offsets is None:
+                    for titration_group_index in titration_group_indices:
+                        self._update_forces(
+                            titration_group_index,
+                            final_titration_states[titration_group_index],
+                            initial_titration_state_index=initial_titration_states[
+                                titration_group_index
+                            ],
+                            fractional_titration_state=titration_lambda,
+                        )
+                else:
+                    self.context.setParameter(
+                        offsets.ncmc_parameter_name, titration_lambda
+                    )
+                    for titration_group_index in titration_group_indices:
+                        packed_forces = self.titrationGroups[
+                            titration_group_index
+                        ].packed_forces
+                        for force_index, force in forces_to_push:
+                            packed_forces[force_index].apply(
+                                force,
+                                initial_titration_states[titration_group_index],
+                                final_titration_states[titration_group_index],
+                                fraction=titration_lambda,
+                            )
 
-            for force_index, force in enumerate(self.forces_to_update):
-                force.updateParametersInContext(self.context)
+                if update_salt:
+                    update_fractional_stateVector(
+                        self.swapper,
+                        final_salt_vector,
+                        fraction=titration_lambda,
+                        set_vector_indices=False,
+                    )
+                    if offsets is not None:
+                        offsets.force.updateParametersInContext(self.context)
 
-            # propagation
-            ncmc_integrator.step(self.propagations_per_step)
+                for force_index, force in forces_to_push:
+                    force.updateParametersInContext(self.context)
 
-            # logging of statistics
-            if isinstance(ncmc_integrator, GHMCIntegrator):
-                self.ncmc_stats_per_step[step] = (
-                    ncmc_integrator.getGlobalVariableByName("protocol_work")
-                    * self.beta_unitless,
-                    ncmc_integrator.getGlobalVariableByName("naccept"),
-                    ncmc_integrator.getGlobalVariableByName("ntrials"),
-                )
-            else:
-                self.ncmc_stats_per_step[step] = (
-                    ncmc_integrator.getGlobalVariableByName("protocol_work")
-                    * self.beta_unitless,
-                    0,
-                    0,
-                )
+                # propagation
+                ncmc_integrator.step(propagations_per_step)
 
-        # Extract the internally calculated work from the integrator
-        work = (
-            ncmc_integrator.getGlobalVariableByName("protocol_work")
-            * self.beta_unitless
-        )
+                # logging of statistics
+                if isinstance(ncmc_integrator, GHMCIntegrator):
+                    self.ncmc_stats_per_step[step] = (
+                        ncmc_integrator.getGlobalVariableByName("protocol_work")
+                        * self.beta_unitless,
+                        ncmc_integrator.getGlobalVariableByName("naccept"),
+                        ncmc_integrator.getGlobalVariableByName("ntrials"),
+                    )
+                else:
+                    self.ncmc_stats_per_step[step] = (
+                        ncmc_integrator.getGlobalVariableByName("protocol_work")
+                        * self.beta_unitless,
+                        0,
+                        0,
+                    )
+
+            # Extract the internally calculated work from the integrator
+            work = (
+                ncmc_integrator.getGlobalVariableByName("protocol_work")
+                * self.beta_unitless
+            )
+
+            # Move the final parameters out of the offsets, into the force itself.
+            # This does not change the energy, so it does not contribute to the work.
+            if offsets is not None:
+                for titration_group_index in titration_group_indices:
+                    self._update_forces(
+                        titration_group_index,
+                        final_titration_states[titration_group_index],
+                    )
+        finally:
+            # Never leave the context with offsets applied, also if the protocol failed.
+            if offsets is not None:
+                offsets.clear()
+                self.context.setParameter(offsets.ncmc_parameter_name, 0.0)
+                offsets.force.updateParametersInContext(self.context)
 
         # Setting the titratable group to the final state so that the appropriate weight can be extracted
         for titration_group_index in titration_group_indices:
-            self.titrationGroups[titration_group_index].state = final_titration_states[
-                titration_group_index
-            ]
+            self._set_group_state(
+                titration_group_index, final_titration_states[titration_group_index]
+            )
 
         # Extracting the final state's weight.
         g_final = self.calculate_gk()
@@ -3110,19 +5074,19 @@ class NCMCProtonDrive(_BaseDrive):
                 self.titrationGroups[
                     self.calibration_state.group_index
                 ].g_k_values = free_energies
+                self._update_group_g_k(self.calibration_state.group_index)
 
         return self.sum_of_gk()
 
     def sum_of_gk(self):
-        """Calculate the total weight of the current titration state."""
-        g_total = 0
-        for (
-            titration_group_index,
-            (titration_group, titration_state_index),
-        ) in enumerate(zip(self.titrationGroups, self.titrationStates)):
-            titration_state = titration_group[titration_state_index]
-            g_total += titration_state.g_k
-        return g_total
+        """Calculate the total weight of the current titration state.
+
+        Notes
+        -----
+        The total is kept up to date incrementally as states change. If g_k values are modified without using
+        the drive, call ``_update_group_g_k`` for the residue.
+        """
+        return self._tables.total_g_k
 
     def _perform_attempt(
         self, attempt_data: _TitrationAttemptData, reject_on_nan: bool = False
@@ -3142,19 +5106,10 @@ class NCMCProtonDrive(_BaseDrive):
 
         initial_positions = initial_velocities = initial_box_vectors = None
 
-        # If using NCMC, store initial positions.
+        # If using NCMC, store the initial state. It is restored in a single call on rejection.
         if self.perturbations_per_trial > 0:
-            initial_openmm_state = self.context.getState(
-                getPositions=True, getVelocities=True
-            )
-            attempt_data.initial_positions = initial_openmm_state.getPositions(
-                asNumpy=True
-            )
-            attempt_data.initial_velocities = initial_openmm_state.getVelocities(
-                asNumpy=True
-            )
-            attempt_data.initial_box_vectors = initial_openmm_state.getPeriodicBoxVectors(
-                asNumpy=True
+            attempt_data.initial_openmm_state = self.context.getState(
+                getPositions=True, getVelocities=True, getParameters=True
             )
 
         log_P_initial, pot1, kin1 = self._compute_log_probability()
@@ -3225,7 +5180,7 @@ class NCMCProtonDrive(_BaseDrive):
             if np.any(attempt_data.initial_states != attempt_data.proposed_states):
                 self.nattempted += 1
 
-            if self.perturbations_per_trial > 0:
+            if self.perturbations_per_trial > 0 and self.record_proposed_coordinates:
                 proposed_openmm_State = self.context.getState(
                     getPositions=True, getVelocities=True
                 )
@@ -3242,6 +5197,14 @@ class NCMCProtonDrive(_BaseDrive):
             # Accept or reject with Metropolis criteria.
             attempt_data.logp_accept = log_P_accept
             log.debug("Acceptance probability: %f", log_P_accept)
+            if self._protocol_controller is not None:
+                self._protocol_controller.record(
+                    attempt_data.changing_groups,
+                    attempt_data.initial_states,
+                    attempt_data.proposed_states,
+                    attempt_data.work,
+                    log_P_accept,
+                )
             if self.sampling_method is SamplingMethod.MCMC:
                 accept_move = self._accept_reject(log_P_accept)
                 attempt_data.accepted = accept_move
@@ -3269,6 +5232,301 @@ class NCMCProtonDrive(_BaseDrive):
 
         return
 
+    def enable_adaptive_protocol_length(
+        self,
+        target_acceptance: float = 0.5,
+        warmup_attempts: int = 500,
+        tune_interval: int = 20,
+        max_propagations_per_step: Optional[int] = None,
+    ):
+        """Tune the NCMC protocol length of every residue toward a target acceptance rate during a warm-up phase.
+
+        Parameters
+        ----------
+        target_acceptance - the acceptance rate to tune toward, between 0 and 1
+        warmup_attempts - the number of attempts after which the protocol lengths are frozen
+        tune_interval - the number of attempts of a residue in between updates of its protocol length
+        max_propagations_per_step - optional, upper bound on the number of propagation steps in between perturbations
+
+        Notes
+        -----
+        The number of perturbations per trial stays the same, and the number of propagation steps in between
+        perturbations is tuned for each residue, starting from ``propagations_per_step``.
+        Changing the protocol during the simulation violates detailed balance, so samples from the warm-up phase
+        should be discarded. Check ``adaptive_protocol_frozen`` to see if the warm-up has finished.
+        Call this after all titratable residues have been added.
+        """
+        if self.perturbations_per_trial == 0:
+            raise ValueError(
+                "Adaptive protocol lengths require NCMC (perturbations_per_trial > 0)."
+            )
+        self._protocol_controller = _ProtocolLengthController(
+            len(self.titrationGroups),
+            self.propagations_per_step,
+            target_acceptance=target_acceptance,
+            warmup_attempts=warmup_attempts,
+            tune_interval=tune_interval,
+            max_propagations_per_step=max_propagations_per_step,
+        )
+
+    @property
+    def adaptive_protocol_frozen(self) -> bool:
+        """True if protocol lengths are not being tuned (anymore)."""
+        return self._protocol_controller is None or self._protocol_controller.frozen
+
+    @property
+    def propagations_per_step_per_residue(self) -> List[int]:
+        """The number of propagation steps in between perturbations, for every residue."""
+        if self._protocol_controller is None:
+            return [self.propagations_per_step] * len(self.titrationGroups)
+        return self._protocol_controller.propagations_per_step.tolist()
+
+    def _propagations_for(self, titration_group_indices: List[int]) -> int:
+        """Number of propagation steps in between perturbations for a protocol that changes these residues."""
+        if self._protocol_controller is None:
+            return self.propagations_per_step
+        return self._protocol_controller.propagations_for(titration_group_indices)
+
+    def enable_parallel_proposals(
+        self,
+        nworkers: int,
+        platform: Optional[mm.Platform] = None,
+        properties: Optional[Dict[str, str]] = None,
+    ):
+        """Run several independent NCMC proposals at once for every update attempt.
+
+        Parameters
+        ----------
+        nworkers - the number of proposals per attempt. Each proposal runs in its own context.
+        platform - optional, the platform for the worker contexts. Defaults to the platform of the attached context.
+        properties - optional, platform properties for the worker contexts.
+            Defaults to the properties of the attached context, e.g. to select a different GPU per worker.
+
+        Notes
+        -----
+        Attempts use multiple-try Metropolis [Liu2000]_. The ``nworkers`` NCMC protocols start from the current
+        configuration, and one of them is selected with a probability proportional to its acceptance weight.
+        A set of ``nworkers - 1`` reference protocols is then run from the selected end point, to accept or reject it.
+        Every attempt therefore runs ``2 * nworkers - 1`` protocols, in two parallel batches.
+        The attached context is only updated if the selected proposal is accepted.
+
+        Protocols run in threads, which is efficient when the platform performs the integration outside of python,
+        e.g. using CUDA or OpenCL. Counterion coupling is not supported.
+
+        References
+        ----------
+        .. [Liu2000] Liu JS, Liang F, Wong WH. The multiple-try method and local optimization in Metropolis sampling.
+            JASA 95:121, 2000. http://dx.doi.org/10.1080/01621459.2000.10473908
+        """
+        if self.context is None:
+            raise RuntimeError("Driver has no context attached.")
+        if nworkers < 1:
+            raise ValueError("The number of workers needs to be at least 1.")
+        if self.perturbations_per_trial == 0:
+            raise ValueError("Parallel proposals require NCMC (perturbations_per_trial > 0).")
+        if self.swapper is not None:
+            raise NotImplementedError(
+                "Parallel proposals do not support counterion coupling."
+            )
+        if self.sampling_method is not SamplingMethod.MCMC:
+            raise NotImplementedError(
+                "Parallel proposals are only supported for MCMC sampling."
+            )
+
+        self.disable_parallel_proposals()
+        if platform is None:
+            platform = self.context.getPlatform()
+        if properties is None:
+            properties = {
+                name: platform.getPropertyValue(self.context, name)
+                for name in platform.getPropertyNames()
+            }
+        for worker_index in range(nworkers):
+            self._ncmc_workers.append(
+                _NCMCWorker(self, platform, properties, random.randint(1, 2 ** 30))
+            )
+        self._ncmc_executor = ThreadPoolExecutor(max_workers=nworkers)
+
+    def disable_parallel_proposals(self):
+        """Remove the worker contexts, and perform a single proposal per update attempt."""
+        if self._ncmc_executor is not None:
+            self._ncmc_executor.shutdown()
+        self._ncmc_executor = None
+        self._ncmc_workers = list()
+
+    def _gk_of_states(self, titration_states: List[int]) -> float:
+        """Return the total weight of a combination of titration states, without changing the current state."""
+        if self.calibration_state is not None:
+            if self.calibration_state.approach is SAMSApproach.MULTISITE:
+                return self.calibration_state.free_energy(titration_states)
+            # Make sure the tables reflect the calibration values
+            self.calculate_gk()
+        tables = self._tables
+        g_k = tables.g_k[np.arange(len(titration_states)), titration_states]
+        return g_k.sum().item()
+
+    def _run_parallel_protocols(
+        self, attempts: List[_TitrationAttemptData], start: Dict[str, np.ndarray]
+    ) -> List[Dict[str, Any]]:
+        """Run the NCMC protocol of each attempt in a separate worker, from the same starting configuration."""
+        futures = [
+            self._ncmc_executor.submit(
+                worker.run,
+                attempt_data.initial_states,
+                attempt_data.proposed_states,
+                attempt_data.changing_groups,
+                start["positions"],
+                start["velocities"],
+                start["box_vectors"],
+            )
+            for worker, attempt_data in zip(self._ncmc_workers, attempts)
+        ]
+        results = [future.result() for future in futures]
+        for attempt_data, result in zip(attempts, results):
+            delta_g = self._gk_of_states(
+                attempt_data.proposed_states
+            ) - self._gk_of_states(attempt_data.initial_states)
+            attempt_data.work = result["work"] + delta_g
+            # The log of the Metropolis-Hastings ratio of the trial, and its split into the change in
+            # log probability of the end points, and the log ratio of reverse and forward proposal probability.
+            attempt_data.logp_accept = (
+                attempt_data.logp_ratio_residue_proposal - attempt_data.work
+            )
+            result["delta_log_p"] -= delta_g
+            result["log_proposal_ratio"] = (
+                attempt_data.logp_accept - result["delta_log_p"]
+            )
+        return results
+
+    @staticmethod
+    def _multiple_try_log_weights(results: List[Dict[str, Any]]) -> np.ndarray:
+        """Log weights of trials for multiple-try Metropolis, relative to the probability of the starting point.
+
+        Notes
+        -----
+        The weight of a trial x -> y is p(y) * sqrt(T(y -> x) / T(x -> y)), which corresponds to the symmetric
+        choice of lambda(x, y) = 1 / sqrt(T(x -> y) T(y -> x)) in [Liu2000]_. Only the ratio of proposal
+        probabilities is needed, which is what an NCMC protocol provides.
+        """
+        return np.asarray(
+            [
+                result["delta_log_p"] + 0.5 * result["log_proposal_ratio"]
+                for result in results
+            ]
+        )
+
+    def _perform_multiple_try_attempt(
+        self, proposal: _StateProposal, residue_pool: Optional[str] = None
+    ):
+        """Attempt a protonation state change using several NCMC proposals at once (multiple-try Metropolis).
+
+        Parameters
+        ----------
+        proposal : _StateProposal derived class
+            Method of selecting residues to update, and their states.
+        residue_pool : str, default None
+            The set of titration group incides to propose from.
+        """
+        nworkers = len(self._ncmc_workers)
+        initial_states = self.titrationStates
+        initial_state = self.context.getState(getPositions=True, getVelocities=True)
+        start = dict(
+            positions=initial_state.getPositions(asNumpy=True),
+            velocities=initial_state.getVelocities(asNumpy=True),
+            box_vectors=initial_state.getPeriodicBoxVectors(asNumpy=True),
+        )
+
+        # Forward trials, all starting from the current configuration
+        trials = [
+            self._propose_random_change(proposal, residue_pool)
+            for worker in range(nworkers)
+        ]
+        results = self._run_parallel_protocols(trials, start)
+        log_weights = self._multiple_try_log_weights(results)
+        probabilities = np.exp(log_weights - logsumexp(log_weights))
+        selected = int(np.random.choice(nworkers, p=probabilities / probabilities.sum()))
+        attempt_data = trials[selected]
+        result = results[selected]
+
+        attempt_data.initial_positions = start["positions"]
+        attempt_data.initial_velocities = start["velocities"]
+        attempt_data.initial_box_vectors = start["box_vectors"]
+        # As for a single proposal, the end point is stored with the velocities at the end of the protocol
+        if self.record_proposed_coordinates:
+            attempt_data.proposed_positions = result["positions"]
+            attempt_data.proposed_velocities = result["velocities"]
+            attempt_data.proposed_box_vectors = result["box_vectors"]
+        # Velocities are flipped upon acceptance to satisfy super-detailed balance
+        reversed_velocities = -result["velocities"]
+        self.ncmc_stats_per_step = list(result["stats"])
+
+        # Reference trials, starting from the selected configuration with reversed velocities.
+        # The reverse of the selected trial, back to the starting point, completes the reference set.
+        reference_log_weights = [-0.5 * result["log_proposal_ratio"]]
+        if nworkers > 1:
+            for group_index, state_index in enumerate(attempt_data.proposed_states):
+                self._set_group_state(group_index, state_index)
+            try:
+                references = [
+                    self._propose_random_change(proposal, residue_pool)
+                    for worker in range(nworkers - 1)
+                ]
+            finally:
+                for group_index, state_index in enumerate(initial_states):
+                    self._set_group_state(group_index, state_index)
+            reference_results = self._run_parallel_protocols(
+                references,
+                dict(
+                    positions=result["positions"],
+                    velocities=reversed_velocities,
+                    box_vectors=result["box_vectors"],
+                ),
+            )
+            # Relative to the probability of the starting point, rather than the selected point
+            reference_log_weights.extend(
+                result["delta_log_p"]
+                + self._multiple_try_log_weights(reference_results)
+            )
+
+        log_P_accept = logsumexp(log_weights) - logsumexp(reference_log_weights)
+        attempt_data.logp_accept = log_P_accept
+        log.debug("Multiple-try acceptance probability: %f", log_P_accept)
+        if self._protocol_controller is not None:
+            self._protocol_controller.record(
+                attempt_data.changing_groups,
+                attempt_data.initial_states,
+                attempt_data.proposed_states,
+                attempt_data.work,
+                log_P_accept,
+            )
+
+        changed = np.any(
+            np.asarray(attempt_data.initial_states)
+            != np.asarray(attempt_data.proposed_states)
+        )
+        if changed:
+            self.nattempted += 1
+        attempt_data.accepted = bool(self._accept_reject(log_P_accept))
+        if attempt_data.accepted:
+            if changed:
+                self.naccepted += 1
+            for group_index in attempt_data.changing_groups:
+                self.set_titration_state(
+                    group_index,
+                    attempt_data.proposed_states[group_index],
+                    updateContextParameters=False,
+                    updateIons=False,
+                )
+            for force_index, force in self._forces_to_push():
+                force.updateParametersInContext(self.context)
+            self.context.setPeriodicBoxVectors(*result["box_vectors"])
+            self.context.setPositions(result["positions"])
+            self.context.setVelocities(reversed_velocities)
+        elif changed:
+            self.nrejected += 1
+
+        self._last_attempt_data = attempt_data
+
     def _propose_random_change(
         self, proposal: _StateProposal, residue_pool: Optional[str] = None
     ) -> _TitrationAttemptData:
@@ -3288,17 +5546,16 @@ class NCMCProtonDrive(_BaseDrive):
         # attempts, and to record potential and kinetic energy.
 
         # Store current titration state indices.
-        initial_titration_states = copy.deepcopy(self.titrationStates)
+        initial_titration_states = self.titrationStates
         final_titration_states, titration_group_indices, logp_ratio_residue_proposal = proposal.propose_states(
             self, residue_pool_indices
         )
-        initial_charge = 0
-        final_charge = 0
-        for idx in titration_group_indices:
-            initial_state = initial_titration_states[idx]
-            initial_charge += self.titrationGroups[idx].total_charges[initial_state]
-            final_state = final_titration_states[idx]
-            final_charge += self.titrationGroups[idx].total_charges[final_state]
+        initial_charge, final_charge = self._tables.totals(
+            self._tables.charges,
+            initial_titration_states,
+            final_titration_states,
+            titration_group_indices,
+        )
         attempt_data.initial_charge = initial_charge
         attempt_data.initial_states = initial_titration_states
         attempt_data.proposed_charge = final_charge
@@ -3330,7 +5587,7 @@ class NCMCProtonDrive(_BaseDrive):
         # attempts, and to record potential and kinetic energy.
 
         # Store current titration state indices.
-        initial_titration_states = copy.deepcopy(self.titrationStates)
+        initial_titration_states = self.titrationStates
 
         titration_group_indices: List[int] = np.where(
             np.asarray(initial_titration_states) != np.asarray(proposed_states)
@@ -3338,13 +5595,12 @@ class NCMCProtonDrive(_BaseDrive):
 
         final_titration_states = proposed_states
         logp_ratio_residue_proposal = 0.0
-        initial_charge = 0
-        final_charge = 0
-        for idx in titration_group_indices:
-            initial_state = initial_titration_states[idx]
-            initial_charge += self.titrationGroups[idx].total_charges[initial_state]
-            final_state = final_titration_states[idx]
-            final_charge += self.titrationGroups[idx].total_charges[final_state]
+        initial_charge, final_charge = self._tables.totals(
+            self._tables.charges,
+            initial_titration_states,
+            final_titration_states,
+            titration_group_indices,
+        )
         attempt_data.initial_charge = initial_charge
         attempt_data.initial_states = initial_titration_states
         attempt_data.proposed_charge = final_charge
@@ -3371,23 +5627,13 @@ class NCMCProtonDrive(_BaseDrive):
     ):
         """For a given change in titration states, get the change in ions and propose ions/waters to swap."""
         proposed_ion_states = copy.deepcopy(self.swapper.stateVector)
-        initial_cations = 0
-        initial_anions = 0
-        proposed_anions = 0
-        proposed_cations = 0
-        for r, residue in enumerate(self.titrationGroups):
-            initial_anions += residue.titration_states[
-                initial_titration_states[r]
-            ].anion_count
-            initial_cations += residue.titration_states[
-                initial_titration_states[r]
-            ].cation_count
-            proposed_anions += residue.titration_states[
-                final_titration_states[r]
-            ].anion_count
-            proposed_cations += residue.titration_states[
-                final_titration_states[r]
-            ].cation_count
+        # Only residues that change state contribute to the change in ions
+        initial_anions, proposed_anions = self._tables.totals(
+            self._tables.anion_counts, initial_titration_states, final_titration_states
+        )
+        initial_cations, proposed_cations = self._tables.totals(
+            self._tables.cation_counts, initial_titration_states, final_titration_states
+        )
 
         saltswap_residue_indices, saltswap_states, logp_ratio_salt_proposal = self.swap_proposal.propose_swaps(
             self.swapper,
@@ -3412,14 +5658,11 @@ class NCMCProtonDrive(_BaseDrive):
         # Update internal statistics counter
         if np.any(attempt_data.initial_states != attempt_data.proposed_states):
             self.nrejected += 1
-        # Restore titration states.
+        # Restore titration states from the cached parameters of the initial states.
         for titration_group_index in attempt_data.changing_groups:
-            self.set_titration_state(
-                titration_group_index,
-                attempt_data.initial_states[titration_group_index],
-                updateContextParameters=False,
-                updateIons=False,
-            )
+            initial_state_index = attempt_data.initial_states[titration_group_index]
+            self._update_forces(titration_group_index, initial_state_index)
+            self._set_group_state(titration_group_index, initial_state_index)
         # If maintaining charge neutrality using saltswap
         if self.swapper is not None:
 
@@ -3435,13 +5678,31 @@ class NCMCProtonDrive(_BaseDrive):
                 set_vector_indices=True,
             )
 
-        for force_index, force in enumerate(self.forces_to_update):
+        for force_index, force in self._forces_to_push(
+            ions_changed=self.swapper is not None
+        ):
             force.updateParametersInContext(self.context)
         # If using NCMC, restore coordinates and velocities.
         if self.perturbations_per_trial > 0:
+            self._restore_initial_configuration(attempt_data)
+
+    def _restore_initial_configuration(self, attempt_data: _TitrationAttemptData):
+        """Restore the positions, velocities, box vectors and global parameters from the start of an attempt.
+
+        Notes
+        -----
+        The simulation time is not restored.
+        """
+        state = attempt_data.initial_openmm_state
+        if state is not None and hasattr(self.context, "setState"):
+            time = self.context.getState().getTime()
+            self.context.setState(state)
+            self.context.setTime(time)
+        else:
+            # Older versions of OpenMM, or data from before recording the state
+            self.context.setPeriodicBoxVectors(*attempt_data.initial_box_vectors)
             self.context.setPositions(attempt_data.initial_positions)
             self.context.setVelocities(attempt_data.initial_velocities)
-            self.context.setPeriodicBoxVectors(*attempt_data.initial_box_vectors)
 
     def _set_state_accept_attempt(self, attempt_data: _TitrationAttemptData):
         """Ensure the correct state after accepting a move."""
@@ -3475,12 +5736,20 @@ class NCMCProtonDrive(_BaseDrive):
 
         # If using NCMC, flip velocities upon accepting to satisfy super-detailed balance.
         if self.perturbations_per_trial > 0:
-            self.context.setVelocities(
-                -self.context.getState(getVelocities=True).getVelocities(asNumpy=True)
-            )
+            # Reuse the velocities if they were already recorded
+            if attempt_data._proposed_velocities is not None:
+                self.context.setVelocities(-attempt_data.proposed_velocities)
+            else:
+                self.context.setVelocities(
+                    -self.context.getState(getVelocities=True).getVelocities(
+                        asNumpy=True
+                    )
+                )
 
         # Push any potentially missed chanfes to the context
-        for force_index, force in enumerate(self.forces_to_update):
+        for force_index, force in self._forces_to_push(
+            ions_changed=self.swapper is not None
+        ):
             force.updateParametersInContext(self.context)
 
     def _accept_reject(self, log_P_accept: float) -> bool:
@@ -3563,6 +5832,28 @@ class NCMCProtonDrive(_BaseDrive):
         # Reset to current state
         return ub_j
 
+    def _get_relative_reduced_potentials(self, group_index=0) -> np.ndarray:
+        """Retrieve the reduced potentials for all states of a group, up to a constant, from a single snapshot.
+
+        Parameters
+        ----------
+        group_index : int, optional
+            Index of the group that needs updating, defaults to 0.
+
+        Notes
+        -----
+        Energies are evaluated in a side context that only contains the forces that change between states,
+        so the context of the drive is not modified. The result differs from ``_get_reduced_potentials`` by a
+        constant that is the same for all states, which cancels out in state weights.
+        If ions are coupled to titration states, this falls back to ``_get_reduced_potentials``.
+        """
+        if self.swapper is not None:
+            return np.asarray(self._get_reduced_potentials(group_index), dtype=float)
+
+        if self._state_energy_evaluator is None:
+            self._state_energy_evaluator = _SideContextEnergyEvaluator(self)
+        return self._state_energy_evaluator.reduced_potentials(group_index)
+
     def _reduced_potential(self, state_index, group_index=0):
         """Retrieve the reduced potential for a given state (specified by index) in the given context.
 
@@ -3675,6 +5966,7 @@ class AmberProtonDrive(NCMCProtonDrive):
         perturbations_per_trial: int = 0,
         propagations_per_step: int = 1,
         sampling_method: SamplingMethod = SamplingMethod.MCMC,
+        parameter_update_method: ParameterUpdateMethod = ParameterUpdateMethod.FORCE_PARAMETERS,
     ):
         """
         Initialize a Monte Carlo titration driver for simulation of protonation states and tautomers.
@@ -3699,6 +5991,8 @@ class AmberProtonDrive(NCMCProtonDrive):
             Default: Replace charges with same sign charge.
         sampling_method : The method of sampling that is used.
             See the SamplingMethod enum for the set of supported options (including MCMC and importance sampling).
+        parameter_update_method : The method used to change force parameters between states.
+            See the ParameterUpdateMethod enum for the set of supported options.
 
         Things to do
         ------------
@@ -3714,6 +6008,7 @@ class AmberProtonDrive(NCMCProtonDrive):
             perturbations_per_trial=perturbations_per_trial,
             propagations_per_step=propagations_per_step,
             sampling_method=sampling_method,
+            parameter_update_method=parameter_update_method,
         )
 
         # Load AMBER cpin file defining protonation states.
@@ -3847,6 +6142,7 @@ class ForceFieldProtonDrive(NCMCProtonDrive):
         residues_by_name=None,
         residues_by_index=None,
         sampling_method: SamplingMethod = SamplingMethod.MCMC,
+        parameter_update_method: ParameterUpdateMethod = ParameterUpdateMethod.FORCE_PARAMETERS,
     ):
 
         """
@@ -3876,6 +6172,8 @@ class ForceFieldProtonDrive(NCMCProtonDrive):
             Residues by name in topology that should be treated as titratable
         sampling_method : The method of sampling that is used.
             See the SamplingMethod enum for the set of supported options (including MCMC and importance sampling).
+        parameter_update_method : The method used to change force parameters between states.
+            See the ParameterUpdateMethod enum for the set of supported options.
 
         Notes
         -----
@@ -3900,6 +6198,7 @@ class ForceFieldProtonDrive(NCMCProtonDrive):
             perturbations_per_trial=perturbations_per_trial,
             propagations_per_step=propagations_per_step,
             sampling_method=sampling_method,
+            parameter_update_method=parameter_update_method,
         )
 
         ffxml_residues = self._parse_ffxml_files(ffxml_files)
@@ -4261,6 +6560,16 @@ class TautomerNCMCProtonDrive(NCMCProtonDrive):
             if force.__class__.__name__ in force_classes_to_update:
                 self.forces_to_update.append(force)
 
+    def enable_ncmc_parameter_offsets(self):
+        """Not supported for tautomers, which also change bonded parameters."""
+        raise NotImplementedError(
+            "NCMC parameter offsets are not supported for tautomer drives."
+        )
+
+    def _get_relative_reduced_potentials(self, group_index=0) -> np.ndarray:
+        """Retrieve the reduced potentials for all states of a group, by switching states in the context."""
+        return np.asarray(self._get_reduced_potentials(group_index), dtype=float)
+
     def _cache_force(self, titration_group_index, titration_state_index):
         """
         Cache the force parameters for a single tautomer state.
@@ -5105,6 +7414,7 @@ class TautomerForceFieldProtonDrive(TautomerNCMCProtonDrive):
             cooh_movers,
         )
         self.titrationGroups[titration_group_index].add_state(state)
+        self._state_tables = None
         return
 
     def _generating_parameter_for_current_state(self, state_block):
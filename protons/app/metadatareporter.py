@@ -4,20 +4,25 @@
 import netCDF4
 import time
 import numpy as np
+from typing import Optional
+from .reportbuffer import BackgroundWriter, existing_group
 
 
 class MetadataReporter:
     """MetadataReporter outputs protonation state metadata for the system to a netCDF4 file.
     Writes only once at the start of the simulation."""
 
-    def __init__(self, netcdffile):
+    def __init__(self, netcdffile, writer: Optional[BackgroundWriter] = None):
         """Create a MetadataReporter.
 
         Parameters
         ----------
         netcdffile : string
             The netcdffile to write to
+        writer : BackgroundWriter, optional
+            The writer used by other reporters of the same file, which needs to be idle before writing.
         """
+        self._writer = writer
         if isinstance(netcdffile, str):
             self._out = netCDF4.Dataset(netcdffile, mode="w")
         elif isinstance(netcdffile, netCDF4.Dataset):
@@ -66,9 +71,13 @@ class MetadataReporter:
             The Simulation to generate a report for
         """
         if not self._hasInitialized:
+            if self._writer is not None:
+                self._writer.drain()
             self._initialize_constants(simulation)
-            self._create_netcdf_structure()
-            self._record_metadata(simulation)
+            # The metadata of an interrupted run that is continued is already there
+            if existing_group(self._out, "Protons/Metadata") is None:
+                self._create_netcdf_structure()
+                self._record_metadata(simulation)
             self._hasInitialized = True
 
         # Write the values.
@@ -150,21 +159,43 @@ class MetadataReporter:
         simulation - ConstantPHSimulation
         """
         drv = simulation.drive
+        ngroups = len(drv.titrationGroups)
+        natoms = max(
+            [len(residue.atom_indices) for residue in drv.titrationGroups] + [0]
+        )
+        nstates = max([len(residue) for residue in drv.titrationGroups] + [0])
+
+        # Collect everything in (masked) arrays, and write every variable at once.
+        g_k = np.ma.masked_all((ngroups, nstates), dtype=float)
+        proton_count = np.ma.masked_all((ngroups, nstates), dtype=int)
+        total_charge = np.ma.masked_all((ngroups, nstates), dtype=float)
+        atom_index = np.ma.masked_all((ngroups, natoms), dtype=int)
+        charge = np.ma.masked_all((ngroups, natoms, nstates), dtype=float)
 
         # Per residue variable
         for ires, residue in enumerate(drv.titrationGroups):
-            self._grp["residue_index"][ires] = residue.index
             self._grp["residue_type"][ires] = residue.residue_type
             self._grp["residue_name"][ires] = residue.name
             # Per residue, per atom variable
-            for iatom, atom_index in enumerate(residue.atom_indices):
-                self._grp["atom_index"][ires, iatom] = atom_index
+            atom_index[ires, : len(residue.atom_indices)] = residue.atom_indices
             # Per residue, per state variable
             for istate, state in enumerate(residue):
-                self._grp["g_k"][ires, istate] = state.g_k
-                self._grp["proton_count"][ires, istate] = state.proton_count
-                self._grp["total_charge"][ires, istate] = state.total_charge
+                g_k[ires, istate] = state.g_k
+                proton_count[ires, istate] = state.proton_count
+                total_charge[ires, istate] = state.total_charge
                 # Per residue, per state, per atom
-                for iatom, charge in enumerate(state.charges):
-                    self._grp["charge"][ires, iatom, istate] = charge
+                charge[ires, : len(state.charges), istate] = state.charges
+
+        if ngroups > 0:
+            self._grp["residue_index"][:] = [
+                residue.index for residue in drv.titrationGroups
+            ]
+        if natoms > 0:
+            self._grp["atom_index"][:, :] = atom_index
+        if nstates > 0:
+            self._grp["g_k"][:, :] = g_k
+            self._grp["proton_count"][:, :] = proton_count
+            self._grp["total_charge"][:, :] = total_charge
+        if natoms > 0 and nstates > 0:
+            self._grp["charge"][:, :, :] = charge
         return
@@ -0,0 +1,148 @@
+# coding=utf-8
+"""Self adjusted mixture sampling with multiple walkers that share their free energy estimates."""
+
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from .driver import SAMSApproach, _SAMSState
+from .logger import log
+from .simulation import ConstantPHSimulation
+
+
+class MultiWalkerSAMS:
+    """Runs a SAMS calibration with several independent walkers that share one set of free energy estimates.
+
+    Every walker is a ConstantPHSimulation with its own context, that has been prepared for the same calibration.
+    The walkers run in parallel threads, and adapt their own copy of the calibration state.
+    Every ``sync_interval`` iterations, the changes of all walkers (free energy updates, histogram counts and the
+    number of adaptations) are merged into the shared state, which is then copied back to every walker.
+
+    Notes
+    -----
+    Moving to the next SAMS stage is decided on the shared state, after merging.
+    Walkers only run in parallel while OpenMM is integrating, which releases the global interpreter lock.
+    """
+
+    def __init__(
+        self,
+        simulations: List[ConstantPHSimulation],
+        sync_interval: int = 10,
+        nthreads: Optional[int] = None,
+    ):
+        """Set up the walkers.
+
+        Parameters
+        ----------
+        simulations - the walkers, every simulation needs a drive with calibration enabled in the same way.
+            The calibration state of the first simulation is used as the starting point for all walkers.
+        sync_interval - the number of iterations every walker performs between merges.
+        nthreads - the number of threads that run walkers, defaults to one per walker.
+        """
+        if len(simulations) == 0:
+            raise ValueError("Please provide at least one simulation.")
+        if sync_interval < 1:
+            raise ValueError("The sync interval needs to be at least 1.")
+
+        first = simulations[0].drive.calibration_state
+        for simulation in simulations:
+            state = simulation.drive.calibration_state
+            if state is None or simulation.sams is None:
+                raise ValueError(
+                    "Please enable calibration on every drive before instantiating the simulations."
+                )
+            if state.approach is not first.approach or len(state) != len(first):
+                raise ValueError("All walkers need to calibrate the same states.")
+            if (
+                state.approach is SAMSApproach.ONESITE
+                and state.group_index != first.group_index
+            ):
+                raise ValueError("All walkers need to calibrate the same residue.")
+
+        self.simulations = simulations
+        self.sync_interval = sync_interval
+        self.nthreads = len(simulations) if nthreads is None else nthreads
+        self.calibration_state: _SAMSState = copy.deepcopy(first)
+        self.last_deviation: float = self.calibration_state.max_absolute_deviation
+        self.iteration = 0
+        self._snapshots: List[_SAMSState] = list()
+        self._broadcast()
+
+    def run(
+        self,
+        iterations: int,
+        md_steps: int = 1000,
+        pool: Optional[str] = None,
+        iteration: Optional[Callable[[ConstantPHSimulation], None]] = None,
+    ):
+        """Let every walker perform a number of iterations, merging the changes every ``sync_interval`` iterations.
+
+        Parameters
+        ----------
+        iterations - the number of iterations per walker
+        md_steps - the number of MD steps between protonation state updates.
+        pool - optional, the pool of residues to update.
+        iteration - optional, a function that performs the MD and updates of a single iteration of a walker,
+            replacing the default of ``md_steps`` steps followed by one update.
+            The SAMS adaptation is performed after calling it.
+        """
+        if iteration is None:
+
+            def iteration(simulation: ConstantPHSimulation):
+                simulation.step(md_steps)
+                simulation.update(1, pool=pool)
+
+        remaining = iterations
+        with ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+            while remaining > 0:
+                rounds = min(self.sync_interval, remaining)
+                futures = [
+                    executor.submit(self._run_walker, simulation, rounds, iteration)
+                    for simulation in self.simulations
+                ]
+                # Raises the exception of a walker, if any
+                for future in futures:
+                    future.result()
+                self.merge()
+                remaining -= rounds
+                self.iteration += rounds
+
+    @staticmethod
+    def _run_walker(
+        simulation: ConstantPHSimulation,
+        iterations: int,
+        iteration: Callable[[ConstantPHSimulation], None],
+    ):
+        """Perform iterations of a single walker, without changing the SAMS stage."""
+        for _ in range(iterations):
+            iteration(simulation)
+            simulation.adapt(update_stage=False, return_gk=False)
+
+    def merge(self):
+        """Add the changes of all walkers to the shared calibration state, and copy it to the walkers."""
+        changes = [
+            simulation.drive.calibration_state.changes_since(snapshot)
+            for simulation, snapshot in zip(self.simulations, self._snapshots)
+        ]
+        self.calibration_state.merge_changes(changes)
+        self.last_deviation = self.calibration_state.max_absolute_deviation
+        self.calibration_state.update_stage(self.last_deviation)
+        log.debug(
+            "Merged %d walkers at adaptation %d, %2f%% deviation"
+            % (
+                len(self.simulations),
+                self.calibration_state._current_adaptation,
+                self.last_deviation * 100,
+            )
+        )
+        self._broadcast()
+
+    def _broadcast(self):
+        """Copy the shared calibration state to every walker."""
+        for simulation in self.simulations:
+            simulation.drive.calibration_state.assign(self.calibration_state)
+            simulation.last_dev = self.last_deviation
+        self._snapshots = [
+            copy.deepcopy(simulation.drive.calibration_state)
+            for simulation in self.simulations
+        ]
@@ -5,7 +5,9 @@ import netCDF4
 import time
 import numpy as np
 from copy import deepcopy
+from typing import Optional
 from protons.app import ConstantPHSimulation
+from .reportbuffer import ReportBuffer, BackgroundWriter, existing_group
 
 
 class NCMCReporter:
@@ -17,6 +19,11 @@ class NCMCReporter:
         reportInterval: int,
         cumulativeworkInterval: int = 0,
         store_coords: bool = False,
+        flush_interval: int = 1,
+        sync_interval: Optional[int] = 1,
+        sync_seconds: Optional[float] = None,
+        chunk_size: Optional[int] = None,
+        writer: Optional[BackgroundWriter] = None,
     ):
         """Create a TitrationReporter.
 
@@ -31,8 +38,25 @@ class NCMCReporter:
             Set to 0 for not storing.
         store_coords:
             Store the coordinates at the start and end of an NCMC attempt.
+        flush_interval : int
+            The number of reports to keep in memory before writing them to the file.
+        sync_interval : int, optional
+            Synchronize the file to disk every this many reports.
+        sync_seconds : float, optional
+            Synchronize the file to disk if this many seconds have passed since the last sync.
+        chunk_size : int, optional
+            The chunk size along the update dimension, defaults to the flush interval.
+        writer : BackgroundWriter, optional
+            Write in a separate thread. Reporters that share a file need to share the writer.
         """
         self._reportInterval: int = reportInterval
+        self._buffer = ReportBuffer(
+            flush_interval=flush_interval,
+            sync_interval=sync_interval,
+            sync_seconds=sync_seconds,
+            chunk_size=chunk_size,
+            writer=writer,
+        )
         self._store_coords: bool = store_coords
         if isinstance(netcdffile, str):
             self._out = netCDF4.Dataset(netcdffile, mode="w")
@@ -62,6 +86,10 @@ class NCMCReporter:
         """The netCDF file currently being written to."""
         return self._out
 
+    def flush(self):
+        """Write any buffered reports to the file, and synchronize it to disk."""
+        self._buffer.close()
+
     def describeNextReport(self, simulation):
         """Get information about the next report this object will generate.
 
@@ -74,10 +102,11 @@ class NCMCReporter:
         -------
         tuple
             A tuple. The first element is the number of steps
-            until the next report.
+            until the next report. The second element is True if the
+            coordinates at the end of the attempt are needed.
         """
         updates = self._reportInterval - simulation.currentUpdate % self._reportInterval
-        return tuple([updates])
+        return tuple([updates, self._store_coords])
 
     def report(self, simulation):
         """Generate a report.
@@ -88,9 +117,15 @@ class NCMCReporter:
             The Simulation to generate a report for
         """
         if not self._hasInitialized:
+            # The structure is created directly in the file
+            self._buffer.wait()
             self._initialize_constants(simulation)
-            self._create_netcdf_structure()
-            self._record_metadata(simulation)
+            grp = existing_group(self._out, "Protons/NCMC")
+            if grp is None:
+                self._create_netcdf_structure()
+                self._record_metadata(simulation)
+            else:
+                self._resume_netcdf_structure(grp)
             self._hasInitialized = True
 
         # Gather and record all data for the current update
@@ -98,8 +133,8 @@ class NCMCReporter:
         # Update number of written updates
         self._update += 1
 
-        # Write the values.
-        self._out.sync()
+        # Write the values, depending on the buffer settings.
+        self._buffer.commit()
 
     def _write_update(self, simulation):
         """Record data for the current update in the netCDF file.
@@ -110,52 +145,59 @@ class NCMCReporter:
             The Simulation to generate a report for
         """
         drv = simulation.drive
-        iupdate = self._update
+        buffer = self._buffer
         # The iteration of the protonation state update attempt. [update]
-        self._grp["update"][iupdate] = simulation.currentUpdate
-        for ires, residue in enumerate(drv.titrationGroups):
-            # The present state of the residue. [update,residue]
-            self._grp["state"][iupdate,] = residue.state_index
+        buffer.append("update", simulation.currentUpdate)
+        # The present state of the residue. [update,residue]
+        buffer.append(
+            "state", [residue.state_index for residue in drv.titrationGroups]
+        )
 
         # first array is initial states, second is proposed state, last is work
-        self._grp["initial_state"][iupdate, :] = drv._last_attempt_data.initial_states
-        self._grp["proposed_state"][iupdate, :] = drv._last_attempt_data.proposed_states
-        self._grp["total_work"][iupdate,] = drv._last_attempt_data.work
-        self._grp["logp_ratio_residue_proposal"][
-            iupdate,
-        ] = drv._last_attempt_data.logp_ratio_residue_proposal
+        buffer.append("initial_state", drv._last_attempt_data.initial_states)
+        buffer.append("proposed_state", drv._last_attempt_data.proposed_states)
+        buffer.append("total_work", drv._last_attempt_data.work)
+        buffer.append(
+            "logp_ratio_residue_proposal",
+            drv._last_attempt_data.logp_ratio_residue_proposal,
+        )
 
         if self._has_swapper:
-            self._grp["logp_ratio_salt_proposal"][
-                iupdate,
-            ] = drv._last_attempt_data.logp_ratio_salt_proposal
-            self._grp["initial_ion_states"][
-                iupdate, :
-            ] = drv._last_attempt_data.initial_ion_states
-            self._grp["proposed_ion_states"][
-                iupdate, :
-            ] = drv._last_attempt_data.proposed_ion_states
+            buffer.append(
+                "logp_ratio_salt_proposal",
+                drv._last_attempt_data.logp_ratio_salt_proposal,
+            )
+            buffer.append(
+                "initial_ion_states", drv._last_attempt_data.initial_ion_states
+            )
+            buffer.append(
+                "proposed_ion_states", drv._last_attempt_data.proposed_ion_states
+            )
 
         if self._store_coords:
-            self._grp["initial_positions"][
-                :, :
-            ] = drv._last_attempt_data.initial_positions[:, :]
-            self._grp["proposed_positions"][
-                :, :
-            ] = drv._last_attempt_data.proposed_positions[:, :]
-            self._grp["initial_box_vectors"][
-                :, :
-            ] = drv._last_attempt_data.initial_box_vectors[:, :]
-            self._grp["proposed_box_vectors"][
-                :, :
-            ] = drv._last_attempt_data.proposed_box_vectors[:, :]
-
-        self._grp["logp_accept"][iupdate,] = drv._last_attempt_data.logp_accept
+            coordinates = dict(
+                initial_positions=drv._last_attempt_data.initial_positions,
+                proposed_positions=drv._last_attempt_data.proposed_positions,
+                initial_box_vectors=drv._last_attempt_data.initial_box_vectors,
+                proposed_box_vectors=drv._last_attempt_data.proposed_box_vectors,
+            )
+            if buffer.writer is not None:
+                buffer.writer.submit(self._write_coordinates, coordinates)
+            else:
+                self._write_coordinates(coordinates)
+
+        buffer.append("logp_accept", drv._last_attempt_data.logp_accept)
 
         if self._cumulative_work_interval > 0:
-            self._grp["cumulative_work"][iupdate, :] = np.asarray(
-                drv.ncmc_stats_per_step
-            )[self._perturbation_steps, 0]
+            buffer.append(
+                "cumulative_work",
+                np.asarray(drv.ncmc_stats_per_step)[self._perturbation_steps, 0],
+            )
+
+    def _write_coordinates(self, coordinates):
+        """Overwrite the stored coordinates with those of the latest attempt."""
+        for name, values in coordinates.items():
+            self._grp[name][:, :] = values[:, :]
 
     def _initialize_constants(self, simulation: ConstantPHSimulation):
         """Initialize a set of constants required for the reports
@@ -177,6 +219,17 @@ class NCMCReporter:
             self._has_swapper = True
             self._nsaltsites = len(driver.swapper.stateVector)
 
+    def _resume_netcdf_structure(self, grp):
+        """Continue writing to the group of an interrupted run that is resumed.
+
+        Parameters
+        ----------
+        grp - the existing netCDF group
+        """
+        self._grp = grp
+        self._update = len(grp.dimensions["update"])
+        self._buffer.attach(self._out, grp, nrows=self._update)
+
     def _create_netcdf_structure(self):
         """Construct the netCDF directory structure and variables
         """
@@ -212,50 +265,90 @@ class NCMCReporter:
             prop_box = grp.createVariable("proposed_box_vectors", float, ("abc", "xyz"))
             prop_box.description = "The proposed box vectors"
 
+        chunks = self._buffer.chunksizes
+
         # Variables written every update
-        update = grp.createVariable("update", int, ("update",))
+        update = grp.createVariable(
+            "update",
+            int,
+            ("update",),
+            chunksizes=chunks(grp, ("update",), int),
+        )
         update.description = (
             "The iteration of the protonation state update attempt. [update]"
         )
-        residue_state = grp.createVariable("state", int, ("update", "residue"))
+        residue_state = grp.createVariable(
+            "state",
+            int,
+            ("update", "residue"),
+            chunksizes=chunks(grp, ("update", "residue"), int),
+        )
         residue_state.description = "The present state of the residue. [update,residue]"
         residue_initial_state = grp.createVariable(
-            "initial_state", int, ("update", "residue")
+            "initial_state",
+            int,
+            ("update", "residue"),
+            chunksizes=chunks(grp, ("update", "residue"), int),
         )
         residue_initial_state.description = (
             "The state of the residue, before switching.[update,residue]"
         )
         residue_proposed_state = grp.createVariable(
-            "proposed_state", int, ("update", "residue")
+            "proposed_state",
+            int,
+            ("update", "residue"),
+            chunksizes=chunks(grp, ("update", "residue"), int),
         )
         residue_proposed_state.description = (
             "The proposed state of the residue. [update,residue]"
         )
         if self._has_swapper:
             salt_initial_states = grp.createVariable(
-                "initial_ion_states", int, ("update", "ion_site")
+                "initial_ion_states",
+                int,
+                ("update", "ion_site"),
+                chunksizes=chunks(grp, ("update", "ion_site"), int),
             )
             salt_proposed_states = grp.createVariable(
-                "proposed_ion_states", int, ("update", "ion_site")
+                "proposed_ion_states",
+                int,
+                ("update", "ion_site"),
+                chunksizes=chunks(grp, ("update", "ion_site"), int),
             )
             salt_initial_states.description = "The initial state of water molecules treated by saltswap. [update, ion_site]"
             salt_proposed_states.description = "The proposed state of water molecules treated by saltswap. [update,ion_site]"
 
-        total_work = grp.createVariable("total_work", float, ("update",))
+        total_work = grp.createVariable(
+            "total_work",
+            float,
+            ("update",),
+            chunksizes=chunks(grp, ("update",), float),
+        )
         total_work.description = "The work of the protocol, including Δg_k. [update]"
         total_work.unit = "unitless (W/kT)"
         logp_ratio_residue = grp.createVariable(
-            "logp_ratio_residue_proposal", float, ("update",)
+            "logp_ratio_residue_proposal",
+            float,
+            ("update",),
+            chunksizes=chunks(grp, ("update",), float),
         )
         logp_ratio_residue.description = "The log P ratio (reverse/forward) of proposing this residue and state. [update]"
         if self._has_swapper:
             logp_ratio_salt = grp.createVariable(
-                "logp_ratio_salt_proposal", float, ("update",)
+                "logp_ratio_salt_proposal",
+                float,
+                ("update",),
+                chunksizes=chunks(grp, ("update",), float),
             )
             logp_ratio_salt.description = (
                 "The log P ratio (reverse/forward) of proposing this ion swap. [update]"
             )
-        logp_accept = grp.createVariable("logp_accept", float, ("update",))
+        logp_accept = grp.createVariable(
+            "logp_accept",
+            float,
+            ("update",),
+            chunksizes=chunks(grp, ("update",), float),
+        )
         logp_accept.description = (
             "The log P acceptance ratio for accepting the full NCMC move. [update]"
         )
@@ -266,7 +359,11 @@ class NCMCReporter:
                 "perturbation", len(self._perturbation_steps)
             )
             cumulative_work = grp.createVariable(
-                "cumulative_work", float, ("update", "perturbation"), zlib=True
+                "cumulative_work",
+                float,
+                ("update", "perturbation"),
+                zlib=True,
+                chunksizes=chunks(grp, ("update", "perturbation"), float),
             )
             cumulative_work.description = "Cumulative work at the end of each NCMC perturbation step.[update,perturbation]"
             cumulative_work.unit = "unitless (W/kT)"
@@ -276,6 +373,7 @@ class NCMCReporter:
             )
 
         self._grp = grp
+        self._buffer.attach(self._out, grp)
         self._out.sync()
 
         return
@@ -0,0 +1,254 @@
+# coding=utf-8
+"""Buffered writing of reporter data along the unlimited dimension of netCDF variables."""
+
+import queue
+import threading
+import time
+import numpy as np
+from typing import Callable, Dict, Optional, Tuple
+
+# Upper bound for the size of a single HDF5 chunk, the default HDF5 chunk cache is 1 MiB.
+_max_chunk_bytes = 2 ** 20
+
+
+def existing_group(dataset, path: str):
+    """Return the group at the given path of the dataset, or None if it does not exist."""
+    grp = dataset
+    for name in path.split("/"):
+        if name not in grp.groups:
+            return None
+        grp = grp.groups[name]
+    return grp
+
+
+class BackgroundWriter:
+    """Performs the netCDF writes of reporters in a separate thread, so the simulation can continue meanwhile.
+
+    Notes
+    -----
+    The netCDF library is not thread safe. All reporters that write to the same file need to share a writer,
+    and wait for it (using ``drain``) before accessing the file directly.
+    """
+
+    def __init__(self, max_pending: int = 8):
+        """Start the writer thread.
+
+        Parameters
+        ----------
+        max_pending - the maximum number of queued writes. Submitting more blocks until the oldest is written.
+        """
+        if max_pending < 1:
+            raise ValueError("The number of pending writes needs to be at least 1.")
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error: Optional[Exception] = None
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="protons-report-writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, func: Callable, *args):
+        """Queue a function call for the writer thread. Blocks if too many writes are pending."""
+        self._raise_error()
+        if self._closed:
+            raise RuntimeError("The writer has been closed.")
+        self._queue.put((func, args))
+
+    def drain(self):
+        """Wait until all queued writes have been performed."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Perform all queued writes, and stop the writer thread."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _run(self):
+        """Perform queued writes until receiving None."""
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                # After an error, the remaining writes are skipped.
+                if self._error is None:
+                    func, args = task
+                    func(*args)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        """Raise errors from the writer thread in the calling thread."""
+        if self._error is not None:
+            raise RuntimeError("Writing reports failed.") from self._error
+
+
+class ReportBuffer:
+    """Collects rows of reporter data in memory, and writes them to a netCDF group in batches.
+
+    Every report adds one row to each buffered variable, along the unlimited dimension of the group.
+    Rows are collected in preallocated arrays, and written once ``flush_interval`` reports have been collected.
+    The file is synchronized to disk according to the sync policy.
+    Optionally, writes are performed in the background by a ``BackgroundWriter``.
+    """
+
+    def __init__(
+        self,
+        flush_interval: int = 1,
+        sync_interval: Optional[int] = 1,
+        sync_seconds: Optional[float] = None,
+        chunk_size: Optional[int] = None,
+        writer: Optional[BackgroundWriter] = None,
+    ):
+        """Set up the buffer.
+
+        Parameters
+        ----------
+        flush_interval - the number of reports that are collected before writing them to the file.
+        sync_interval - synchronize the file to disk every this many reports. None to not sync on count.
+        sync_seconds - synchronize the file to disk if this many seconds passed since the last sync.
+            None to not sync on time. The file is also synchronized by ``close``.
+        chunk_size - number of rows per chunk along the unlimited dimension. Defaults to ``flush_interval``.
+            Chunks are limited to 1 MiB.
+        writer - optional, perform writes in the background using this writer.
+        """
+        if flush_interval < 1:
+            raise ValueError("The flush interval needs to be at least 1.")
+        if sync_interval is not None and sync_interval < 1:
+            raise ValueError("The sync interval needs to be at least 1, or None.")
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError("The chunk size needs to be at least 1, or None.")
+
+        self.flush_interval = flush_interval
+        self.sync_interval = sync_interval
+        self.sync_seconds = sync_seconds
+        self.chunk_size = chunk_size if chunk_size is not None else flush_interval
+        self.writer = writer
+
+        self._dataset = None
+        self._grp = None
+        self._dtypes: Dict[str, np.dtype] = dict()
+        # Preallocated rows, by variable name
+        self._rows: Dict[str, np.ndarray] = dict()
+        self._nbuffered = 0  # rows in the buffer
+        self._nwritten = 0  # rows written to the file
+        self._unsynced = 0  # rows written since the last sync
+        self._last_sync = time.time()
+
+    @property
+    def nrows(self) -> int:
+        """The total number of rows, including those that are still buffered."""
+        return self._nwritten + self._nbuffered
+
+    def attach(self, dataset, grp, nrows: int = 0):
+        """Write to the given group of an open netCDF dataset.
+
+        Parameters
+        ----------
+        dataset - the open netCDF dataset
+        grp - the group to write to
+        nrows - the number of rows that the group already contains, new rows are written after them.
+        """
+        self._dataset = dataset
+        self._grp = grp
+        self._nwritten = nrows
+        # Data types are looked up once, the group should not be accessed while a writer is active.
+        self._dtypes = {
+            name: variable.dtype for name, variable in grp.variables.items()
+        }
+
+    def chunksizes(self, grp, dimensions: Tuple[str, ...], datatype) -> Tuple[int, ...]:
+        """Chunk sizes for a new variable, with the unlimited dimension first.
+
+        Parameters
+        ----------
+        grp - the netCDF group that holds the dimensions
+        dimensions - names of the dimensions of the variable
+        datatype - the datatype of the variable
+        """
+        sizes = [max(1, len(grp.dimensions[name])) for name in dimensions[1:]]
+        row_bytes = np.dtype(datatype).itemsize * int(np.prod(sizes, dtype=np.int64))
+        rows = min(self.chunk_size, max(1, _max_chunk_bytes // max(1, row_bytes)))
+        return tuple([rows] + sizes)
+
+    def wait(self):
+        """Wait for background writes to finish, before accessing the file directly."""
+        if self.writer is not None:
+            self.writer.drain()
+
+    def append(self, name: str, value):
+        """Add the value of a variable for the current report."""
+        row = np.asarray(value)
+        if name not in self._rows:
+            self._rows[name] = np.empty(
+                (self.flush_interval,) + row.shape, dtype=self._dtypes[name]
+            )
+        self._rows[name][self._nbuffered] = row
+
+    def commit(self):
+        """Finish the current report, and write the buffer to the file if it is full."""
+        self._nbuffered += 1
+        if self._nbuffered >= self.flush_interval:
+            self.flush(sync=False)
+        self._maybe_sync()
+
+    def flush(self, sync: bool = True):
+        """Write all buffered rows to the file.
+
+        Parameters
+        ----------
+        sync - synchronize the file to disk after writing.
+        """
+        if self._nbuffered > 0:
+            start = self._nwritten
+            rows = {
+                name: values[: self._nbuffered] for name, values in self._rows.items()
+            }
+            if self.writer is not None:
+                # Hand the rows over to the writer, and collect new rows in new arrays.
+                self._rows = dict()
+                self.writer.submit(self._write_rows, start, rows)
+            else:
+                self._write_rows(start, rows)
+            self._nwritten += self._nbuffered
+            self._unsynced += self._nbuffered
+            self._nbuffered = 0
+        if sync and self._dataset is not None:
+            self._sync()
+
+    def close(self):
+        """Write all buffered rows and synchronize the file. The dataset is not closed."""
+        self.flush(sync=True)
+        self.wait()
+
+    def _write_rows(self, start: int, rows: Dict[str, np.ndarray]):
+        """Write rows to the file, starting at the given index of the unlimited dimension."""
+        for name, values in rows.items():
+            self._grp[name][start : start + values.shape[0]] = values
+
+    def _maybe_sync(self):
+        """Synchronize written rows to disk according to the sync policy."""
+        if self._unsynced == 0:
+            return
+        if self.sync_interval is not None and self._unsynced >= self.sync_interval:
+            self._sync()
+        elif (
+            self.sync_seconds is not None
+            and time.time() - self._last_sync >= self.sync_seconds
+        ):
+            self._sync()
+
+    def _sync(self):
+        """Synchronize the dataset to disk."""
+        if self.writer is not None:
+            self.writer.submit(self._dataset.sync)
+        else:
+            self._dataset.sync()
+        self._unsynced = 0
+        self._last_sync = time.time()
@@ -5,14 +5,25 @@ import netCDF4
 import time
 import numpy as np
 from copy import deepcopy
+from typing import Optional
 from protons.app.simulation import ConstantPHSimulation
 from protons.app.driver import Stage, UpdateRule, SAMSApproach
+from .reportbuffer import ReportBuffer, BackgroundWriter, existing_group
 
 
 class SAMSReporter:
     """SamsReporter outputs SAMS data from a ConstantPHCalibration to a netCDF4 file."""
 
-    def __init__(self, netcdffile, reportInterval):
+    def __init__(
+        self,
+        netcdffile,
+        reportInterval,
+        flush_interval: int = 1,
+        sync_interval: Optional[int] = 1,
+        sync_seconds: Optional[float] = None,
+        chunk_size: Optional[int] = None,
+        writer: Optional[BackgroundWriter] = None,
+    ):
         """Create a TitrationReporter.
 
         Parameters
@@ -21,9 +32,25 @@ class SAMSReporter:
             The netcdffile to write to
         reportInterval : int
             The interval (in adaptation steps) at which to write frames
-        
+        flush_interval : int
+            The number of reports to keep in memory before writing them to the file.
+        sync_interval : int, optional
+            Synchronize the file to disk every this many reports.
+        sync_seconds : float, optional
+            Synchronize the file to disk if this many seconds have passed since the last sync.
+        chunk_size : int, optional
+            The chunk size along the adaptation dimension, defaults to the flush interval.
+        writer : BackgroundWriter, optional
+            Write in a separate thread. Reporters that share a file need to share the writer.
         """
         self._reportInterval = reportInterval
+        self._buffer = ReportBuffer(
+            flush_interval=flush_interval,
+            sync_interval=sync_interval,
+            sync_seconds=sync_seconds,
+            chunk_size=chunk_size,
+            writer=writer,
+        )
         if isinstance(netcdffile, str):
             self._out = netCDF4.Dataset(netcdffile, mode="w")
         elif isinstance(netcdffile, netCDF4.Dataset):
@@ -45,6 +72,10 @@ class SAMSReporter:
         """The netCDF file currently being written to."""
         return self._out
 
+    def flush(self):
+        """Write any buffered reports to the file, and synchronize it to disk."""
+        self._buffer.close()
+
     def describeNextReport(self, calibration: ConstantPHSimulation):
         """Get information about the next report this object will generate.
 
@@ -75,9 +106,15 @@ class SAMSReporter:
             The Simulation to generate a report for
         """
         if not self._hasInitialized:
+            # The structure is created directly in the file
+            self._buffer.wait()
             self._initialize_constants(calibration)
-            self._create_netcdf_structure()
-            self._record_metadata(calibration)
+            grp = existing_group(self._out, "Protons/SAMS")
+            if grp is None:
+                self._create_netcdf_structure()
+                self._record_metadata(calibration)
+            else:
+                self._resume_netcdf_structure(grp)
             self._hasInitialized = True
 
         # Gather and record all data for the current update
@@ -85,8 +122,8 @@ class SAMSReporter:
         # Update number of written updates
         self._adaptation += 1
 
-        # Write the values.
-        self._out.sync()
+        # Write the values, depending on the buffer settings.
+        self._buffer.commit()
 
     def _write_adaptation(self, simulation: ConstantPHSimulation):
         """Record data for the current update in the netCDF file.
@@ -98,17 +135,18 @@ class SAMSReporter:
         """
         drv = simulation.drive
         sams = simulation.sams
-        iadapt = self._adaptation
+        buffer = self._buffer
         # The iteration of the protonation state update attempt. [update]
-        self._grp["adaptation"][
-            iadapt
-        ] = simulation.drive.calibration_state._current_adaptation
-        self._grp["g_k"][iadapt, :] = deepcopy(
-            simulation.drive.calibration_state.free_energies[:]
-        )
-        self._grp["flatness"][iadapt] = simulation.last_dev
-        self._grp["stage"][iadapt] = simulation.drive.calibration_state._stage.value
+        buffer.append(
+            "adaptation", simulation.drive.calibration_state._current_adaptation
+        )
+        buffer.append(
+            "g_k", deepcopy(simulation.drive.calibration_state.free_energies[:])
+        )
+        buffer.append("flatness", simulation.last_dev)
+        buffer.append("stage", simulation.drive.calibration_state._stage.value)
         if simulation.drive.calibration_state._stage == Stage.FASTDECAY:
+            buffer.wait()
             self._grp["end_of_slowdecay"][
                 0
             ] = simulation.drive.calibration_state._end_of_slowdecay
@@ -130,9 +168,20 @@ class SAMSReporter:
             group_index = np.nan
         self._group_index = group_index
         self._ngroups = len(simulation.drive.titrationGroups)
-        self._nstates = drive.calibration_state.free_energies.size
+        self._nstates = len(drive.calibration_state.free_energies)
         self._perturbation_steps = drive.perturbations_per_trial
 
+    def _resume_netcdf_structure(self, grp):
+        """Continue writing to the group of an interrupted run that is resumed.
+
+        Parameters
+        ----------
+        grp - the existing netCDF group
+        """
+        self._grp = grp
+        self._adaptation = len(grp.dimensions["adaptation"])
+        self._buffer.attach(self._out, grp, nrows=self._adaptation)
+
     def _create_netcdf_structure(self):
         """Construct the netCDF directory structure and variables
         """
@@ -148,15 +197,32 @@ class SAMSReporter:
         adapt_dim = grp.createDimension("adaptation")
         state_dim = grp.createDimension("state", self._nstates)
 
+        chunks = self._buffer.chunksizes
+
         # Variables written every adaptation
-        adaptation = grp.createVariable("adaptation", int, ("adaptation",))
+        adaptation = grp.createVariable(
+            "adaptation",
+            int,
+            ("adaptation",),
+            chunksizes=chunks(grp, ("adaptation",), int),
+        )
         adaptation.description = "The current adaptation step of the SAMS algorithm."
 
-        g_k = grp.createVariable("g_k", float, ("adaptation", "state"))
+        g_k = grp.createVariable(
+            "g_k",
+            float,
+            ("adaptation", "state"),
+            chunksizes=chunks(grp, ("adaptation", "state"), float),
+        )
         g_k.description = (
             "Weight of each individual state, relative to g_0. [adaptation, state]"
         )
-        flatness = grp.createVariable("flatness", float, ("adaptation",))
+        flatness = grp.createVariable(
+            "flatness",
+            float,
+            ("adaptation",),
+            chunksizes=chunks(grp, ("adaptation",), float),
+        )
         flatness.description = "Measure of how flat the histogram is. (Sum over all deviations from target)."
 
         approach = grp.createVariable("approach", int)
@@ -169,7 +235,12 @@ class SAMSReporter:
         group = grp.createVariable("group_index", int)
         group.description = "The index of the titration group that is being calibrated in the drive. (not the topology index)."
 
-        stage = grp.createVariable("stage", int, ("adaptation"))
+        stage = grp.createVariable(
+            "stage",
+            int,
+            ("adaptation",),
+            chunksizes=chunks(grp, ("adaptation",), int),
+        )
         stage.description = (
             "Current stage in the SAMS protocol (burn-in (0) or slow-gain(1))."
         )
@@ -196,6 +267,7 @@ class SAMSReporter:
         minburn.description = "The minimum number of steps of burn-in that are run before flatness is estimated."
 
         self._grp = grp
+        self._buffer.attach(self._out, grp)
         self._out.sync()
 
         return
@@ -3,7 +3,7 @@
 
 from simtk.openmm.app import Simulation
 from simtk import openmm
-from .driver import SAMSApproach, Stage, UpdateRule, NCMCProtonDrive, SamplingMethod
+from .driver import SAMSApproach, UpdateRule, NCMCProtonDrive, SamplingMethod
 from .calibration import SAMSCalibrationEngine
 from protons.app import proposals
 from protons.app.logger import log
@@ -91,11 +91,11 @@ class ConstantPHSimulation(Simulation):
         if self.drive.calibration_state is not None:
             self.sams = SAMSCalibrationEngine(drive)
             self.last_dev = self.drive.calibration_state.max_absolute_deviation
-            self.last_gk = None  # weights at last iteration if sams
         else:
             self.sams = None
             self.last_dev = None
-            self.last_gk = None
+        # Set once the weights have been adapted, see last_gk
+        self._adapted = False
 
         self.calibration_reporters = list()  # keeps track of calibration results
 
@@ -153,7 +153,12 @@ class ConstantPHSimulation(Simulation):
                 updatesToGo -= 1
                 if endTime is not None and datetime.now() >= endTime:
                     return
+            # Only the last attempt before a report is reported
+            self.drive.record_proposed_coordinates = (
+                anyReport and self._needs_coordinates(nextReport, nextUpdates)
+            )
             self.drive.update(move, residue_pool=pool, nattempts=updatesToGo)
+            self.drive.record_proposed_coordinates = False
 
             self.currentUpdate += nextUpdates
             if anyReport:
@@ -161,6 +166,17 @@ class ConstantPHSimulation(Simulation):
                     if nextR[0] == nextUpdates:
                         reporter.report(self)
 
+    @staticmethod
+    def _needs_coordinates(nextReport, nextUpdates) -> bool:
+        """Return True if a reporter that reports after nextUpdates updates needs the coordinates of the attempt.
+
+        Reporters can declare this need as the optional second element of the tuple from ``describeNextReport``.
+        """
+        return any(
+            nextR[0] == nextUpdates and len(nextR) > 1 and nextR[1]
+            for nextR in nextReport
+        )
+
     def _scan(self, endTime=None):
         """Systematic scan over all protonation states possible."""
         numScanStates: int = np.product([len(r) for r in self.drive.titrationGroups])
@@ -184,7 +200,11 @@ class ConstantPHSimulation(Simulation):
                     if nextReport[i][0] == 1:
                         anyReport = True
 
+                self.drive.record_proposed_coordinates = (
+                    anyReport and self._needs_coordinates(nextReport, 1)
+                )
                 self.drive.calculate_weight_in_state(state_combination)
+                self.drive.record_proposed_coordinates = False
 
                 self.currentUpdate += 1
                 if anyReport:
@@ -192,9 +212,22 @@ class ConstantPHSimulation(Simulation):
                         if nextR[0] == 1:
                             reporter.report(self)
 
-    def adapt(self):
+    def adapt(self, update_stage: bool = True, return_gk: bool = True):
         """
         Adapt the weights for the residue that is being calibrated.
+
+        Parameters
+        ----------
+        update_stage : bool, default True
+            Move to the next stage of SAMS once its criteria are met.
+            Disable this if the stages are controlled elsewhere, e.g. by ``MultiWalkerSAMS``.
+        return_gk : bool, default True
+            Return the weights after adaptation. For multisite calibrations, this builds the array of all joint states.
+            Disable this if the weights are not needed every adaptation, they remain available as ``last_gk``.
+
+        Returns
+        -------
+        tuple - the maximum absolute deviation from the target histogram, and the weights (None if return_gk is False).
         """
         if self.drive.calibration_state is None:
             raise ValueError("Proton drive has no calibration state attached.")
@@ -211,50 +244,8 @@ class ConstantPHSimulation(Simulation):
                 anyReport = True
 
         # Check stages
-        # If the histogram is flat below the criterion
-        # Flatness is defined as the sum of absolute deviations
-        # if minimum iterations have been performed, start SAMS decay
-        if (
-            self.drive.calibration_state._current_adaptation == 0
-            and self.drive.calibration_state._stage is Stage.NODECAY
-        ):
-            log.info("Burn-in iterations complete, starting SAMS.")
-            self.drive.calibration_state._stage = Stage.SLOWDECAY
-            self.drive.calibration_state.reset_observed_counts()
-        # If flatter than criterion, decay the gain faster
-        elif (
-            self.last_dev < self.drive.calibration_state._flatness_criterion
-            and self.drive.calibration_state._stage == Stage.SLOWDECAY
-            and self.drive.calibration_state._current_adaptation
-            > self.drive.calibration_state._min_slow
-        ):
-            log.info(
-                "Histogram flat below {}. Initiating the fast-decay phase at iteration {}.".format(
-                    self.drive.calibration_state._flatness_criterion,
-                    self.drive.calibration_state._current_adaptation,
-                )
-            )
-            self.drive.calibration_state._stage = Stage.FASTDECAY
-            self.drive.calibration_state.reset_observed_counts()
-            self.drive.calibration_state._end_of_slowdecay = int(
-                self.drive.calibration_state._current_adaptation
-            )
-        # If 3x flatter than criterion, stop adapting
-        elif (
-            self.last_dev < self.drive.calibration_state._flatness_criterion / 3
-            and self.drive.calibration_state._stage == Stage.FASTDECAY
-            and self.drive.calibration_state._current_adaptation
-            > self.drive.calibration_state._end_of_slowdecay
-            + self.drive.calibration_state._min_fast
-        ):
-            log.info(
-                "Histogram flat below {}. Initiating the equilibrium phase at iteration {}.".format(
-                    self.drive.calibration_state._flatness_criterion / 3,
-                    self.drive.calibration_state._current_adaptation,
-                )
-            )
-            self.drive.calibration_state._stage = Stage.EQUILIBRIUM
-            self.drive.calibration_state.reset_observed_counts()
+        if update_stage:
+            self.drive.calibration_state.update_stage(self.last_dev)
 
         # No adaptation performed if the simulation is in equilibrium
 
@@ -265,12 +256,22 @@ class ConstantPHSimulation(Simulation):
             b=self.drive.calibration_state._beta_sams,
             end_of_slowdecay=self.drive.calibration_state._end_of_slowdecay,
         )
-
-        self.last_gk = self.drive.calibration_state.free_energies
+        self._adapted = True
 
         if anyReport:
             for reporter, nextR in zip(self.calibration_reporters, nextReport):
                 if nextR[0] == 1:
                     reporter.report(self)
 
-        return self.last_dev, self.last_gk
+        return self.last_dev, self.last_gk if return_gk else None
+
+    @property
+    def last_gk(self) -> Optional[np.ndarray]:
+        """The weights (g_k) after the last adaptation, or None if no adaptation has been performed.
+
+        The weights are only gathered when requested, since for multisite calibrations this builds
+        the array of all joint states.
+        """
+        if self.sams is None or not self._adapted:
+            return None
+        return self.drive.calibration_state.free_energies
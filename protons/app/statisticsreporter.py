@@ -0,0 +1,246 @@
+# coding=utf-8
+"""A reporter for ConstantPHSimulation that keeps running statistics in memory."""
+
+import json
+import os
+import time
+import numpy as np
+from typing import Dict, Optional
+
+
+class StatisticsReporter:
+    """StatisticsReporter keeps running statistics of the titration state updates of a ConstantPHSimulation.
+
+    Per residue, it counts the occupancy of every state, and for every transition (initial state, proposed state)
+    the number of attempts, the number of accepted attempts, and the running mean and variance of the work.
+    The statistics are available through the API, and can periodically be written to a JSON or NPZ snapshot.
+
+    Notes
+    -----
+    The reporter needs to see every update, so it reports after every update.
+    When multiple residues change in one attempt, the work of the attempt is counted for the transition of each of them.
+    """
+
+    def __init__(
+        self, snapshotfile: Optional[str] = None, snapshotInterval: int = 1000
+    ):
+        """Create a StatisticsReporter.
+
+        Parameters
+        ----------
+        snapshotfile : string, optional
+            Write snapshots of the statistics to this file. The format is JSON, or NPZ if the name ends with '.npz'.
+            The file is replaced atomically.
+        snapshotInterval : int
+            The interval (in update steps) at which to write snapshots.
+        """
+        if snapshotInterval < 1:
+            raise ValueError("The snapshot interval needs to be at least 1.")
+        self._snapshotfile = snapshotfile
+        self._snapshotInterval = snapshotInterval
+        self._hasInitialized = False
+        self._update = 0  # Number of updates recorded
+        self._last_attempt = None  # The attempt that was recorded last
+        self._start_time = None
+        self._ngroups = 0
+        self._nstates = 0
+
+    def describeNextReport(self, simulation):
+        """Get information about the next report this object will generate.
+
+        Parameters
+        ----------
+        simulation : ConstantPHSimulation
+            The Simulation to generate a report for
+
+        Returns
+        -------
+        tuple
+            A tuple. The first element is the number of steps
+            until the next report. The second element is True if the
+            coordinates at the end of the attempt are needed.
+        """
+        return tuple([1, False])
+
+    def report(self, simulation):
+        """Record the latest update.
+
+        Parameters
+        ----------
+        simulation : ConstantPHSimulation
+            The Simulation to generate a report for
+        """
+        if not self._hasInitialized:
+            self._initialize_constants(simulation)
+            self._hasInitialized = True
+
+        self._record_update(simulation)
+        self._update += 1
+
+        if (
+            self._snapshotfile is not None
+            and self._update % self._snapshotInterval == 0
+        ):
+            self.write_snapshot()
+
+    def _initialize_constants(self, simulation):
+        """Initialize the counters for the residues of the simulation.
+
+        Parameters
+        - simulation (ConstantPHSimulation) The simulation to generate a report for
+        """
+        groups = simulation.drive.titrationGroups
+        self._ngroups = len(groups)
+        self._nstates = max([len(group) for group in groups] + [1])
+        # The number of states of every residue, states beyond this are padding.
+        self._states_per_residue = np.asarray(
+            [len(group) for group in groups], dtype=int
+        )
+        # Occupancy of every state after an update [residue, state]
+        self._state_counts = np.zeros((self._ngroups, self._nstates), dtype=np.int64)
+        transitions = (self._ngroups, self._nstates, self._nstates)
+        # Attempts and accepted attempts [residue, initial state, proposed state]
+        self._attempts = np.zeros(transitions, dtype=np.int64)
+        self._accepts = np.zeros(transitions, dtype=np.int64)
+        # Running mean and sum of squared deviations of the work, using Welford's algorithm
+        self._work_counts = np.zeros(transitions, dtype=np.int64)
+        self._work_mean = np.zeros(transitions, dtype=float)
+        self._work_m2 = np.zeros(transitions, dtype=float)
+        self._start_time = time.time()
+
+    def _record_update(self, simulation):
+        """Add the latest attempt, and the current states to the statistics."""
+        drv = simulation.drive
+        states = np.asarray(drv.titrationStates, dtype=int)
+        self._state_counts[np.arange(self._ngroups), states] += 1
+
+        attempt = drv._last_attempt_data
+        # Attempts are only counted once, even if the simulation reports without updating.
+        if attempt is None or attempt is self._last_attempt:
+            return
+        self._last_attempt = attempt
+        if attempt._initial_states is None or attempt._changing_groups is None:
+            return
+
+        work = attempt.work
+        for group in attempt.changing_groups:
+            transition = (
+                group,
+                attempt.initial_states[group],
+                attempt.proposed_states[group],
+            )
+            self._attempts[transition] += 1
+            if attempt.accepted:
+                self._accepts[transition] += 1
+            if work is not None and np.isfinite(work):
+                self._work_counts[transition] += 1
+                count = self._work_counts[transition]
+                delta = work - self._work_mean[transition]
+                self._work_mean[transition] += delta / count
+                self._work_m2[transition] += delta * (
+                    work - self._work_mean[transition]
+                )
+
+    @property
+    def nupdates(self) -> int:
+        """The number of updates recorded."""
+        return self._update
+
+    @property
+    def updates_per_second(self) -> float:
+        """The average number of updates per second of wall time, since the first report."""
+        if self._start_time is None:
+            return 0.0
+        elapsed = time.time() - self._start_time
+        return self._update / elapsed if elapsed > 0.0 else 0.0
+
+    @property
+    def state_counts(self) -> np.ndarray:
+        """The number of updates after which each residue was in each state. [residue, state]"""
+        return self._state_counts.copy()
+
+    @property
+    def state_populations(self) -> np.ndarray:
+        """The fraction of updates after which each residue was in each state. [residue, state]"""
+        return self._state_counts / max(1, self._update)
+
+    @property
+    def attempts(self) -> np.ndarray:
+        """The number of attempted transitions. [residue, initial state, proposed state]"""
+        return self._attempts.copy()
+
+    @property
+    def accepts(self) -> np.ndarray:
+        """The number of accepted transitions. [residue, initial state, proposed state]"""
+        return self._accepts.copy()
+
+    @property
+    def acceptance_rates(self) -> np.ndarray:
+        """The fraction of accepted attempts, NaN without attempts. [residue, initial state, proposed state]"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self._attempts > 0, self._accepts / self._attempts, np.nan)
+
+    @property
+    def work_mean(self) -> np.ndarray:
+        """The mean work of transitions, NaN without attempts. [residue, initial state, proposed state]"""
+        return np.where(self._work_counts > 0, self._work_mean, np.nan)
+
+    @property
+    def work_variance(self) -> np.ndarray:
+        """The sample variance of the work, NaN for less than two attempts. [residue, initial state, proposed state]"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(
+                self._work_counts > 1, self._work_m2 / (self._work_counts - 1), np.nan
+            )
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        """Return all statistics as a dictionary of arrays."""
+        if not self._hasInitialized:
+            raise RuntimeError("No updates have been recorded yet.")
+        return dict(
+            nupdates=np.asarray(self.nupdates),
+            updates_per_second=np.asarray(self.updates_per_second),
+            states_per_residue=self._states_per_residue.copy(),
+            state_counts=self.state_counts,
+            state_populations=self.state_populations,
+            attempts=self.attempts,
+            accepts=self.accepts,
+            acceptance_rates=self.acceptance_rates,
+            work_mean=self.work_mean,
+            work_variance=self.work_variance,
+        )
+
+    def write_snapshot(self, filename: Optional[str] = None):
+        """Write the statistics to a JSON file, or an NPZ file if the name ends with '.npz'.
+
+        Parameters
+        ----------
+        filename - optional, the file to write to. Defaults to the snapshot file of the reporter.
+
+        Notes
+        -----
+        The snapshot is written to a temporary file first, which then replaces the file.
+        Readers never see a partially written snapshot.
+        """
+        if filename is None:
+            filename = self._snapshotfile
+        if filename is None:
+            raise ValueError("Please provide a filename for the snapshot.")
+
+        snapshot = self.snapshot()
+        temporary = "{}.tmp".format(filename)
+        with open(temporary, "wb") as snapshotfile:
+            if filename.endswith(".npz"):
+                np.savez(snapshotfile, **snapshot)
+            else:
+                # NaN is not valid JSON, and is stored as null.
+                data = {
+                    name: (
+                        np.where(np.isnan(values), None, values).tolist()
+                        if values.dtype.kind == "f"
+                        else values.tolist()
+                    )
+                    for name, values in snapshot.items()
+                }
+                snapshotfile.write(json.dumps(data).encode("utf-8"))
+        os.replace(temporary, filename)
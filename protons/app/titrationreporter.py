@@ -8,6 +8,8 @@ from simtk.openmm import NonbondedForce
 from math import floor
 from simtk.unit import elementary_charge
 from copy import deepcopy
+from typing import Optional
+from .reportbuffer import ReportBuffer, BackgroundWriter, existing_group
 
 # openmm aliases for water in pdbnames
 # ion names from ions xml files in protons.
@@ -33,7 +35,17 @@ _solvent_names = [
 class TitrationReporter:
     """TitrationReporter outputs protonation states of residues in the system to a netCDF4 file."""
 
-    def __init__(self, netcdffile, reportInterval):
+    def __init__(
+        self,
+        netcdffile,
+        reportInterval,
+        flush_interval: int = 1,
+        sync_interval: Optional[int] = 1,
+        sync_seconds: Optional[float] = None,
+        chunk_size: Optional[int] = None,
+        writer: Optional[BackgroundWriter] = None,
+        dense_atom_status: bool = False,
+    ):
         """Create a TitrationReporter.
 
         Parameters
@@ -42,8 +54,30 @@ class TitrationReporter:
             The netcdffile to write to
         reportInterval : int
             The interval (in time steps) at which to write frames        
+        flush_interval : int
+            The number of reports to keep in memory before writing them to the file.
+        sync_interval : int, optional
+            Synchronize the file to disk every this many reports.
+        sync_seconds : float, optional
+            Synchronize the file to disk if this many seconds have passed since the last sync.
+        chunk_size : int, optional
+            The chunk size along the update dimension, defaults to the flush interval.
+        writer : BackgroundWriter, optional
+            Write in a separate thread. Reporters that share a file need to share the writer.
+        dense_atom_status : bool
+            Store the status of every atom in the topology for every update. By default, the status of the
+            titratable atoms in every state is stored once, which with the states determines the atom status.
+            Use ``read_atom_status`` to retrieve the status of every atom in either case.
         """
         self._reportInterval = reportInterval
+        self._dense_atom_status = dense_atom_status
+        self._buffer = ReportBuffer(
+            flush_interval=flush_interval,
+            sync_interval=sync_interval,
+            sync_seconds=sync_seconds,
+            chunk_size=chunk_size,
+            writer=writer,
+        )
         if isinstance(netcdffile, str):
             self._out = netCDF4.Dataset(netcdffile, mode="w")
         elif isinstance(netcdffile, netCDF4.Dataset):
@@ -63,6 +97,10 @@ class TitrationReporter:
         """The netCDF file currently being written to."""
         return self._out
 
+    def flush(self):
+        """Write any buffered reports to the file, and synchronize it to disk."""
+        self._buffer.close()
+
     def describeNextReport(self, simulation):
         """Get information about the next report this object will generate.
 
@@ -89,16 +127,23 @@ class TitrationReporter:
             The Simulation to generate a report for
         """
         if not self._hasInitialized:
+            # The structure is created directly in the file
+            self._buffer.wait()
             self._initialize_constants(simulation)
-            self._create_netcdf_structure()
+            grp = existing_group(self._out, "Protons/Titration")
+            if grp is None:
+                self._create_netcdf_structure()
+                self._record_metadata(simulation)
+            else:
+                self._resume_netcdf_structure(grp)
             self._hasInitialized = True
 
         # Gather and record all data for the current update
         self._write_update(simulation)
         self._update += 1
 
-        # Write the values.
-        self._out.sync()
+        # Write the values, depending on the buffer settings.
+        self._buffer.commit()
 
     def _write_update(self, simulation):
         """Record data for the current update in the netCDF file.
@@ -109,43 +154,59 @@ class TitrationReporter:
             The Simulation to generate a report for
         """
         drv = simulation.drive
-        iupdate = self._update
+        buffer = self._buffer
         # The iteration of the protonation state update attempt. [update]
-        self._grp["update"][iupdate] = simulation.currentUpdate
-        all_stat = np.ones(self._natoms_topology, dtype=np.bool_)
-        for ires, residue in enumerate(drv.titrationGroups):
-            # The present state of the residue. [update,residue]
-            self._grp["state"][iupdate, ires] = residue.state_index
-            # Indicator of whether an atom is on/off (charged) at present. [update,residue,atom]
-            for iatom, status in enumerate(residue.atom_status):
-                if status != 1:
-                    topo_index = residue.atom_indices[iatom]
-                    all_stat[topo_index] = False
-        self._grp["atom_status"][iupdate, :] = deepcopy(all_stat[:])
-        # From simtk.openmm.app.modeller
-        self._grp["complex_charge"][iupdate] = self._get_total_charge(
-            self._all_minus_solvent_indices
+        buffer.append("update", simulation.currentUpdate)
+        # The present state of the residue. [update,residue]
+        states = np.asarray(drv.titrationStates, dtype=int)
+        buffer.append("state", states)
+        if self._dense_atom_status:
+            all_stat = np.ones(self._natoms_topology, dtype=np.bool_)
+            for ires, residue in enumerate(drv.titrationGroups):
+                # Indicator of whether an atom is on/off (charged) at present. [update,residue,atom]
+                for iatom, status in enumerate(residue.atom_status):
+                    if status != 1:
+                        topo_index = residue.atom_indices[iatom]
+                        all_stat[topo_index] = False
+            buffer.append("atom_status", all_stat)
+        # Charges follow from the charges of the current states
+        groups = np.arange(self._ngroups)
+        buffer.append(
+            "complex_charge",
+            self._round_charge(
+                self._background_charge
+                + self._complex_state_charges[groups, states].sum()
+            ),
         )
 
         # Store the charge of every residue pool
-        for pool, indices in self._pool_indices.items():
-            self._grp["{}_charge".format(pool)][iupdate] = self._get_total_charge(
-                indices
+        for pool, state_charges in self._pool_state_charges.items():
+            buffer.append(
+                "{}_charge".format(pool),
+                self._round_charge(state_charges[groups, states].sum()),
             )
 
         # Store salt identities
         if self._nsaltsites > 0:
-            self._grp["ionic_species"][iupdate, :] = deepcopy(
-                drv.swapper.stateVector[:]
+            buffer.append("ionic_species", deepcopy(drv.swapper.stateVector[:]))
+
+    @staticmethod
+    def _round_charge(charge: float) -> int:
+        """Returns total charge as integer."""
+        return int(floor(0.5 + charge))
+
+    def _state_charge_table(self, particle_indices) -> np.ndarray:
+        """Returns the charge of the given particles per state, as [residue, state]."""
+        particle_indices = set(particle_indices)
+        table = np.zeros((self._ngroups, self._nstates), dtype=float)
+        for ires, residue in enumerate(self.driver.titrationGroups):
+            mask = np.asarray(
+                [atom_index in particle_indices for atom_index in residue.atom_indices],
+                dtype=bool,
             )
-
-    def _get_total_charge(self, particle_indices):
-        """Returns total charge as integer for specified particles."""
-        charges = (
-            self.nonbonded.getParticleParameters(i)[0].value_in_unit(elementary_charge)
-            for i in particle_indices
-        )
-        return int(floor(0.5 + sum(charges)))
+            for istate, state in enumerate(residue):
+                table[ires, istate] = np.asarray(state.charges, dtype=float)[mask].sum()
+        return table
 
     def _initialize_constants(self, simulation):
         """Initialize a set of constants required for the reports
@@ -178,6 +239,11 @@ class TitrationReporter:
                 for atom in res.atoms():
                     self._all_minus_solvent_indices.append(atom.index)
 
+        self._ntitratable_atoms = sum(
+            len(group.atom_indices) for group in self.driver.titrationGroups
+        )
+        self._nstates = max([len(group) for group in self.driver.titrationGroups] + [1])
+
         # store the indices of every atom in the pool
         self._pool_indices = dict()
         for pool, resindices in self._residue_pools.items():
@@ -186,6 +252,65 @@ class TitrationReporter:
                 atom_indices.extend(self.driver.titrationGroups[resid].atom_indices)
             self._pool_indices[pool] = atom_indices
 
+        # The charge of titratable atoms is determined by the state of their residue.
+        # The charge of the other atoms in the complex is constant.
+        titratable_indices = set()
+        for group in self.driver.titrationGroups:
+            titratable_indices.update(group.atom_indices)
+        self._background_charge = sum(
+            self.nonbonded.getParticleParameters(i)[0].value_in_unit(elementary_charge)
+            for i in self._all_minus_solvent_indices
+            if i not in titratable_indices
+        )
+        self._complex_state_charges = self._state_charge_table(
+            self._all_minus_solvent_indices
+        )
+        self._pool_state_charges = {
+            pool: self._state_charge_table(indices)
+            for pool, indices in self._pool_indices.items()
+        }
+
+    def _record_metadata(self, simulation):
+        """Records all metadata that doesn't depend on the update dimension, into the netCDF file.
+
+        Parameters
+        ----------
+        simulation - ConstantPHSimulation
+        """
+        if self._dense_atom_status:
+            return
+        atom_index = np.empty(self._ntitratable_atoms, dtype=int)
+        atom_residue = np.empty(self._ntitratable_atoms, dtype=int)
+        atom_status = np.ma.masked_all(
+            (self._ntitratable_atoms, self._nstates), dtype=np.uint8
+        )
+        offset = 0
+        for ires, residue in enumerate(simulation.drive.titrationGroups):
+            natoms = len(residue.atom_indices)
+            atom_index[offset : offset + natoms] = residue.atom_indices
+            atom_residue[offset : offset + natoms] = ires
+            for istate, state in enumerate(residue):
+                atom_status[offset : offset + natoms, istate] = [
+                    0 if abs(charge) < 1.0e-9 else 1 for charge in state.charges
+                ]
+            offset += natoms
+        if self._ntitratable_atoms > 0:
+            self._grp["titratable_atom_index"][:] = atom_index
+            self._grp["titratable_atom_residue"][:] = atom_residue
+            self._grp["titratable_atom_status"][:, :] = atom_status
+        self._out.sync()
+
+    def _resume_netcdf_structure(self, grp):
+        """Continue writing to the group of an interrupted run that is resumed.
+
+        Parameters
+        ----------
+        grp - the existing netCDF group
+        """
+        self._grp = grp
+        self._update = len(grp.dimensions["update"])
+        self._buffer.attach(self._out, grp, nrows=self._update)
+
     def _create_netcdf_structure(self):
         """Construct the netCDF directory structure and variables
         """
@@ -202,41 +327,124 @@ class TitrationReporter:
         if self._nsaltsites > 0:
             ion_dim = grp.createDimension("ion_site", self._nsaltsites)
 
+        chunks = self._buffer.chunksizes
+
         # Variables written every update
-        update = grp.createVariable("update", int, ("update",))
+        update = grp.createVariable(
+            "update", int, ("update",), chunksizes=chunks(grp, ("update",), int)
+        )
         update.description = (
             "The iteration of the protonation state update attempt. [update]"
         )
 
-        residue_state = grp.createVariable("state", int, ("update", "residue"))
+        residue_state = grp.createVariable(
+            "state",
+            int,
+            ("update", "residue"),
+            chunksizes=chunks(grp, ("update", "residue"), int),
+        )
         residue_state.description = "The present state of the residue. [update,residue]"
 
         if self._nsaltsites > 0:
-            ion_state = grp.createVariable("ionic_species", int, ("update", "ion_site"))
+            ion_state = grp.createVariable(
+                "ionic_species",
+                int,
+                ("update", "ion_site"),
+                chunksizes=chunks(grp, ("update", "ion_site"), int),
+            )
             ion_state.description = (
                 "The present state of a water/ion molecule."
                 "Typical saltswap convention: 0 means water, 1 is cation, 2 is anion. [update, ion_site]"
             )
 
-        atom_status = grp.createVariable(
-            "atom_status", "u1", ("update", "atom"), zlib=True
+        if self._dense_atom_status:
+            atom_status = grp.createVariable(
+                "atom_status",
+                "u1",
+                ("update", "atom"),
+                zlib=True,
+                chunksizes=chunks(grp, ("update", "atom"), "u1"),
+            )
+            atom_status.description = "Byte indicator (1/0) of whether an atom is on/off (charged) at present, where the atom index is equal to the topology.[update,atom]"
+        else:
+            titratable_atom_dim = grp.createDimension(
+                "titratable_atom", self._ntitratable_atoms
+            )
+            state_dim = grp.createDimension("state", self._nstates)
+            titratable_atom_index = grp.createVariable(
+                "titratable_atom_index", int, ("titratable_atom",)
+            )
+            titratable_atom_index.description = (
+                "The topology index of every titratable atom. [titratable_atom]"
+            )
+            titratable_atom_residue = grp.createVariable(
+                "titratable_atom_residue", int, ("titratable_atom",)
+            )
+            titratable_atom_residue.description = "The index of the residue that a titratable atom belongs to. [titratable_atom]"
+            titratable_atom_status = grp.createVariable(
+                "titratable_atom_status", "u1", ("titratable_atom", "state")
+            )
+            titratable_atom_status.description = "Byte indicator (1/0) of whether a titratable atom is on/off (charged) in each state of its residue. [titratable_atom,state]"
+            titratable_atom_status.note = "Combine with the state variable to find the atom status per update, see read_atom_status."
+
+        complex_charge = grp.createVariable(
+            "complex_charge",
+            int,
+            ("update",),
+            chunksizes=chunks(grp, ("update",), int),
         )
-        atom_status.description = "Byte indicator (1/0) of whether an atom is on/off (charged) at present, where the atom index is equal to the topology.[update,atom]"
-
-        complex_charge = grp.createVariable("complex_charge", int, ("update"))
         complex_charge.description = (
             "Total charge of all atoms in the complex. [update]"
         )
         complex_charge.note = "This value excludes solvent and ions, includes residues that are not titratable."
 
         for pool in self._residue_pools:
-            pool_charge = grp.createVariable("{}_charge".format(pool), int, ("update"))
+            pool_charge = grp.createVariable(
+                "{}_charge".format(pool),
+                int,
+                ("update",),
+                chunksizes=chunks(grp, ("update",), int),
+            )
             pool_charge.description = "Total charge of all titratable residue atoms in the '{}' pool. [update]"
             pool_charge.note = (
                 "This variable only includes information about titratable residues."
             )
 
         self._grp = grp
+        self._buffer.attach(self._out, grp)
         self._out.sync()
 
         return
+
+
+def read_atom_status(dataset, updates=slice(None)) -> np.ndarray:
+    """Return the status of every atom as stored by a TitrationReporter, for either storage format.
+
+    Parameters
+    ----------
+    dataset - netCDF4.Dataset with a 'Protons/Titration' group
+    updates - optional, index or slice of the updates to read
+
+    Returns
+    -------
+    np.ndarray of bytes, indicating whether an atom is on/off (charged), indexed as [update, atom],
+    where the atom index is equal to the topology index.
+    """
+    grp = dataset["Protons/Titration"]
+    if "atom_status" in grp.variables:
+        return np.atleast_2d(
+            np.asarray(grp["atom_status"][updates, :], dtype=np.uint8)
+        )
+
+    states = np.atleast_2d(np.asarray(grp["state"][updates, :], dtype=int))
+    natoms = len(grp.dimensions["atom"])
+    atom_status = np.ones((states.shape[0], natoms), dtype=np.uint8)
+    if len(grp.dimensions["titratable_atom"]) == 0:
+        return atom_status
+    atom_index = np.asarray(grp["titratable_atom_index"][:], dtype=int)
+    atom_residue = np.asarray(grp["titratable_atom_residue"][:], dtype=int)
+    status_per_state = np.ma.filled(grp["titratable_atom_status"][:, :], 1)
+    atom_status[:, atom_index] = status_per_state[
+        np.arange(atom_index.size), states[:, atom_residue]
+    ]
+    return atom_status
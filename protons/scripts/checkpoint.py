@@ -0,0 +1,868 @@
+"""Compact checkpoint files for restarting protons simulations.
+
+A checkpoint is a zip archive. Coordinates and the force parameters of the drive are stored as binary numpy arrays,
+and the serialized OpenMM objects, drive and topology are stored as compressed text. Optionally, the serialized System is kept in a separate store,
+under its content hash, so that successive checkpoints of the same system do not each contain a copy.
+
+The XML checkpoint format of ``create_protons_checkpoint_file`` can be converted to and from this format.
+
+Checkpoints written during a run record the progress of the run, so an interrupted run can be resumed.
+They share the System serialized at the first checkpoint of the run, see `PeriodicCheckpointer.save_simulation`.
+"""
+
+import datetime
+import hashlib
+import io
+import json
+import netCDF4
+import os
+import time
+import zipfile
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from lxml import etree
+from simtk import openmm as mm, unit
+from typing import Callable, Dict, Optional, Tuple
+from .. import app
+from ..app import log
+from ..app.driver import _PackedForceParameters, _TitratableResidue
+from .utilities import (
+    serialize_integrator,
+    serialize_system,
+    store_topology,
+    xml_to_topology,
+)
+
+# Identifies the file format, and its version
+_format_name = "protons-checkpoint"
+_format_version = 2
+
+
+def system_hash(system_xml: str) -> str:
+    """Return the content hash that identifies a serialized System."""
+    return hashlib.sha256(system_xml.encode("utf-8")).hexdigest()
+
+
+def is_binary_checkpoint(filename: str) -> bool:
+    """Returns True if the file is a binary checkpoint, False if it is not (e.g. an XML checkpoint)."""
+    return zipfile.is_zipfile(filename)
+
+
+class ProtonsCheckpoint:
+    """The contents of a checkpoint of a protons simulation.
+
+    Positions, velocities and box vectors are stored in nanometer (per picosecond).
+    """
+
+    def __init__(self):
+        """Create an empty checkpoint. Use `from_simulation`, `read` or `from_xml` instead."""
+        self.runtype: str = "protons-v1"
+        self.date: str = str(datetime.datetime.now())
+        self.drive_xml: str = ""
+        # The force parameters of the drive as arrays, if they are not part of drive_xml
+        self.drive_force_arrays: Optional[Dict[str, np.ndarray]] = None
+        self.integrator_xml: str = ""
+        self.system_xml: str = ""
+        self.topology_string: str = ""
+        self.topology_format: str = "pdbx"
+        self.positions: Optional[np.ndarray] = None
+        self.velocities: Optional[np.ndarray] = None
+        self.box_vectors: Optional[np.ndarray] = None
+        self.time: float = 0.0  # picosecond
+        self.parameters: Dict[str, float] = dict()
+        self.salt_concentration: Optional[float] = None  # molar
+        self.saltswap_state_vector: Optional[np.ndarray] = None
+        # The saltswap state of the ions in system_xml, if it is older than saltswap_state_vector
+        self.system_saltswap_state_vector: Optional[np.ndarray] = None
+        # Progress of the run at the time of the checkpoint, see `PeriodicCheckpointer`
+        self.progress: Dict = dict()
+
+    @classmethod
+    def from_simulation(
+        cls,
+        drive: app.NCMCProtonDrive,
+        context: mm.Context,
+        system: mm.System,
+        integrator: mm.CustomIntegrator,
+        topology_string: str,
+        salinator=None,
+        topology_format: str = "pdbx",
+    ) -> "ProtonsCheckpoint":
+        """Collect the current state of a simulation.
+
+        Parameters
+        ----------
+        drive - the proton drive of the simulation
+        context - the context of the simulation
+        system - the system of the simulation
+        integrator - the integrator of the simulation
+        topology_string - the contents of a topology file, such as pdbx.
+        salinator - optional, the salinator of the simulation.
+        topology_format - the format of the topology file, 'pdbx' or 'pdb'.
+        """
+        drive_force_arrays = _drive_force_arrays(drive)
+        snapshot = SimulationSnapshot(
+            drive,
+            context,
+            integrator,
+            salinator=salinator,
+            include_forces=drive_force_arrays is None,
+        )
+        return snapshot.to_checkpoint(
+            serialize_system(system),
+            topology_string,
+            topology_format=topology_format,
+            drive_force_arrays=drive_force_arrays,
+        )
+
+    def write(self, filename: str, system_store: Optional[str] = None):
+        """Write the checkpoint to a file.
+
+        Parameters
+        ----------
+        filename - the name of the checkpoint file
+        system_store - optional, a directory to store the serialized System in, under its content hash.
+            The System is only written to the store if it is not there yet.
+            By default, the System is stored inside of the checkpoint.
+
+        Notes
+        -----
+        The checkpoint is written to a temporary file first, which then replaces the file.
+        """
+        digest = system_hash(self.system_xml)
+        header = dict(
+            format=_format_name,
+            version=_format_version,
+            runtype=self.runtype,
+            date=self.date,
+            system_sha256=digest,
+            system_store=None,
+            topology_format=self.topology_format,
+            time_ps=self.time,
+            parameters=self.parameters,
+            salt_concentration_molar=self.salt_concentration,
+            progress=self.progress,
+        )
+
+        if system_store is not None:
+            _store_system(system_store, digest, self.system_xml)
+            # Relative to the checkpoint, so the files can be moved together.
+            header["system_store"] = os.path.relpath(
+                system_store, os.path.dirname(os.path.abspath(filename))
+            )
+
+        temporary = "{}.tmp".format(filename)
+        with zipfile.ZipFile(temporary, "w") as archive:
+            archive.writestr("header.json", json.dumps(header, indent=1))
+            # Arrays are stored uncompressed for fast reading
+            for name in ["positions", "velocities", "box_vectors"]:
+                archive.writestr(
+                    "{}.npy".format(name), _array_bytes(getattr(self, name))
+                )
+            for name in ["saltswap_state_vector", "system_saltswap_state_vector"]:
+                if getattr(self, name) is not None:
+                    archive.writestr(
+                        "{}.npy".format(name), _array_bytes(getattr(self, name))
+                    )
+            if self.drive_force_arrays is not None:
+                stream = io.BytesIO()
+                np.savez(stream, **self.drive_force_arrays)
+                archive.writestr("drive_forces.npz", stream.getvalue())
+            text = [
+                ("drive.xml", self.drive_xml),
+                ("integrator.xml", self.integrator_xml),
+                ("topology", self.topology_string),
+            ]
+            if system_store is None:
+                text.append(("system.xml", self.system_xml))
+            for name, contents in text:
+                archive.writestr(name, contents, compress_type=zipfile.ZIP_DEFLATED)
+        os.replace(temporary, filename)
+
+    @classmethod
+    def read(cls, filename: str) -> "ProtonsCheckpoint":
+        """Read a checkpoint written by `write`.
+
+        Parameters
+        ----------
+        filename - the name of the checkpoint file
+        """
+        obj = cls()
+        with zipfile.ZipFile(filename, "r") as archive:
+            header = json.loads(archive.read("header.json").decode("utf-8"))
+            if header.get("format") != _format_name:
+                raise ValueError("{} is not a protons checkpoint.".format(filename))
+            if header["version"] > _format_version:
+                raise ValueError(
+                    "This checkpoint was written by a newer version of protons."
+                )
+
+            obj.runtype = header["runtype"]
+            obj.date = header["date"]
+            obj.topology_format = header["topology_format"]
+            obj.time = header["time_ps"]
+            obj.parameters = header["parameters"]
+            obj.salt_concentration = header["salt_concentration_molar"]
+            obj.progress = header.get("progress", dict())
+
+            for name in ["positions", "velocities", "box_vectors"]:
+                setattr(obj, name, _read_array(archive, "{}.npy".format(name)))
+            for name in ["saltswap_state_vector", "system_saltswap_state_vector"]:
+                if "{}.npy".format(name) in archive.namelist():
+                    setattr(obj, name, _read_array(archive, "{}.npy".format(name)))
+
+            obj.drive_xml = archive.read("drive.xml").decode("utf-8")
+            if "drive_forces.npz" in archive.namelist():
+                with np.load(
+                    io.BytesIO(archive.read("drive_forces.npz")), allow_pickle=False
+                ) as arrays:
+                    obj.drive_force_arrays = dict(arrays)
+            obj.integrator_xml = archive.read("integrator.xml").decode("utf-8")
+            obj.topology_string = archive.read("topology").decode("utf-8")
+            if header["system_store"] is None:
+                obj.system_xml = archive.read("system.xml").decode("utf-8")
+
+        if header["system_store"] is not None:
+            store = os.path.join(
+                os.path.dirname(os.path.abspath(filename)), header["system_store"]
+            )
+            obj.system_xml = _load_system(store, header["system_sha256"])
+        return obj
+
+    @classmethod
+    def from_xml(cls, filename: str) -> "ProtonsCheckpoint":
+        """Read a checkpoint in the XML format of ``create_protons_checkpoint_file``.
+
+        Parameters
+        ----------
+        filename - the name of the XML checkpoint file
+        """
+        with open(filename, "rb") as checkpoint:
+            tree = etree.fromstring(checkpoint.read())
+
+        obj = cls()
+        obj.runtype = tree.get("runtype", obj.runtype)
+        obj.date = tree.get("date", obj.date)
+        obj.drive_xml = _element_text(tree.xpath("NCMCProtonDrive")[0])
+        obj.integrator_xml = _element_text(tree.xpath("Integrator")[0])
+        obj.system_xml = _element_text(tree.xpath("System")[0])
+
+        topology_element = tree.xpath("TopologyFile")[0]
+        obj.topology_string = topology_element.text
+        obj.topology_format = topology_element.get("format").lower()
+
+        state = tree.xpath("State")[0]
+        obj.time = float(state.get("time"))
+        parameters = state.xpath("Parameters")
+        if len(parameters):
+            obj.parameters = {
+                name: float(value) for name, value in parameters[0].attrib.items()
+            }
+        obj.box_vectors = _vectors_from_xml(state.xpath("PeriodicBoxVectors/*"))
+        obj.positions = _vectors_from_xml(state.xpath("Positions/Position"))
+        obj.velocities = _vectors_from_xml(state.xpath("Velocities/Velocity"))
+
+        saltswap = tree.xpath("Saltswap")
+        if len(saltswap):
+            obj.salt_concentration = float(saltswap[0].get("salt_concentration_molar"))
+            obj.saltswap_state_vector = np.fromstring(
+                saltswap[0].xpath("StateVector")[0].text, dtype=int, sep=" "
+            )
+            system_vector = saltswap[0].xpath("SystemStateVector")
+            if len(system_vector):
+                obj.system_saltswap_state_vector = np.fromstring(
+                    system_vector[0].text, dtype=int, sep=" "
+                )
+
+        progress = tree.xpath("Progress")
+        if len(progress):
+            obj.progress = json.loads(progress[0].text)
+        return obj
+
+    def to_xml(self, filename: str):
+        """Write the checkpoint in the XML format of ``create_protons_checkpoint_file``.
+
+        Parameters
+        ----------
+        filename - the name of the XML checkpoint file
+
+        Notes
+        -----
+        The checkpoint is written to a temporary file first, which then replaces the file.
+        """
+        tree = etree.Element("Checkpoint", runtype=self.runtype, date=self.date)
+        tree.append(self._full_drive_element())
+        tree.append(etree.fromstring(self.integrator_xml))
+        tree.append(etree.fromstring(self.system_xml))
+        tree.append(self._state_element())
+        topology = store_topology(self.topology_string, fileformat=self.topology_format)
+        tree.append(topology)
+        if self.saltswap_state_vector is not None:
+            saltswap = etree.fromstring("<Saltswap><StateVector/></Saltswap>")
+            saltswap.set("salt_concentration_molar", str(self.salt_concentration))
+            saltswap.xpath("StateVector")[0].text = " ".join(
+                str(int(value)) for value in self.saltswap_state_vector
+            )
+            if self.system_saltswap_state_vector is not None:
+                etree.SubElement(saltswap, "SystemStateVector").text = " ".join(
+                    str(int(value)) for value in self.system_saltswap_state_vector
+                )
+            tree.append(saltswap)
+        if self.progress:
+            progress = etree.SubElement(tree, "Progress")
+            progress.text = json.dumps(self.progress)
+
+        # Replace the file only once it is complete
+        temporary = "{}.tmp".format(filename)
+        with open(temporary, "wb") as ofile:
+            ofile.write(etree.tostring(tree))
+        os.replace(temporary, filename)
+
+    def _state_element(self) -> etree.Element:
+        """Create an element in the format of a serialized openmm State."""
+        state = etree.Element(
+            "State",
+            openmmVersion=mm.__version__,
+            time=repr(float(self.time)),
+            type="State",
+            version="1",
+        )
+        box = etree.SubElement(state, "PeriodicBoxVectors")
+        for name, vector in zip("ABC", self.box_vectors):
+            _vector_element(box, name, vector)
+        parameters = etree.SubElement(state, "Parameters")
+        for name, value in self.parameters.items():
+            parameters.set(name, repr(float(value)))
+        positions = etree.SubElement(state, "Positions")
+        for vector in self.positions:
+            _vector_element(positions, "Position", vector)
+        velocities = etree.SubElement(state, "Velocities")
+        for vector in self.velocities:
+            _vector_element(velocities, "Velocity", vector)
+        return state
+
+    def topology(self) -> app.Topology:
+        """Create the topology of the checkpoint."""
+        return xml_to_topology(
+            store_topology(self.topology_string, fileformat=self.topology_format)
+        )
+
+    def system(self) -> mm.System:
+        """Create the System of the checkpoint."""
+        return mm.XmlSerializer.deserialize(self.system_xml)
+
+    def integrator(self) -> mm.Integrator:
+        """Create the integrator of the checkpoint."""
+        return mm.XmlSerializer.deserialize(self.integrator_xml)
+
+    def drive_element(self) -> etree.Element:
+        """The serialized drive, as an xml element."""
+        return etree.fromstring(self.drive_xml)
+
+    def _full_drive_element(self) -> etree.Element:
+        """The serialized drive, including the force parameters that may be stored as arrays."""
+        drive = self.drive_element()
+        if self.drive_force_arrays is None:
+            return drive
+        residues = drive.xpath("TitratableResidue")
+        packed_groups = _PackedForceParameters.from_arrays(self.drive_force_arrays)
+        for element, packed_forces in zip(residues, packed_groups):
+            residue = _TitratableResidue.from_serialized_xml(
+                element, packed_forces=packed_forces
+            )
+            drive.replace(element, residue.serialize())
+        return drive
+
+    def set_context_state(self, context: mm.Context):
+        """Set the positions, box vectors and velocities of a context to those of the checkpoint."""
+        context.setPositions(self.positions * unit.nanometer)
+        context.setPeriodicBoxVectors(*(self.box_vectors * unit.nanometer))
+        context.setVelocities(self.velocities * (unit.nanometer / unit.picosecond))
+
+
+class SimulationSnapshot:
+    """The state of a running simulation, captured to be turned into a checkpoint later.
+
+    Only the data that changes during a run is captured: the state of the context, the drive and the integrator,
+    and the saltswap state. Serializing it, which is slow for large systems, is left to `to_checkpoint`.
+    """
+
+    def __init__(
+        self,
+        drive: app.NCMCProtonDrive,
+        context: mm.Context,
+        integrator: mm.CustomIntegrator,
+        salinator=None,
+        include_forces: bool = False,
+    ):
+        """Capture the current state of a simulation.
+
+        Parameters
+        ----------
+        drive - the proton drive of the simulation
+        context - the context of the simulation
+        integrator - the integrator of the simulation
+        salinator - optional, the salinator of the simulation.
+        include_forces - capture the force parameters of the drive, if they are not stored as arrays.
+        """
+        self.date: str = str(datetime.datetime.now())
+        self.drive_element: etree.Element = drive.state_to_element(
+            include_forces=include_forces
+        )
+        self.integrator_xml: str = serialize_integrator(integrator)
+        self.state: mm.State = context.getState(
+            getPositions=True,
+            getVelocities=True,
+            getParameters=True,
+            enforcePeriodicBox=True,
+        )
+        self.salt_concentration: Optional[float] = None
+        self.saltswap_state_vector: Optional[np.ndarray] = None
+        if salinator is not None:
+            self.salt_concentration = salinator.salt_concentration / unit.molar
+            self.saltswap_state_vector = np.array(
+                salinator.swapper.stateVector, dtype=int
+            )
+
+    def to_checkpoint(
+        self,
+        system_xml: str,
+        topology_string: str,
+        topology_format: str = "pdbx",
+        drive_force_arrays: Optional[Dict[str, np.ndarray]] = None,
+        system_saltswap_state_vector: Optional[np.ndarray] = None,
+    ) -> ProtonsCheckpoint:
+        """Serialize the snapshot into a checkpoint.
+
+        Parameters
+        ----------
+        system_xml - the serialized System of the simulation
+        topology_string - the contents of a topology file, such as pdbx.
+        topology_format - the format of the topology file, 'pdbx' or 'pdb'.
+        drive_force_arrays - the force parameters of the drive from ``force_cache_arrays``, if not captured.
+        system_saltswap_state_vector - the saltswap state of the ions in system_xml, if it was serialized earlier.
+        """
+        obj = ProtonsCheckpoint()
+        obj.date = self.date
+        obj.drive_xml = _element_text(self.drive_element)
+        obj.drive_force_arrays = drive_force_arrays
+        obj.integrator_xml = self.integrator_xml
+        obj.system_xml = system_xml
+        obj.topology_string = topology_string
+        obj.topology_format = topology_format
+
+        state = self.state
+        obj.positions = np.asarray(
+            state.getPositions(asNumpy=True).value_in_unit(unit.nanometer)
+        )
+        obj.velocities = np.asarray(
+            state.getVelocities(asNumpy=True).value_in_unit(
+                unit.nanometer / unit.picosecond
+            )
+        )
+        obj.box_vectors = np.asarray(
+            state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(unit.nanometer)
+        )
+        obj.time = state.getTime().value_in_unit(unit.picosecond)
+        obj.parameters = {
+            name: float(value) for name, value in state.getParameters().items()
+        }
+
+        obj.salt_concentration = self.salt_concentration
+        obj.saltswap_state_vector = self.saltswap_state_vector
+        if system_saltswap_state_vector is not None and not np.array_equal(
+            system_saltswap_state_vector, self.saltswap_state_vector
+        ):
+            obj.system_saltswap_state_vector = system_saltswap_state_vector
+        return obj
+
+
+def read_checkpoint(filename: str) -> ProtonsCheckpoint:
+    """Read a checkpoint in either the binary or the XML format."""
+    if is_binary_checkpoint(filename):
+        return ProtonsCheckpoint.read(filename)
+    return ProtonsCheckpoint.from_xml(filename)
+
+
+def convert_xml_checkpoint(
+    xml_filename: str, filename: str, system_store: Optional[str] = None
+):
+    """Convert an XML checkpoint into a binary checkpoint.
+
+    Parameters
+    ----------
+    xml_filename - the XML checkpoint to read
+    filename - the binary checkpoint to write
+    system_store - optional, a directory to store the serialized System in, see `ProtonsCheckpoint.write`.
+    """
+    ProtonsCheckpoint.from_xml(xml_filename).write(filename, system_store=system_store)
+
+
+class PeriodicCheckpointer:
+    """Decides when to write checkpoints during a run, and writes them atomically.
+
+    Checkpoints are due every ``interval`` iterations, and/or every ``minutes`` minutes.
+    Optionally, files are written in a worker thread, while the simulation continues.
+    At most one checkpoint is written at a time.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        binary: bool = True,
+        interval: Optional[int] = None,
+        minutes: Optional[float] = None,
+        asynchronous: bool = False,
+        system_store: Optional[str] = None,
+    ):
+        """Set up periodic checkpointing.
+
+        Parameters
+        ----------
+        filename - the name of the checkpoint file, which is replaced by every new checkpoint.
+        binary - write binary checkpoints if True, XML checkpoints if False.
+        interval - write a checkpoint every this many iterations, None to not checkpoint on count.
+        minutes - write a checkpoint if this many minutes passed since the last one, None to not checkpoint on time.
+        asynchronous - write the files in a worker thread.
+        system_store - optional, a directory to store the serialized System in, see `ProtonsCheckpoint.write`.
+        """
+        if interval is not None and interval < 1:
+            raise ValueError("The checkpoint interval needs to be at least 1, or None.")
+        if minutes is not None and minutes <= 0.0:
+            raise ValueError("The checkpoint time needs to be positive, or None.")
+        self.filename = filename
+        self.binary = binary
+        self.interval = interval
+        self.minutes = minutes
+        self.system_store = system_store
+        self._executor = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        self._pending: Optional[Future] = None
+        self._last_time = time.time()
+        # The serialized System, the saltswap state of its ions, and the force parameters of the drive
+        self._run_data: Optional[
+            Tuple[str, Optional[np.ndarray], Optional[Dict[str, np.ndarray]]]
+        ] = None
+
+    @property
+    def enabled(self) -> bool:
+        """True if checkpoints are written periodically."""
+        return self.interval is not None or self.minutes is not None
+
+    def due(self, iteration: int) -> bool:
+        """Return True if a checkpoint should be written after the given number of completed iterations."""
+        if self.interval is not None and iteration % self.interval == 0:
+            return True
+        if (
+            self.minutes is not None
+            and time.time() - self._last_time >= 60.0 * self.minutes
+        ):
+            return True
+        return False
+
+    def save(self, checkpoint: ProtonsCheckpoint):
+        """Write a checkpoint, or hand it to the worker thread.
+
+        Parameters
+        ----------
+        checkpoint - a checkpoint that is not modified anymore
+        """
+        self._submit(lambda: checkpoint)
+
+    def save_simulation(
+        self,
+        drive: app.NCMCProtonDrive,
+        context: mm.Context,
+        system: mm.System,
+        integrator: mm.CustomIntegrator,
+        topology_string: str,
+        salinator=None,
+        topology_format: str = "pdbx",
+        progress: Optional[Dict] = None,
+    ):
+        """Capture the state of a running simulation, and write it as a checkpoint, or hand it to the worker thread.
+
+        Parameters
+        ----------
+        drive - the proton drive of the simulation
+        context - the context of the simulation
+        system - the system of the simulation
+        integrator - the integrator of the simulation
+        topology_string - the contents of a topology file, such as pdbx.
+        salinator - optional, the salinator of the simulation.
+        topology_format - the format of the topology file, 'pdbx' or 'pdb'.
+        progress - optional, the progress of the run, see `ProtonsCheckpoint.progress`.
+
+        Notes
+        -----
+        The System is serialized only once per run, at the first checkpoint. During the run, only the titration
+        and ion parameters of the System change. Titration states are restored from the drive, and ion parameters
+        from ``system_saltswap_state_vector``, see ``run_simulation.restore_titration_parameters``
+        and ``run_simulation.restore_ion_parameters``.
+        The force parameters of the drive do not change during a run, and are also packed only once.
+        """
+        if self._run_data is None:
+            system_vector = None
+            if salinator is not None:
+                system_vector = np.array(salinator.swapper.stateVector, dtype=int)
+            self._run_data = (
+                serialize_system(system),
+                system_vector,
+                _drive_force_arrays(drive),
+            )
+        system_xml, system_vector, drive_force_arrays = self._run_data
+        snapshot = SimulationSnapshot(
+            drive,
+            context,
+            integrator,
+            salinator=salinator,
+            include_forces=drive_force_arrays is None,
+        )
+        progress = dict() if progress is None else progress
+
+        def create_checkpoint() -> ProtonsCheckpoint:
+            checkpoint = snapshot.to_checkpoint(
+                system_xml,
+                topology_string,
+                topology_format=topology_format,
+                drive_force_arrays=drive_force_arrays,
+                system_saltswap_state_vector=system_vector,
+            )
+            checkpoint.progress = progress
+            return checkpoint
+
+        self._submit(create_checkpoint)
+
+    def wait(self):
+        """Wait until the checkpoint that is being written is complete."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        """Finish writing, and stop the worker thread."""
+        try:
+            self.wait()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def remove(self):
+        """Remove the checkpoint file, once the run it belongs to has completed."""
+        self.wait()
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+    def _submit(self, create_checkpoint: Callable[[], ProtonsCheckpoint]):
+        """Create and write a checkpoint, in the worker thread if there is one."""
+        self.wait()
+        if self._executor is None:
+            self._write(create_checkpoint())
+        else:
+            self._pending = self._executor.submit(
+                lambda: self._write(create_checkpoint())
+            )
+        self._last_time = time.time()
+
+    def _write(self, checkpoint: ProtonsCheckpoint):
+        """Write the checkpoint file."""
+        if self.binary:
+            checkpoint.write(self.filename, system_store=self.system_store)
+        else:
+            checkpoint.to_xml(self.filename)
+
+
+def load_progress_checkpoint(
+    filename: str, ncfilename: str
+) -> Optional[ProtonsCheckpoint]:
+    """Load the checkpoint of an interrupted run, if it exists and matches the netCDF file of the run.
+
+    Parameters
+    ----------
+    filename - the checkpoint written during the run
+    ncfilename - the netCDF file of the run
+
+    Returns
+    -------
+    The checkpoint, or None if the run can not be resumed from it.
+    """
+    if not os.path.isfile(filename):
+        return None
+    try:
+        checkpoint = read_checkpoint(filename)
+    except Exception as error:
+        log.warn(f"Could not read checkpoint '{filename}': {error}")
+        return None
+    if "iteration" not in checkpoint.progress:
+        log.warn(f"Checkpoint '{filename}' does not record the progress of a run.")
+        return None
+
+    # The reports up to the checkpoint need to be present.
+    sizes = checkpoint.progress.get("netcdf_dimensions", dict())
+    if sizes:
+        if not os.path.isfile(ncfilename):
+            log.warn(
+                f"The reports of the interrupted run ('{ncfilename}') are missing."
+            )
+            return None
+        try:
+            with netCDF4.Dataset(ncfilename, "r") as dataset:
+                available = netcdf_dimension_sizes(dataset)
+        except Exception as error:
+            log.warn(f"Could not read '{ncfilename}': {error}")
+            return None
+        for path, dimensions in sizes.items():
+            for name, size in dimensions.items():
+                if available.get(path, dict()).get(name, -1) < size:
+                    log.warn(
+                        f"'{ncfilename}' has fewer reports than checkpoint '{filename}'."
+                    )
+                    return None
+    return checkpoint
+
+
+def netcdf_dimension_sizes(dataset: netCDF4.Dataset) -> Dict[str, Dict[str, int]]:
+    """Return the size of every unlimited dimension, by group path and dimension name."""
+    sizes = dict()
+    for grp in _walk_groups(dataset):
+        unlimited = {
+            name: len(dimension)
+            for name, dimension in grp.dimensions.items()
+            if dimension.isunlimited()
+        }
+        if unlimited:
+            sizes[grp.path] = unlimited
+    return sizes
+
+
+def truncate_netcdf(filename: str, sizes: Dict[str, Dict[str, int]]):
+    """Truncate the unlimited dimensions of a netCDF file to the given sizes.
+
+    Parameters
+    ----------
+    filename - the netCDF file
+    sizes - the size of unlimited dimensions, by group path and dimension name, see `netcdf_dimension_sizes`.
+        Dimensions that are not listed keep their size.
+
+    Notes
+    -----
+    netCDF files can not shrink, so the data is copied into a new file, which then replaces the file.
+    """
+    temporary = "{}.tmp".format(filename)
+    with netCDF4.Dataset(filename, "r") as source:
+        source.set_auto_mask(False)
+        with netCDF4.Dataset(temporary, "w", format=source.data_model) as destination:
+            for grp in _walk_groups(source):
+                _copy_group(grp, destination, sizes)
+    os.replace(temporary, filename)
+
+
+def _walk_groups(grp):
+    """Yield the group, and all groups below it."""
+    yield grp
+    for child in grp.groups.values():
+        yield from _walk_groups(child)
+
+
+def _copy_group(grp, destination: netCDF4.Dataset, sizes: Dict[str, Dict[str, int]]):
+    """Copy the dimensions, variables and attributes of a group, truncating unlimited dimensions."""
+    if grp.path == "/":
+        target = destination
+    else:
+        target = destination.createGroup(grp.path)
+    target.setncatts({name: grp.getncattr(name) for name in grp.ncattrs()})
+
+    for name, dimension in grp.dimensions.items():
+        target.createDimension(
+            name, None if dimension.isunlimited() else len(dimension)
+        )
+
+    for name, variable in grp.variables.items():
+        attributes = {key: variable.getncattr(key) for key in variable.ncattrs()}
+        fill_value = attributes.pop("_FillValue", None)
+        filters = variable.filters() or dict()
+        chunking = variable.chunking()
+        copy = target.createVariable(
+            name,
+            variable.datatype,
+            variable.dimensions,
+            zlib=filters.get("zlib", False),
+            chunksizes=None if chunking == "contiguous" else chunking,
+            fill_value=fill_value,
+        )
+        copy.setncatts(attributes)
+        if len(variable.dimensions) == 0:
+            copy.assignValue(variable.getValue())
+            continue
+        # Dimensions can be defined in a parent group
+        region = tuple(
+            slice(0, min(sizes[dim.group().path][dim.name], extent))
+            if dim.name in sizes.get(dim.group().path, dict())
+            else slice(None)
+            for dim, extent in zip(variable.get_dims(), variable.shape)
+        )
+        values = variable[region]
+        if values.size > 0:
+            copy[tuple(slice(0, extent) for extent in values.shape)] = values
+
+
+def _drive_force_arrays(drive: app.NCMCProtonDrive) -> Optional[Dict[str, np.ndarray]]:
+    """The force parameters of the drive as arrays, which are restored much faster than xml, if possible."""
+    try:
+        return drive.force_cache_arrays()
+    except ValueError:
+        return None
+
+
+def _element_text(element: etree.Element) -> str:
+    """Serialize an xml element, without the text that follows it."""
+    return etree.tostring(element, encoding="unicode", with_tail=False)
+
+
+def _array_bytes(array: np.ndarray) -> bytes:
+    """Serialize an array in the npy format."""
+    stream = io.BytesIO()
+    np.save(stream, np.asarray(array), allow_pickle=False)
+    return stream.getvalue()
+
+
+def _read_array(archive: zipfile.ZipFile, name: str) -> np.ndarray:
+    """Read an array in the npy format from an archive."""
+    return np.load(io.BytesIO(archive.read(name)), allow_pickle=False)
+
+
+def _vectors_from_xml(elements) -> np.ndarray:
+    """Read an array of vectors from xml elements with x, y, z attributes."""
+    return np.asarray(
+        [[float(element.get(axis)) for axis in "xyz"] for element in elements],
+        dtype=float,
+    ).reshape(-1, 3)
+
+
+def _vector_element(parent: etree.Element, tag: str, vector):
+    """Add an element with x, y, z attributes."""
+    x, y, z = (repr(float(value)) for value in vector)
+    etree.SubElement(parent, tag, x=x, y=y, z=z)
+
+
+def _store_system(store: str, digest: str, system_xml: str):
+    """Add a serialized System to the store, unless it is there already."""
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    filename = os.path.join(store, "{}.xml".format(digest))
+    if os.path.isfile(filename):
+        return
+    temporary = "{}.{}.tmp".format(filename, os.getpid())
+    with open(temporary, "w") as systemfile:
+        systemfile.write(system_xml)
+    os.replace(temporary, filename)
+
+
+def _load_system(store: str, digest: str) -> str:
+    """Read a serialized System from the store, and verify its content hash."""
+    filename = os.path.join(store, "{}.xml".format(digest))
+    with open(filename, "r") as systemfile:
+        system_xml = systemfile.read()
+    if system_hash(system_xml) != digest:
+        raise ValueError("The stored System {} is corrupted.".format(filename))
+    return system_xml
@@ -13,6 +13,7 @@ from typing import List
 from .run_simulation import run_main
 from .run_prep_ffxml import run_prep_ffxml_main
 from .run_parametrize_ligand import run_parametrize_main
+from .run_calibration_campaign import run_campaign_main
 
 log.setLevel(logging.DEBUG)
 
@@ -29,6 +30,44 @@ _logo = """
     ╚═╝     ╚═╝  ╚═╝ ╚═════╝    ╚═╝    ╚═════╝ ╚═╝  ╚═══╝╚══════╝
 """
 
+_campaign_help = """
+    protons campaign <toml>
+
+    Prepare and calibrate many residues in parallel, and collect the calibrated free energies in one file.
+
+    Every residue is prepared with the settings of a 'protons prep' template, and calibrated using successive
+    'protons run' runs from a run template, until SAMS reaches the stop stage or max_runs runs have been performed.
+    Input and output settings of the templates are filled in per residue, and the format_vars 'name', 'run_idx'
+    and 'previous_run_idx' are available to them. Residues are calibrated in separate processes.
+
+    Example campaign.toml
+    ---------------------
+
+    [campaign]
+    dir = "campaign"  # every residue gets its own subdirectory
+    prepare = "prepare_calibration.toml"  # template for protons prep
+    run = "run_calibration.toml"  # template for protons run
+    processes = 4  # residues calibrated at the same time
+    max_runs = 10  # maximum number of runs per residue
+    stop_stage = "equilibrium"  # SAMS stage at which a residue is converged
+    output = "reference-free-energies.toml"
+
+    [residues.ASP]
+    vacuum = "asp-vacuum.pdb"  # solvated before preparation
+
+    [residues.1D]
+    structure = "1D-water.cif"  # used as is
+    ffxml = "1D.xml"
+    hxml = "1D-h.xml"
+
+    Output
+    ------
+    The output file is updated whenever a residue finishes. It contains a reference_free_energies block with the
+    free energies of every converged residue type, that can be used in the input of 'protons prep',
+    and a calibrations block with the status of every residue.
+    Rerunning a campaign continues from the checkpoints of earlier runs.
+"""
+
 
 def validate(args: List[str]) -> str:
     """Validate input or return appropriate help string for the given arguments"""
@@ -49,6 +88,8 @@ def validate(args: List[str]) -> str:
         Note: Currently only ffxml supported.
     protons run <toml>
         Run a constant-pH simulation or calibration from a toml file.
+    protons campaign <toml>
+        Prepare and calibrate many residues in parallel, and collect the calibrated free energies in one file.
     
     protons help <cmd>
         Provide a longer explanation for a command, including example toml files.
@@ -76,10 +117,12 @@ def validate(args: List[str]) -> str:
             raise NotImplementedError("This help feature is incomplete.")
         elif arg.lower() == "run":
             raise NotImplementedError("This help feature is incomplete.")
+        elif arg.lower() == "campaign":
+            return _campaign_help
         else:
             return f"Unknown command: {arg}. \n" + usage
 
-    elif cmd in ["param", "prep", "run"]:
+    elif cmd in ["param", "prep", "run", "campaign"]:
         if os.path.splitext(arg)[1].lower() != ".toml":
             return "Please provide a '.toml' file as input."
         else:
@@ -106,5 +149,7 @@ def cli() -> None:
             run_prep_ffxml_main(arg)
         elif cmd == "param":
             run_parametrize_main(arg)
+        elif cmd == "campaign":
+            run_campaign_main(arg)
 
         sys.exit(0)
@@ -0,0 +1,337 @@
+"""Run the calibrations of many residues in parallel, and collect the calibrated free energies in one table.
+
+A campaign is described by a toml file with a ``campaign`` block, and a ``residues`` block with one entry per
+residue or ligand. Every residue is prepared using ``run_prep_ffxml_main``, and calibrated using successive
+``run_main`` runs, until SAMS reaches the requested stage or the maximum number of runs has been performed.
+Residues are calibrated in parallel, in separate processes.
+
+Example
+-------
+
+    [campaign]
+    dir = "campaign"
+    prepare = "prepare_calibration.toml"  # template for run_prep_ffxml_main
+    run = "run_calibration.toml"  # template for run_main
+    processes = 4
+    max_runs = 10
+    stop_stage = "equilibrium"
+    output = "reference-free-energies.toml"
+
+    [residues.ASP]
+    vacuum = "asp-vacuum.pdb"  # solvated using prepare_calibration_systems
+
+    [residues.1D]
+    structure = "1D-water.cif"  # used as is
+    ffxml = "1D.xml"
+    hxml = "1D-h.xml"
+
+The output file contains a ``reference_free_energies`` block, that can be used in the input of
+``run_prep_ffxml_main``, or loaded using ``load_reference_free_energies`` and passed to ``import_gk_values``.
+Rerunning a campaign continues from the checkpoints of earlier runs.
+"""
+
+import copy
+import multiprocessing
+import os
+import sys
+import numpy as np
+import toml
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict
+
+from ..app import log
+from ..app.driver import SAMSApproach, Stage, _SAMSState
+from ..app.ligands import prepare_calibration_systems
+from .checkpoint import read_checkpoint
+from .run_prep_ffxml import run_prep_ffxml_main
+from .run_simulation import run_main
+
+
+def read_calibration_result(checkpoint_file: str) -> Dict[str, Any]:
+    """Read the calibration progress and free energies of the calibrated residue from a checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_file - a checkpoint of a calibration run, in xml or binary format.
+
+    Returns
+    -------
+    dict with
+        residue_type - the residue type, as used by ``import_gk_values``
+        stage - the name of the SAMS stage
+        adaptation - the number of the current adaptation
+        max_absolute_deviation - deviation of the histogram from the target
+        free_energies - the calibrated free energy (g_k) of every state of the residue
+    """
+    drive = read_checkpoint(checkpoint_file).drive_element()
+    sams_state = drive.xpath("SAMSState")
+    if len(sams_state) == 0:
+        raise ValueError(
+            "The checkpoint '{}' does not contain a calibration.".format(
+                checkpoint_file
+            )
+        )
+    state = _SAMSState.from_xml(sams_state[0])
+    residues = drive.xpath("TitratableResidue")
+    if state.approach is SAMSApproach.ONESITE:
+        residue = residues[state.group_index]
+    elif len(residues) == 1:
+        residue = residues[0]
+    else:
+        raise ValueError(
+            "A multisite calibration of {} residues does not provide the free energies of a single residue.".format(
+                len(residues)
+            )
+        )
+
+    return dict(
+        residue_type=residue.get("type"),
+        stage=state._stage.name.lower(),
+        adaptation=int(state._current_adaptation),
+        max_absolute_deviation=float(state.max_absolute_deviation),
+        free_energies=[float(value) for value in state.free_energies],
+    )
+
+
+def load_reference_free_energies(filename: str) -> Dict[str, np.ndarray]:
+    """Load the free energies written by a calibration campaign, for use with ``import_gk_values``.
+
+    Parameters
+    ----------
+    filename - the output file of the campaign, or any toml file with a ``reference_free_energies`` block.
+    """
+    with open(filename, "r") as tomlfile:
+        table = toml.load(tomlfile)["reference_free_energies"]
+    gk_dict = dict()
+    for residue_type, values in table.items():
+        # Skip comments
+        if residue_type.startswith("_"):
+            continue
+        values = np.asarray(values).astype(np.float64)
+        if not values.ndim == 1:
+            raise ValueError("Reference free energies should be simple lists.")
+        gk_dict[residue_type] = values
+    return gk_dict
+
+
+def _checkpoint_name(name: str, run_idx: int, extension: str) -> str:
+    """File name of the checkpoint of a run, the prepared system is always stored as xml."""
+    if run_idx == 0:
+        extension = ".xml"
+    return f"{name}-checkpoint-{run_idx}{extension}"
+
+
+def calibrate_residue(
+    name: str,
+    residue: Dict[str, Any],
+    prepare_template: Dict[str, Any],
+    run_template: Dict[str, Any],
+    workdir: str,
+    max_runs: int,
+    stop_stage: Stage,
+) -> Dict[str, Any]:
+    """Prepare and calibrate a single residue, continuing from existing checkpoints.
+
+    Parameters
+    ----------
+    name - the name of the residue in the campaign, used for the directory and file names.
+    residue - the settings of the residue from the campaign file.
+    prepare_template - settings for ``run_prep_ffxml_main``, input and output are filled in per residue.
+    run_template - settings for ``run_main``, input and output are filled in per residue.
+    workdir - absolute path of the campaign directory.
+    max_runs - the maximum number of calibration runs.
+    stop_stage - stop once SAMS reaches this stage.
+
+    Returns
+    -------
+    dict - the result of the last run (see ``read_calibration_result``), with the name and number of runs.
+    """
+    resdir = os.path.join(workdir, name)
+    if not os.path.isdir(resdir):
+        os.makedirs(resdir)
+
+    format_vars = dict(residue.get("format_vars", dict()))
+    format_vars["name"] = name
+
+    output = run_template.get("output", dict())
+    if output.get("checkpoint_format", "xml").lower() == "binary":
+        extension = ".chk"
+    else:
+        extension = ".xml"
+
+    ffxml = residue.get("ffxml", None)
+    if ffxml is not None:
+        ffxml = os.path.abspath(ffxml)
+
+    # Prepare the system, unless an earlier campaign already did
+    if not os.path.isfile(os.path.join(resdir, _checkpoint_name(name, 0, extension))):
+        if "vacuum" in residue:
+            hxml = residue.get("hxml", None)
+            prepare_calibration_systems(
+                os.path.abspath(residue["vacuum"]),
+                os.path.join(resdir, name),
+                ffxml=ffxml,
+                hxml=None if hxml is None else os.path.abspath(hxml),
+                delete_old_H=bool(residue.get("delete_old_H", False)),
+            )
+            # Implicit solvent systems are not solvated
+            solvent = "water" if "PME" in prepare_template["system"] else "vacuum"
+            structure = os.path.join(resdir, f"{name}-{solvent}.cif")
+        elif "structure" in residue:
+            structure = os.path.abspath(residue["structure"])
+        else:
+            raise KeyError(
+                f"Please provide either a vacuum file or a structure for residue {name}."
+            )
+
+        prepare = copy.deepcopy(prepare_template)
+        prepare["format_vars"] = {**prepare.get("format_vars", dict()), **format_vars}
+        prepare["input"] = dict(
+            dir=os.path.dirname(structure), structure=os.path.basename(structure)
+        )
+        prepare["output"] = dict(dir=resdir, basename=name)
+        if ffxml is not None:
+            prepare["forcefield"]["user"] = [ffxml]
+        prepare_file = os.path.join(resdir, f"{name}-prepare.toml")
+        with open(prepare_file, "w") as tomlfile:
+            toml.dump(prepare, tomlfile)
+        log.info(f"Preparing calibration of {name}.")
+        run_prep_ffxml_main(prepare_file)
+
+    result = dict()
+    for run_idx in range(1, max_runs + 1):
+        checkpoint_file = os.path.join(
+            resdir, _checkpoint_name(name, run_idx, extension)
+        )
+        # Runs that completed during an earlier campaign are not repeated
+        if not os.path.isfile(checkpoint_file):
+            run = copy.deepcopy(run_template)
+            run["format_vars"] = {
+                **run.get("format_vars", dict()),
+                **format_vars,
+                "previous_run_idx": run_idx - 1,
+                "run_idx": run_idx,
+            }
+            run["input"] = dict(
+                dir=resdir, checkpoint=_checkpoint_name(name, run_idx - 1, extension)
+            )
+            run["output"] = {**output, "dir": resdir, "basename": name}
+            run_file = os.path.join(resdir, f"{name}-run-{run_idx}.toml")
+            with open(run_file, "w") as tomlfile:
+                toml.dump(run, tomlfile)
+            log.info(f"Calibrating {name}, run {run_idx}.")
+            run_main(run_file)
+
+        result = read_calibration_result(checkpoint_file)
+        result["runs"] = run_idx
+        log.info(
+            "{}: {} stage at adaptation {}, {:.2f}% deviation.".format(
+                name,
+                result["stage"],
+                result["adaptation"],
+                result["max_absolute_deviation"] * 100,
+            )
+        )
+        if Stage[result["stage"].upper()].value >= stop_stage.value:
+            break
+
+    result["name"] = name
+    result["converged"] = Stage[result["stage"].upper()].value >= stop_stage.value
+    return result
+
+
+def write_campaign_results(filename: str, results: Dict[str, Dict[str, Any]]):
+    """Write the free energies of the converged residues, and the status of every residue to a toml file.
+
+    Parameters
+    ----------
+    filename - the output file
+    results - the result of ``calibrate_residue`` by residue name, or a dict with an error for failed residues.
+    """
+    free_energies = dict()
+    for name, result in sorted(results.items()):
+        if not result.get("converged", False):
+            continue
+        residue_type = result["residue_type"]
+        if residue_type in free_energies:
+            raise ValueError(
+                f"Residue type {residue_type} was calibrated more than once, please use separate campaigns."
+            )
+        free_energies[residue_type] = result["free_energies"]
+
+    table = dict(
+        reference_free_energies=free_energies,
+        calibrations={name: results[name] for name in sorted(results)},
+    )
+    temporary = "{}.tmp".format(filename)
+    with open(temporary, "w") as tomlfile:
+        toml.dump(table, tomlfile)
+    os.replace(temporary, filename)
+
+
+def run_campaign_main(tomlfile):
+    """Calibrate every residue of a campaign, and write the consolidated free energies."""
+
+    log.info(f"Running a calibration campaign from '{tomlfile}'")
+    with open(tomlfile, "r") as settings_file:
+        settings = toml.load(settings_file)
+
+    campaign = settings["campaign"]
+    workdir = os.path.abspath(campaign["dir"])
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    with open(campaign["prepare"], "r") as template_file:
+        prepare_template = toml.load(template_file)
+    with open(campaign["run"], "r") as template_file:
+        run_template = toml.load(template_file)
+    processes = int(campaign.get("processes", 1))
+    max_runs = int(campaign.get("max_runs", 1))
+    stop_stage = Stage[campaign.get("stop_stage", "equilibrium").upper()]
+    output_file = os.path.abspath(
+        campaign.get("output", "reference-free-energies.toml")
+    )
+
+    residues: Dict[str, Dict[str, Any]] = settings["residues"]
+    if len(residues) == 0:
+        raise ValueError("No residues specified for the campaign.")
+
+    results: Dict[str, Dict[str, Any]] = dict()
+    # Every calibration runs in a fresh process, since the scripts change directories and install signal handlers.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        futures = {
+            executor.submit(
+                calibrate_residue,
+                name,
+                residue,
+                prepare_template,
+                run_template,
+                workdir,
+                max_runs,
+                stop_stage,
+            ): name
+            for name, residue in residues.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as error:
+                # One failing residue should not stop the rest of the campaign
+                log.error(f"Calibration of {name} failed: {error}")
+                results[name] = dict(
+                    name=name, converged=False, error="{!r}".format(error)
+                )
+            # Keep the table up to date, so progress can be followed
+            write_campaign_results(output_file, results)
+
+    converged = sum(result["converged"] for result in results.values())
+    log.info(f"🏁 Campaign finished, {converged} of {len(results)} residues converged.")
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Please provide a single toml file as input.")
+    else:
+        run_campaign_main(sys.argv[1])
@@ -5,7 +5,6 @@ import toml
 from typing import Dict
 import sys
 import netCDF4
-from lxml import etree
 from saltswap.wrappers import Salinator
 from simtk import openmm as mm, unit
 from tqdm import trange
@@ -13,15 +12,76 @@ from tqdm import trange
 from .. import app
 from ..app import log, NCMCProtonDrive
 from ..app.proposals import UniformSwapProposal
-from ..app.driver import SAMSApproach
+from ..app.driver import SAMSApproach, Stage
+from ..app.reportbuffer import BackgroundWriter
+from ..app.saltswap_utils import update_fractional_stateVector
 from .utilities import (
     timeout_handler,
-    xml_to_topology,
-    deserialize_openmm_element,
-    deserialize_state_vector,
     TimeOutError,
     create_protons_checkpoint_file,
 )
+from .checkpoint import (
+    ProtonsCheckpoint,
+    PeriodicCheckpointer,
+    read_checkpoint,
+    load_progress_checkpoint,
+    netcdf_dimension_sizes,
+    truncate_netcdf,
+)
+
+
+def buffer_options(reporter_settings: Dict) -> Dict:
+    """Retrieve the optional buffering settings of a reporter, see ``protons.app.reportbuffer.ReportBuffer``."""
+    options = dict()
+    for key, convert in [
+        ("flush_interval", int),
+        ("sync_interval", int),
+        ("sync_seconds", float),
+        ("chunk_size", int),
+    ]:
+        if key in reporter_settings:
+            options[key] = convert(reporter_settings[key])
+    return options
+
+
+def flush_reporters(simulation: app.ConstantPHSimulation):
+    """Write any reports that are still buffered, and wait for them to be written."""
+    for reporter in simulation.update_reporters + simulation.calibration_reporters:
+        if hasattr(reporter, "flush"):
+            reporter.flush()
+
+
+def restore_titration_parameters(driver: NCMCProtonDrive):
+    """Set the force parameters of the System to the titration states of the drive.
+
+    Progress checkpoints share the System serialized at the first checkpoint of a run, which can have older states.
+    Call this before a context is created.
+    """
+    for group_index, group in enumerate(driver.titrationGroups):
+        driver._update_forces(group_index, group.state_index)
+
+
+def restore_ion_parameters(
+    driver: NCMCProtonDrive, checkpoint: ProtonsCheckpoint, context: mm.Context
+):
+    """Set the ion parameters of the System and context to the saltswap state of the checkpoint.
+
+    The System may have the ions of an earlier checkpoint of the run, see ``ProtonsCheckpoint.system_saltswap_state_vector``.
+    """
+    swapper = driver.swapper
+    if checkpoint.system_saltswap_state_vector is None:
+        # Assumes the parameters are already set and the ions are set if needed
+        swapper.stateVector = checkpoint.saltswap_state_vector.copy()
+        return
+    swapper.stateVector = checkpoint.system_saltswap_state_vector.copy()
+    update_fractional_stateVector(
+        swapper,
+        checkpoint.saltswap_state_vector.copy(),
+        fraction=1.0,
+        set_vector_indices=True,
+    )
+    for force_index, force in driver._forces_to_push(ions_changed=True):
+        force.updateParametersInContext(context)
 
 
 def run_main(jsonfile):
@@ -51,15 +111,57 @@ def run_main(jsonfile):
     input_checkpoint_file = os.path.abspath(
         os.path.join(idir, inp["checkpoint"].format(**format_vars))
     )
-    # Load checkpoint file
-    with open(input_checkpoint_file, "r") as checkpoint:
-        checkpoint_tree = etree.fromstring(checkpoint.read())
+    # Naming the output files
+    out = settings["output"]
+    odir = out["dir"].format(**format_vars)
+    obasename = out["basename"].format(**format_vars)
+    runid = format_vars["run_idx"]
+    if not os.path.isdir(odir):
+        os.makedirs(odir)
+    lastdir = os.getcwd()
+    os.chdir(odir)
+
+    # File for resuming simulation, the xml format is the default.
+    checkpoint_format = out.get("checkpoint_format", "xml").lower()
+    if checkpoint_format == "xml":
+        output_checkpoint_file = f"{obasename}-checkpoint-{runid}.xml"
+    elif checkpoint_format == "binary":
+        output_checkpoint_file = f"{obasename}-checkpoint-{runid}.chk"
+    else:
+        raise ValueError(f"Unsupported checkpoint format: '{checkpoint_format}'.")
+    # Optionally, store the System of binary checkpoints separately, under its content hash
+    system_store = out.get("system_store", None)
+
+    # Checkpoints written during the run, to resume it if it is interrupted
+    ncfilename = f"{obasename}-{runid}.nc"
+    progress_checkpoint_file = "{}-progress{}".format(
+        *os.path.splitext(output_checkpoint_file)
+    )
+    checkpoint_interval = run.get("checkpoint_interval", None)
+    checkpoint_minutes = run.get("checkpoint_minutes", None)
+    checkpointer = PeriodicCheckpointer(
+        progress_checkpoint_file,
+        binary=checkpoint_format == "binary",
+        interval=None if checkpoint_interval is None else int(checkpoint_interval),
+        minutes=None if checkpoint_minutes is None else float(checkpoint_minutes),
+        asynchronous=bool(run.get("async_checkpoint", False)),
+        system_store=system_store,
+    )
 
-    checkpoint_date = checkpoint_tree.attrib["date"]
+    # Load checkpoint file, either binary or xml
+    # An interrupted run continues from its latest checkpoint.
+    checkpoint = load_progress_checkpoint(progress_checkpoint_file, ncfilename)
+    progress = dict()
+    if checkpoint is None:
+        checkpoint = read_checkpoint(input_checkpoint_file)
+    else:
+        progress = checkpoint.progress
+        log.info(f"Resuming the interrupted run at iteration {progress['iteration']}.")
+
+    checkpoint_date = checkpoint.date
     log.info(f"Reading checkpoint from '{checkpoint_date}'.")
 
-    topology_element = checkpoint_tree.xpath("TopologyFile")[0]
-    topology: app.Topology = xml_to_topology(topology_element)
+    topology: app.Topology = checkpoint.topology()
 
     # Quick fix for histidines in topology
     # Openmm relabels them HIS, which leads to them not being detected as
@@ -74,32 +176,17 @@ def run_main(jsonfile):
         elif residue.name == "GLU":
             residue.name = "GLH"
 
-    # Naming the output files
-    out = settings["output"]
-    odir = out["dir"].format(**format_vars)
-    obasename = out["basename"].format(**format_vars)
-    runid = format_vars["run_idx"]
-    if not os.path.isdir(odir):
-        os.makedirs(odir)
-    lastdir = os.getcwd()
-    os.chdir(odir)
-
-    # File for resuming simulation
-    output_checkpoint_file = f"{obasename}-checkpoint-{runid}.xml"
-
     # System Configuration
-    system_element = checkpoint_tree.xpath("System")[0]
-    system: mm.System = deserialize_openmm_element(system_element)
+    system: mm.System = checkpoint.system()
 
     # Deserialize the integrator
-    integrator_element = checkpoint_tree.xpath("Integrator")[0]
-    integrator: mm.CompoundIntegrator = deserialize_openmm_element(integrator_element)
+    integrator: mm.CompoundIntegrator = checkpoint.integrator()
 
     perturbations_per_trial = int(run["perturbations_per_ncmc_trial"])
     propagations_per_step = int(run["propagations_per_ncmc_step"])
 
     # Deserialize the proton drive
-    drive_element = checkpoint_tree.xpath("NCMCProtonDrive")[0]
+    drive_element = checkpoint.drive_element()
     temperature = float(drive_element.get("temperature_kelvin")) * unit.kelvin
     if "pressure_bar" in drive_element.attrib:
         pressure = float(drive_element.get("pressure_bar")) * unit.bar
@@ -114,7 +201,10 @@ def run_main(jsonfile):
         perturbations_per_trial=perturbations_per_trial,
         propagations_per_step=propagations_per_step,
     )
-    driver.state_from_xml_tree(drive_element)
+    driver.state_from_xml_tree(
+        drive_element, force_arrays=checkpoint.drive_force_arrays
+    )
+    restore_titration_parameters(driver)
 
     if driver.calibration_state is not None:
         if driver.calibration_state.approach == SAMSApproach.ONESITE:
@@ -148,25 +238,12 @@ def run_main(jsonfile):
     )
 
     # Set the simulation state
-    state_element = checkpoint_tree.xpath("State")[0]
-    state: mm.State = deserialize_openmm_element(state_element)
-    boxvec = state.getPeriodicBoxVectors()
-    pos = state.getPositions()
-    vel = state.getVelocities()
-
-    simulation.context.setPositions(pos)
-    simulation.context.setPeriodicBoxVectors(*boxvec)
-    simulation.context.setVelocities(vel)
+    checkpoint.set_context_state(simulation.context)
 
     # Check if the system has an associated salinator
 
-    saltswap_element = checkpoint_tree.xpath("Saltswap")
-    if saltswap_element:
-        # Deserialiation workaround
-        saltswap_element = saltswap_element[0]
-        salt_concentration = (
-            float(saltswap_element.get("salt_concentration_molar")) * unit.molar
-        )
+    if checkpoint.saltswap_state_vector is not None:
+        salt_concentration = checkpoint.salt_concentration * unit.molar
         salinator = Salinator(
             context=simulation.context,
             system=system,
@@ -176,22 +253,32 @@ def run_main(jsonfile):
             pressure=pressure,
             temperature=temperature,
         )
-        swapper = salinator.swapper
-        deserialize_state_vector(saltswap_element, swapper)
-        # Assumes the parameters are already set and the ions are set if needed
         # Don't set the charge rule
-        driver.swapper = swapper
+        driver.swapper = salinator.swapper
         driver.swap_proposal = UniformSwapProposal(cation_coefficient=0.5)
+        restore_ion_parameters(driver, checkpoint, simulation.context)
 
     else:
         salinator = None
 
     # Add reporters
-    ncfile = netCDF4.Dataset(f"{obasename}-{runid}.nc", "w")
-    dcd_output_name = f"{obasename}-{runid}.dcd"
+    if progress:
+        # Discard reports made after the checkpoint, and continue writing.
+        truncate_netcdf(ncfilename, progress["netcdf_dimensions"])
+        ncfile = netCDF4.Dataset(ncfilename, "a")
+        dcd_output_name = f"{obasename}-{runid}-from-{progress['iteration']}.dcd"
+        simulation.currentUpdate = int(progress["current_update"])
+    else:
+        ncfile = netCDF4.Dataset(ncfilename, "w")
+        dcd_output_name = f"{obasename}-{runid}.dcd"
     reporters = settings["reporters"]
+    # Optionally, write reports in a separate thread
+    writer = None
+    if reporters.get("background_writer", False):
+        writer = BackgroundWriter()
+
     if "metadata" in reporters:
-        simulation.update_reporters.append(app.MetadataReporter(ncfile))
+        simulation.update_reporters.append(app.MetadataReporter(ncfile, writer=writer))
 
     if "coordinates" in reporters:
         freq = int(reporters["coordinates"]["frequency"])
@@ -201,11 +288,19 @@ def run_main(jsonfile):
 
     if "titration" in reporters:
         freq = int(reporters["titration"]["frequency"])
-        simulation.update_reporters.append(app.TitrationReporter(ncfile, freq))
+        simulation.update_reporters.append(
+            app.TitrationReporter(
+                ncfile, freq, writer=writer, **buffer_options(reporters["titration"])
+            )
+        )
 
     if "sams" in reporters:
         freq = int(reporters["sams"]["frequency"])
-        simulation.calibration_reporters.append(app.SAMSReporter(ncfile, freq))
+        simulation.calibration_reporters.append(
+            app.SAMSReporter(
+                ncfile, freq, writer=writer, **buffer_options(reporters["sams"])
+            )
+        )
 
     if "ncmc" in reporters:
         freq = int(reporters["ncmc"]["frequency"])
@@ -214,16 +309,42 @@ def run_main(jsonfile):
         else:
             work_interval = 0
         simulation.update_reporters.append(
-            app.NCMCReporter(ncfile, freq, work_interval)
+            app.NCMCReporter(
+                ncfile,
+                freq,
+                work_interval,
+                writer=writer,
+                **buffer_options(reporters["ncmc"])
+            )
         )
 
+    # Optionally, stop the calibration once it has converged
+    monitor = None
+    if "convergence" in settings and driver.calibration_state is not None:
+        convergence = settings["convergence"]
+        options = dict()
+        for key, convert in [
+            ("tolerance", float),
+            ("agreement", float),
+            ("window", int),
+            ("check_interval", int),
+            ("min_samples", int),
+        ]:
+            if key in convergence:
+                options[key] = convert(convergence[key])
+        if "min_stage" in convergence:
+            options["min_stage"] = Stage[convergence["min_stage"].upper()]
+        monitor = app.SAMSConvergenceMonitor(**options)
+        simulation.update_reporters.append(monitor)
+
     total_iterations = int(run["total_update_attempts"])
     md_steps_between_updates = int(run["md_steps_between_updates"])
+    start_iteration = int(progress.get("iteration", 0))
 
     # MAIN SIMULATION LOOP STARTS HERE
 
     try:
-        for i in trange(total_iterations, desc="NCMC attempts"):
+        for i in trange(start_iteration, total_iterations, desc="NCMC attempts"):
             if i == 2:
                 log.info("Simulation seems to be working. Suppressing debugging info.")
                 log.setLevel(logging.INFO)
@@ -235,25 +356,79 @@ def run_main(jsonfile):
                     simulation.update(1, pool="calibration")
                 else:
                     simulation.update(1)
-                simulation.adapt()
+                simulation.adapt(return_gk=False)
+                if monitor is not None:
+                    monitor.record_adaptation(driver.calibration_state)
+                    if monitor.converged():
+                        log.info(
+                            f"Calibration converged after {i + 1} iterations, ending the run."
+                        )
+                        driver.calibration_state.end_adaptation()
+                        break
             else:
                 simulation.update(1)
 
+            completed = i + 1
+            if (
+                checkpointer.enabled
+                and completed < total_iterations
+                and checkpointer.due(completed)
+            ):
+                # The reports need to be on disk before the checkpoint that refers to them.
+                flush_reporters(simulation)
+                checkpointer.save_simulation(
+                    driver,
+                    simulation.context,
+                    simulation.system,
+                    simulation.integrator,
+                    checkpoint.topology_string,
+                    salinator=salinator,
+                    topology_format=checkpoint.topology_format,
+                    progress=dict(
+                        iteration=completed,
+                        current_update=simulation.currentUpdate,
+                        netcdf_dimensions=netcdf_dimension_sizes(ncfile),
+                    ),
+                )
+
     except TimeOutError:
         log.warn("Simulation ran out of time, saving current results.")
 
     finally:
+        # Finish writing any periodic checkpoint first
+        checkpointer.close()
         # export the context
-        create_protons_checkpoint_file(
-            output_checkpoint_file,
-            driver,
-            simulation.context,
-            simulation.system,
-            simulation.integrator,
-            topology_element.text,
-            salinator=salinator,
-        )
-        ncfile.close()
+        if checkpoint_format == "binary":
+            ProtonsCheckpoint.from_simulation(
+                driver,
+                simulation.context,
+                simulation.system,
+                simulation.integrator,
+                checkpoint.topology_string,
+                salinator=salinator,
+                topology_format=checkpoint.topology_format,
+            ).write(output_checkpoint_file, system_store=system_store)
+        else:
+            create_protons_checkpoint_file(
+                output_checkpoint_file,
+                driver,
+                simulation.context,
+                simulation.system,
+                simulation.integrator,
+                checkpoint.topology_string,
+                salinator=salinator,
+            )
+        # Write any reports that are still buffered, and wait for the writer to finish
+        try:
+            flush_reporters(simulation)
+        finally:
+            try:
+                if writer is not None:
+                    writer.close()
+            finally:
+                ncfile.close()
+        # The run is complete, it does not need to be resumed.
+        checkpointer.remove()
         os.chdir(lastdir)
 
 
@@ -5,8 +5,10 @@ import matplotlib as mpl
 # For non-gui plotting
 mpl.use("Agg")
 from protons.app import analysis
+from protons.app.datasets import ProtonsDatasetCollection
 from . import get_test_data
 import netCDF4
+import numpy as np
 import pytest
 import os
 
@@ -50,6 +52,38 @@ class TestBARforSAMS:
                 len(output["0->1"]) == 2
             ), "There should be two values for each transition (estimate, error)"
 
+    def test_parallel_bootstrap_matches_serial(self):
+        """Bootstrapping in a process pool should give the same estimates as serial bootstrapping."""
+        with netCDF4.Dataset(self.a1, "r") as dataset:
+            np.random.seed(1)
+            serial = analysis.bar_all_states(
+                dataset, bootstrap=True, num_bootstrap_samples=120
+            )
+            np.random.seed(1)
+            parallel = analysis.bar_all_states(
+                dataset, bootstrap=True, num_bootstrap_samples=120, nprocesses=2
+            )
+        for transition, (estimate, error) in serial.items():
+            assert np.isclose(estimate, parallel[transition][0])
+            assert np.isclose(error, parallel[transition][1])
+
+    def test_gather_all_transitions(self):
+        """Gathering all transitions at once should match gathering them per pair of states."""
+        with netCDF4.Dataset(self.a1, "r") as dataset:
+            initial, proposed, work, n_states, gk = analysis.calibration_dataset_to_arrays(
+                dataset
+            )
+            transitions = analysis._gather_all_transitions(
+                initial, proposed, work, gk, n_states
+            )
+            for from_state in range(n_states):
+                for to_state in range(from_state + 1, n_states):
+                    forward, reverse = analysis._gather_transitions(
+                        from_state, to_state, initial, proposed, work, gk
+                    )
+                    assert np.allclose(forward, transitions[(from_state, to_state)])
+                    assert np.allclose(reverse, transitions[(to_state, from_state)])
+
     def test_plotting_calibration_defaults(self):
         """
         Try plotting calibration data using the defaults
@@ -143,3 +177,35 @@ class TestMultifileAnalysis:
         analysis.plot_calibration_weight_traces(datasets)
         analysis.plt.show()
         return
+
+    def test_dataset_collection(self):
+        """A collection of files should present the concatenated data of the files."""
+        filenames = [self.a1, self.a2, self.a3]
+        datasets = [netCDF4.Dataset(filename, "r") for filename in filenames]
+        with ProtonsDatasetCollection(filenames, chunk_size=7) as collection:
+            work = collection["Protons/NCMC/total_work"]
+            expected = np.ma.concatenate(
+                [dataset["Protons/NCMC/total_work"][:] for dataset in datasets]
+            )
+            assert work.shape == expected.shape
+            assert np.allclose(work[:], expected)
+            assert np.allclose(work[5:-3:2], expected[5:-3:2])
+            assert np.allclose(work[[-1, 0, 3]], expected[[-1, 0, 3]])
+            assert np.allclose(list(work), expected)
+            # Variables without an update dimension are read from the first file
+            assert (
+                collection["Protons/SAMS/approach"][0]
+                == datasets[0]["Protons/SAMS/approach"][0]
+            )
+
+            from_collection = analysis.gather_trajectories(collection, 0, 1)
+            from_list = analysis.gather_trajectories(datasets, 0, 1)
+            for trajectories, reference in zip(from_collection, from_list):
+                assert len(trajectories) == len(reference)
+                for trajectory, expected_trajectory in zip(trajectories, reference):
+                    assert np.allclose(trajectory, expected_trajectory)
+
+            output = analysis.bar_all_states(collection, bootstrap=False)
+            assert len(output) == 3
+        for dataset in datasets:
+            dataset.close()
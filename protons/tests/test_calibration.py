@@ -6,6 +6,7 @@ from simtk import unit
 from simtk.openmm import openmm as mm
 from . import get_test_data
 from uuid import uuid4
+from types import SimpleNamespace
 import os
 import pytest
 import numpy as np
@@ -13,7 +14,7 @@ from protons.app import AmberProtonDrive, ForceFieldProtonDrive, NCMCProtonDrive
 from protons.app import ForceField
 from protons.app import UniformProposal
 from protons.app.calibration import SAMSCalibrationEngine
-from protons.app.driver import SAMSApproach, Stage, UpdateRule
+from protons.app.driver import SAMSApproach, Stage, UpdateRule, _TitrationAttemptData
 from protons.app import log
 import logging
 
@@ -180,12 +181,66 @@ class TestSAMS:
             xml.count("<Dimension") == 3
         ), "The number of dimensions in the XML output is wrong."
         assert (
-            xml.count("<State") == 12
-        ), "The number of states in the XML output is wrong."
+            xml.count("<State") == 0
+        ), "Only visited states should be in the XML output."
+
+        new_table = app.driver._SAMSState.from_xml(etree.fromstring(xml))
+        assert np.allclose(new_table.free_energies, table.free_energies)
 
+        # Visiting a state stores only that state
+        index = table.state_index(pep.drive.titrationStates)
+        table.add_free_energy(index, 1.0)
+        table.add_observed(index, 1.0)
+        table.normalize_free_energies()
+        xml = etree.tostring(table.to_xml()).decode()
+        assert xml.count("<State") == 1, "Only visited states should be stored."
         new_table = app.driver._SAMSState.from_xml(etree.fromstring(xml))
+        assert np.allclose(new_table.free_energies, table.free_energies)
+        assert np.allclose(new_table.observed_counts, table.observed_counts)
+        assert new_table.max_absolute_deviation == pytest.approx(
+            np.max(np.abs(table.deviation_from_target))
+        )
         return
 
+    def test_sparse_multisite_table(self):
+        """Test that the sparse multisite table behaves like a dense table over all joint states."""
+        state_counts = [2, 3, 4]
+        table = app.driver._SAMSState(state_counts, SAMSApproach.MULTISITE)
+        residue_free_energies = [
+            np.asarray([0.0, 1.0]),
+            np.asarray([0.0, -2.0, 3.0]),
+            np.asarray([0.5, 0.0, 1.5, -1.0]),
+        ]
+        table.set_residue_free_energies(residue_free_energies)
+        dense = (
+            residue_free_energies[0][:, None, None]
+            + residue_free_energies[1][None, :, None]
+            + residue_free_energies[2][None, None, :]
+        ).reshape(-1)
+        counts = np.zeros(dense.size)
+        assert np.allclose(table.free_energies, dense)
+
+        index = np.arange(dense.size).reshape(state_counts)
+        for states in [[1, 2, 3], [0, 1, 0], [1, 2, 3]]:
+            idx = table.state_index(states)
+            assert idx == index[tuple(states)]
+            table.add_free_energy(idx, 0.25)
+            table.add_observed(idx, 2.0)
+            table.normalize_free_energies()
+            dense[idx] += 0.25
+            dense -= dense[0]
+            counts[idx] += 2.0
+            assert table.free_energy(states) == pytest.approx(dense[idx])
+
+        assert np.allclose(table.free_energies, dense)
+        assert np.allclose(table.observed_counts, counts)
+        assert table.max_absolute_deviation == pytest.approx(
+            np.max(np.abs(counts / counts.sum() - 1.0 / dense.size))
+        )
+        # Only the visited states are stored
+        assert len(table._free_energy_table.stored()) == 2
+        assert len(table) == dense.size
+
     def test_onesite_sams_sampling_binary(self):
         """Test the one site sams sampling approach with binary updates"""
         old_log_level = log.getEffectiveLevel()
@@ -251,6 +306,74 @@ class TestSAMS:
         log.setLevel(old_log_level)
         return
 
+    def test_multisite_adapt_stays_sparse(self, monkeypatch):
+        """Test that multisite adaptation of many residues never builds the table of all joint states."""
+
+        def to_dense(table):
+            raise AssertionError("The joint state table was materialized.")
+
+        pep = self.setup_peptide_implicit("hahaha", minimize=False)
+        pep.drive.enable_calibration(SAMSApproach.MULTISITE)
+        pep.simulation = app.ConstantPHSimulation(
+            pep.topology,
+            pep.system,
+            pep.integrator,
+            pep.drive,
+            platform=TestSAMS.platform,
+        )
+        pep.simulation.context.setPositions(pep.positions)
+        calibration_state = pep.drive.calibration_state
+        nresidues = len(pep.drive.titrationGroups)
+        assert nresidues >= 6
+        assert pep.simulation.sams.nstates == np.prod(
+            [len(group) for group in pep.drive.titrationGroups]
+        )
+
+        monkeypatch.setattr(app.driver._SparseJointTable, "to_dense", to_dense)
+        for x in range(20):
+            pep.simulation.update(1)
+            deviation, gk = pep.simulation.adapt(return_gk=False)
+            assert gk is None
+        assert len(calibration_state._free_energy_table.stored()) <= 20
+
+        # The weights are only gathered when requested
+        monkeypatch.undo()
+        assert pep.simulation.last_gk.size == len(calibration_state)
+        pep.simulation.update(1)
+        deviation, gk = pep.simulation.adapt()
+        assert deviation == pep.simulation.last_dev
+        assert np.array_equal(gk, pep.simulation.last_gk)
+        return
+
+    def test_multiwalker_sams_sampling(self):
+        """Test the one site sams sampling approach with two walkers that share their estimates."""
+        walkers = list()
+        for _ in range(2):
+            pep = self.setup_peptide_implicit("yeah", createsim=False)
+            pep.drive.enable_calibration(SAMSApproach.ONESITE, group_index=0)
+            pep.simulation = app.ConstantPHSimulation(
+                pep.topology,
+                pep.system,
+                pep.integrator,
+                pep.drive,
+                platform=TestSAMS.platform,
+            )
+            pep.simulation.context.setPositions(pep.positions)
+            walkers.append(pep.simulation)
+
+        sampler = app.MultiWalkerSAMS(walkers, sync_interval=3)
+        sampler.run(5, md_steps=1)
+        shared = sampler.calibration_state
+
+        # Every walker adapted once per iteration
+        assert shared._current_adaptation == 2 * 5
+        for simulation in walkers:
+            state = simulation.drive.calibration_state
+            assert state is not shared
+            assert state._current_adaptation == shared._current_adaptation
+            assert np.allclose(state.free_energies, shared.free_energies)
+            assert np.allclose(state.observed_counts, shared.observed_counts)
+
     def test_onesite_sams_sampling_binary_all_stages(self):
         """Test the one site sams sampling approach with binary updates through all 4 stages of the algorithm"""
         old_log_level = log.getEffectiveLevel()
@@ -358,3 +481,60 @@ class TestSAMS:
             "Observed counts: %s", str(pep.drive.calibration_state.observed_counts)
         )
         log.setLevel(old_log_level)
+
+
+class TestConvergenceMonitor:
+    """Test the early stopping criteria of SAMS calibrations."""
+
+    @staticmethod
+    def gaussian_work(delta_f: float, sigma: float, nsamples: int, seed: int = 42):
+        """Forward and reverse work of a gaussian process, satisfying the Crooks fluctuation theorem."""
+        random = np.random.RandomState(seed)
+        forward = random.normal(delta_f + sigma ** 2 / 2, sigma, nsamples)
+        reverse = random.normal(-delta_f + sigma ** 2 / 2, sigma, nsamples)
+        return forward, reverse
+
+    def fill_monitor(self, monitor, free_energies, stage=Stage.FASTDECAY):
+        """Add work for a free energy difference of 1 kT between state 0 and 1, and constant zeta."""
+        forward, reverse = self.gaussian_work(1.0, 0.5, 500)
+        for work in forward:
+            monitor.add_work(0, 1, work)
+        for work in reverse:
+            monitor.add_work(1, 0, work)
+        for _ in range(10):
+            monitor.add_free_energies(np.asarray(free_energies), stage)
+
+    def test_report_before_first_attempt(self):
+        """Reports of an attempt without states are skipped."""
+        monitor = app.SAMSConvergenceMonitor(window=10, check_interval=1)
+        attempt = _TitrationAttemptData()
+        attempt.work = 1.0
+        drive = SimpleNamespace(_last_attempt_data=attempt, calibration_state=None)
+        monitor.report(SimpleNamespace(drive=drive))
+        assert len(monitor._transitions) == 0
+
+    def test_converged(self):
+        """SAMS estimates that agree with BAR converge."""
+        monitor = app.SAMSConvergenceMonitor(window=10, check_interval=1)
+        # The SAMS estimate has the opposite sign of the free energy difference
+        self.fill_monitor(monitor, [0.0, -1.0])
+        assert monitor.converged()
+        bar_estimate, bar_sd, sams_estimate = monitor.estimates["0->1"]
+        assert abs(bar_estimate - 1.0) < 0.2
+        assert sams_estimate == 1.0
+
+    def test_not_converged(self):
+        """Disagreement with BAR, fluctuations, or an early stage prevent convergence."""
+        monitor = app.SAMSConvergenceMonitor(window=10, check_interval=1)
+        self.fill_monitor(monitor, [0.0, 0.0])
+        assert not monitor.converged()
+
+        monitor = app.SAMSConvergenceMonitor(window=10, check_interval=1)
+        self.fill_monitor(monitor, [0.0, -1.0])
+        # Fluctuations in the window
+        monitor.add_free_energies(np.asarray([0.0, -2.0]), Stage.FASTDECAY)
+        assert not monitor.converged()
+
+        monitor = app.SAMSConvergenceMonitor(window=10, check_interval=1)
+        self.fill_monitor(monitor, [0.0, -1.0], stage=Stage.SLOWDECAY)
+        assert not monitor.converged()
@@ -6,6 +6,7 @@ from copy import deepcopy
 
 import numpy as np
 import pytest
+from pandas import DataFrame
 from lxml import etree
 from numpy.random import choice
 from saltswap.swapper import Swapper
@@ -15,14 +16,19 @@ import itertools
 
 from protons import app
 from protons.app import AmberProtonDrive, ForceFieldProtonDrive, NCMCProtonDrive
-from protons.app.driver import SamplingMethod
+from protons.app.driver import SamplingMethod, ParameterUpdateMethod
 from protons.app import ForceField
 from protons.app import SAMSCalibrationEngine
 from protons.app import UniformProposal
 from protons.app.proposals import UniformSwapProposal
 from protons.app import ions
 from . import get_test_data
-from .utilities import SystemSetup, create_compound_gbaoab_integrator, hasCUDA
+from .utilities import (
+    SystemSetup,
+    compare_parameter_update_energies,
+    create_compound_gbaoab_integrator,
+    hasCUDA,
+)
 
 
 class TestAmberTyrosineExplicit(object):
@@ -128,6 +134,34 @@ class TestAmberTyrosineExplicit(object):
         )
         driver.import_gk_values(dict(TYR=[0.0, 1.0]))
 
+    def test_tyrosine_state_tables(self):
+        """
+        Check that the incrementally updated state bookkeeping matches the residues
+        """
+        testsystem = self.setup_tyrosine_explicit()
+        driver = AmberProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.cpin_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=0,
+        )
+        driver.import_gk_values(dict(TYR=[0.0, 1.0]))
+
+        def manual_sum_of_gk():
+            return sum(group.state.g_k for group in driver.titrationGroups)
+
+        for state in [1, 0, 1]:
+            driver.set_titration_state(0, state, updateIons=False)
+            assert driver.titrationStates == [
+                group.state_index for group in driver.titrationGroups
+            ]
+            assert driver.sum_of_gk() == pytest.approx(manual_sum_of_gk())
+
+        driver.adjust_to_ph(7.4)
+        assert driver.sum_of_gk() == pytest.approx(manual_sum_of_gk())
+
     def test_tyrosine_sams_instantaneous_binary(self):
         """
         Run SAMS (binary update) tyrosine in explicit solvent with an instanteneous state switch
@@ -180,6 +214,136 @@ class TestAmberTyrosineExplicit(object):
         sams_sampler.driver.update(UniformProposal())  # protonation
         sams_sampler.adapt_zetas(app.driver.UpdateRule.GLOBAL)
 
+    def test_tyrosine_exception_map(self):
+        """
+        Check that the precomputed exception map finds the same 1-4 exceptions as scanning all exceptions
+        """
+        testsystem = self.setup_tyrosine_explicit()
+        driver = AmberProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.cpin_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=0,
+        )
+        nonbonded = driver.forces_to_update[0]
+        group = driver.titrationGroups[0]
+        atoms = set(group.atom_indices)
+        expected = list()
+        for exception_index in range(nonbonded.getNumExceptions()):
+            particle1, particle2 = nonbonded.getExceptionParameters(exception_index)[:2]
+            if (particle1 in atoms or particle2 in atoms) and (
+                particle2 in driver.atomExceptions[particle1]
+            ):
+                expected.append(exception_index)
+
+        assert group.exception_indices == expected, "Exceptions do not match."
+
+    def test_tyrosine_relative_reduced_potentials(self):
+        """
+        Compare reduced potentials of tyrosine states from a side context to switching states in the context
+        """
+        testsystem = self.setup_tyrosine_explicit()
+        compound_integrator = create_compound_gbaoab_integrator(testsystem)
+        driver = AmberProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.cpin_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=0,
+        )
+        platform = openmm.Platform.getPlatformByName(self.default_platform)
+        context = openmm.Context(testsystem.system, compound_integrator, platform)
+        context.setPositions(testsystem.positions)  # set to minimized positions
+        context.setVelocitiesToTemperature(testsystem.temperature)
+        driver.attach_context(context)
+
+        reference = np.asarray(driver._get_reduced_potentials(0), dtype=float)
+        energy_before = context.getState(getEnergy=True).getPotentialEnergy()
+        relative = driver._get_relative_reduced_potentials(0)
+        energy_after = context.getState(getEnergy=True).getPotentialEnergy()
+
+        assert energy_before == energy_after, "The context should not be modified."
+        assert np.allclose(
+            reference - reference[0], relative - relative[0], rtol=0.0, atol=1.0e-2
+        ), "Reduced potential differences between states do not match."
+
+    @pytest.mark.skipif(
+        not hasattr(openmm.NonbondedForce, "addParticleParameterOffset"),
+        reason="OpenMM version does not support parameter offsets.",
+    )
+    def test_tyrosine_global_parameter_offsets_energies(self):
+        """
+        Compare energies of tyrosine states set using global parameter offsets to setting force parameters
+        """
+        platform = openmm.Platform.getPlatformByName(self.default_platform)
+
+        def create_drive(method):
+            testsystem = self.setup_tyrosine_explicit()
+            compound_integrator = create_compound_gbaoab_integrator(testsystem)
+            driver = AmberProtonDrive(
+                testsystem.temperature,
+                testsystem.topology,
+                testsystem.system,
+                testsystem.cpin_filename,
+                pressure=testsystem.pressure,
+                perturbations_per_trial=0,
+                parameter_update_method=method,
+            )
+            context = openmm.Context(testsystem.system, compound_integrator, platform)
+            context.setPositions(testsystem.positions)
+            driver.attach_context(context)
+            return driver
+
+        compare_parameter_update_energies(create_drive)
+
+    @pytest.mark.skipif(
+        not hasattr(openmm.NonbondedForce, "addParticleParameterOffset"),
+        reason="OpenMM version does not support parameter offsets.",
+    )
+    def test_tyrosine_implicit_global_parameter_offsets_energies(self):
+        """
+        Compare energies of tyrosine states in implicit solvent set using global parameter offsets to setting force parameters
+
+        The GBSAOBCForce is still updated by setting force parameters.
+        """
+        platform = openmm.Platform.getPlatformByName(self.default_platform)
+        testsystems = get_test_data("tyr_implicit", "testsystems")
+
+        def create_drive(method):
+            testsystem = self.setup_tyrosine_explicit()
+            testsystem.pressure = None
+            testsystem.positions = openmm.XmlSerializer.deserialize(
+                open("{}/tyr.state.xml".format(testsystems)).read()
+            ).getPositions(asNumpy=True)
+            testsystem.system = openmm.XmlSerializer.deserialize(
+                open("{}/tyr.sys.xml".format(testsystems)).read()
+            )
+            testsystem.topology = app.AmberPrmtopFile(
+                "{}/tyr.prmtop".format(testsystems)
+            ).topology
+            testsystem.cpin_filename = "{}/tyr.cpin".format(testsystems)
+            compound_integrator = create_compound_gbaoab_integrator(testsystem)
+            driver = AmberProtonDrive(
+                testsystem.temperature,
+                testsystem.topology,
+                testsystem.system,
+                testsystem.cpin_filename,
+                perturbations_per_trial=0,
+                parameter_update_method=method,
+            )
+            assert "GBSAOBCForce" in [
+                force.__class__.__name__ for force in driver.forces_to_update
+            ]
+            context = openmm.Context(testsystem.system, compound_integrator, platform)
+            context.setPositions(testsystem.positions)
+            driver.attach_context(context)
+            return driver
+
+        compare_parameter_update_energies(create_drive)
+
     def test_tyrosine_ncmc(self):
         """
         Run tyrosine in explicit solvent with an ncmc state switch
@@ -204,6 +368,305 @@ class TestAmberTyrosineExplicit(object):
         compound_integrator.step(10)  # MD
         driver.update(UniformProposal(), nattempts=10)  # protonation
 
+    def test_tyrosine_ncmc_coordinates_on_demand(self):
+        """
+        Run tyrosine in explicit solvent with an ncmc state switch, storing final coordinates only when requested
+        """
+        testsystem = self.setup_tyrosine_explicit()
+
+        compound_integrator = create_compound_gbaoab_integrator(testsystem)
+        driver = AmberProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.cpin_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=2,
+        )
+        platform = openmm.Platform.getPlatformByName(self.default_platform)
+        context = openmm.Context(testsystem.system, compound_integrator, platform)
+        context.setPositions(testsystem.positions)  # set to minimized positions
+        context.setVelocitiesToTemperature(testsystem.temperature)
+        driver.attach_context(context)
+
+        driver.update(UniformProposal(), nattempts=1)
+        assert driver._last_attempt_data._proposed_positions is None
+        assert driver._last_attempt_data.initial_positions is not None
+
+        driver.record_proposed_coordinates = True
+        driver.update(UniformProposal(), nattempts=1)
+        assert driver._last_attempt_data.proposed_positions.shape == (
+            testsystem.system.getNumParticles(),
+            3,
+        )
+
+    def test_tyrosine_ncmc_reject_restores_state(self):
+        """
+        Reject an ncmc state switch for tyrosine, and check that the initial state is restored
+        """
+        testsystem = self.setup_tyrosine_explicit()
+
+        compound_integrator = create_compound_gbaoab_integrator(testsystem)
+        driver = AmberProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.cpin_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=2,
+        )
+        platform = openmm.Platform.getPlatformByName(self.default_platform)
+        context = openmm.Context(testsystem.system, compound_integrator, platform)
+        context.setPositions(testsystem.positions)  # set to minimized positions
+        context.setVelocitiesToTemperature(testsystem.temperature)
+        driver.attach_context(context)
+
+        initial_states = driver.titrationStates
+        before = context.getState(getPositions=True, getEnergy=True)
+        driver._accept_reject = lambda log_P_accept: False
+        driver._perform_attempt(driver._propose_given_change([1 - initial_states[0]]))
+        after = context.getState(getPositions=True, getEnergy=True)
+
+        assert driver.titrationStates == initial_states
+        assert driver._last_attempt_data.accepted is False
+        assert np.all(
+            before.getPositions(asNumpy=True) == after.getPositions(asNumpy=True)
+        ), "Positions should be restored after rejection."
+        assert np.isclose(
+            before.getPotentialEnergy().value_in_unit(unit.kilojoule_per_mole),
+            after.getPotentialEnergy().value_in_unit(unit.kilojoule_per_mole),
+        ), "Energy should be restored after rejection."
+        assert before.getTime() < after.getTime(), "Time should not be restored."
+        assert driver._last_attempt_data.initial_positions.shape == (
+            testsystem.system.getNumParticles(),
+            3,
+        )
+
+    def test_tyrosine_ncmc_parallel_proposals(self):
+        """
+        Run tyrosine in explicit solvent with multiple ncmc proposals per attempt
+        """
+        testsystem = self.setup_tyrosine_explicit()
+
+        compound_integrator = create_compound_gbaoab_integrator(testsystem)
+        driver = AmberProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.cpin_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=2,
+        )
+        platform = openmm.Platform.getPlatformByName(self.default_platform)
+        context = openmm.Context(testsystem.system, compound_integrator, platform)
+        context.setPositions(testsystem.positions)  # set to minimized positions
+        context.setVelocitiesToTemperature(testsystem.temperature)
+        driver.attach_context(context)
+        driver.enable_parallel_proposals(2)
+
+        compound_integrator.step(10)  # MD
+        driver.update(UniformProposal(), nattempts=10)  # protonation
+        assert driver.nattempted == driver.naccepted + driver.nrejected
+        assert driver._last_attempt_data._proposed_positions is None
+
+        # An accepted trial places its end point in the context, with flipped velocities
+        driver.record_proposed_coordinates = True
+        driver._accept_reject = lambda log_P_accept: True
+        driver.update(UniformProposal(), nattempts=1)
+        attempt_data = driver._last_attempt_data
+        after = context.getState(getPositions=True, getVelocities=True)
+        assert attempt_data.accepted is True
+        assert driver.titrationStates == list(attempt_data.proposed_states)
+        assert np.allclose(
+            after.getPositions(asNumpy=True).value_in_unit(unit.nanometer),
+            attempt_data.proposed_positions,
+        ), "The context should hold the end point of the selected trial."
+        assert np.allclose(
+            after.getVelocities(asNumpy=True).value_in_unit(
+                unit.nanometer / unit.picosecond
+            ),
+            -attempt_data.proposed_velocities,
+        ), "Velocities should be flipped relative to the end of the selected trial."
+        driver.disable_parallel_proposals()
+
+    def test_tyrosine_adaptive_protocol_length(self):
+        """
+        Tune the ncmc protocol length for tyrosine, and freeze it after warm-up
+        """
+        testsystem = self.setup_tyrosine_explicit()
+        driver = AmberProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.cpin_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=2,
+            propagations_per_step=2,
+        )
+        driver.enable_adaptive_protocol_length(warmup_attempts=8, tune_interval=4)
+        controller = driver._protocol_controller
+        initial, final = [0], [1]
+
+        # Work variance far above the target requires a longer protocol
+        for work in [0.0, 20.0, -20.0, 10.0]:
+            controller.record([0], initial, final, work, -5.0)
+        assert driver.propagations_per_step_per_residue == [4]
+        assert driver._propagations_for([0]) == 4
+        assert not driver.adaptive_protocol_frozen
+
+        # No work variance allows a shorter protocol
+        for work in [1.0, 1.0, 1.0, 1.0]:
+            controller.record([0], initial, final, work, 0.0)
+        assert driver.propagations_per_step_per_residue == [2]
+        assert driver.adaptive_protocol_frozen
+
+        controller.record([0], initial, final, 100.0, -100.0)
+        assert driver.propagations_per_step_per_residue == [2]
+
+    def test_tyrosine_adaptive_protocol_length_serialization(self):
+        """
+        Store and restore the tuned ncmc protocol length for tyrosine, during and after warm-up
+        """
+        testsystem = self.setup_tyrosine_explicit()
+        driver = AmberProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.cpin_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=2,
+            propagations_per_step=2,
+        )
+        driver.enable_adaptive_protocol_length(
+            warmup_attempts=8, tune_interval=4, max_propagations_per_step=16
+        )
+        controller = driver._protocol_controller
+        initial, final = [0], [1]
+        for work in [0.0, 20.0, -20.0, 10.0, 5.0]:
+            controller.record([0], initial, final, work, -5.0)
+
+        def restore(drive):
+            newdrive = NCMCProtonDrive(
+                testsystem.temperature,
+                testsystem.topology,
+                testsystem.system,
+                pressure=testsystem.pressure,
+                perturbations_per_trial=2,
+                propagations_per_step=2,
+            )
+            newdrive.state_from_xml_tree(etree.fromstring(drive.state_to_xml()))
+            return newdrive
+
+        # Warm-up continues where it left off
+        newdrive = restore(driver)
+        restored = newdrive._protocol_controller
+        assert newdrive.propagations_per_step_per_residue == [4]
+        assert not newdrive.adaptive_protocol_frozen
+        assert restored.nattempts == controller.nattempts
+        assert restored.max_propagations_per_step == 16
+        assert np.array_equal(restored._group_attempts, controller._group_attempts)
+        assert restored._transition_works == controller._transition_works
+
+        # A frozen schedule stays frozen
+        for work in [1.0, 1.0, 1.0]:
+            controller.record([0], initial, final, work, 0.0)
+        assert driver.adaptive_protocol_frozen
+        newdrive = restore(driver)
+        assert newdrive.adaptive_protocol_frozen
+        assert (
+            newdrive.propagations_per_step_per_residue
+            == driver.propagations_per_step_per_residue
+        )
+        newdrive._protocol_controller.record([0], initial, final, 100.0, -100.0)
+        assert (
+            newdrive.propagations_per_step_per_residue
+            == driver.propagations_per_step_per_residue
+        )
+
+    def test_tyrosine_packed_force_cache(self):
+        """
+        Check that the packed force parameter arrays reproduce the cached parameters of tyrosine
+        """
+        testsystem = self.setup_tyrosine_explicit()
+        driver = AmberProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.cpin_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=0,
+        )
+        group = driver.titrationGroups[0]
+        for force_index, packed in enumerate(group.packed_forces):
+            names = packed.particle_parameter_names[packed.force_classname]
+            for state_index, state in enumerate(group):
+                atoms = state.forces[force_index]["atoms"]
+                assert np.all(
+                    packed.atom_indices == [atom["atom_index"] for atom in atoms]
+                ), "Atom indices are not in the order of the cache."
+                for atom, params in zip(atoms, packed.atom_parameters[state_index]):
+                    assert np.allclose(
+                        [atom[name] for name in names], params, rtol=0.0, atol=1.0e-12
+                    ), "Packed atom parameters differ from the cache."
+
+            # Halfway between the states, parameters should be the mean of both states
+            blended = packed.blend_atoms(0, 1, 0.5)
+            assert np.allclose(
+                blended,
+                0.5 * (packed.atom_parameters[0] + packed.atom_parameters[1]),
+                rtol=0.0,
+                atol=1.0e-12,
+            ), "Blended parameters are not interpolated linearly."
+
+        # Setting the state should place the cached parameters in the force
+        driver.set_titration_state(0, 1, updateContextParameters=False)
+        nonbonded = driver.forces_to_update[0]
+        for atom in group[1].forces[0]["atoms"]:
+            charge = nonbonded.getParticleParameters(atom["atom_index"])[0]
+            assert np.isclose(
+                charge / unit.elementary_charge, atom["charge"], rtol=0.0, atol=1.0e-12
+            ), "Charge was not updated from the packed cache."
+
+    def test_tyrosine_force_cache_arrays(self):
+        """
+        Restore a tyrosine drive from xml without force parameters, and the force parameter arrays
+        """
+        testsystem = self.setup_tyrosine_explicit()
+        olddrive = AmberProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.cpin_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=0,
+        )
+        x = olddrive.state_to_xml(include_forces=False)
+        assert b"<force" not in x, "Force parameters should not be serialized."
+        arrays = olddrive.force_cache_arrays()
+
+        newdrive = NCMCProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=0,
+        )
+        newdrive.state_from_xml_tree(etree.fromstring(x), force_arrays=arrays)
+
+        for old_res, new_res in zip(olddrive.titrationGroups, newdrive.titrationGroups):
+            assert old_res == new_res, "Residues don't match. {} :: {}".format(
+                old_res.name, new_res.name
+            )
+            for old_packed, new_packed in zip(
+                old_res.packed_forces, new_res.packed_forces
+            ):
+                assert np.array_equal(
+                    old_packed.atom_parameters, new_packed.atom_parameters
+                )
+                assert np.array_equal(
+                    old_packed.exception_parameters, new_packed.exception_parameters
+                )
+
 
 class TestForceFieldImidazoleExplicit(object):
     """Tests for imidazole in explict solvent (TIP3P)"""
@@ -267,6 +730,135 @@ class TestForceFieldImidazoleExplicit(object):
         compound_integrator.step(10)  # MD
         driver.update(UniformProposal())  # protonation
 
+    @pytest.mark.skipif(
+        not hasattr(openmm.NonbondedForce, "addParticleParameterOffset"),
+        reason="OpenMM version does not support parameter offsets.",
+    )
+    def test_imidazole_ncmc_parameter_offsets(self):
+        """
+        Run imidazole in explicit solvent with ncmc switches performed using parameter offsets
+        """
+        testsystem = self.setup_imidazole_explicit()
+        compound_integrator = create_compound_gbaoab_integrator(testsystem)
+        driver = ForceFieldProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.forcefield,
+            testsystem.ffxml_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=5,
+        )
+        platform = openmm.Platform.getPlatformByName(self.default_platform)
+        context = openmm.Context(testsystem.system, compound_integrator, platform)
+        context.setPositions(testsystem.positions)  # set to minimized positions
+        context.setVelocitiesToTemperature(testsystem.temperature)
+        driver.attach_context(context)
+        driver.enable_ncmc_parameter_offsets()
+        assert (
+            driver.parameter_update_method
+            is ParameterUpdateMethod.NCMC_PARAMETER_OFFSETS
+        )
+
+        compound_integrator.step(10)  # MD
+        driver.update(UniformProposal(), nattempts=3)  # protonation
+
+        # After the protocol, the parameters of the current state are in the force, and the offsets are off.
+        offsets = driver._ncmc_parameter_offsets
+        assert context.getParameter(offsets.ncmc_parameter_name) == 0.0
+        group = driver.titrationGroups[0]
+        for atom in group.state.forces[0]["atoms"]:
+            charge = offsets.force.getParticleParameters(atom["atom_index"])[0]
+            assert np.isclose(
+                charge / unit.elementary_charge, atom["charge"], rtol=0.0, atol=1.0e-12
+            ), "Charges do not match the current state."
+
+    @pytest.mark.skipif(
+        not hasattr(openmm.NonbondedForce, "addParticleParameterOffset"),
+        reason="OpenMM version does not support parameter offsets.",
+    )
+    def test_imidazole_ncmc_parameter_offsets_failed_protocol(self):
+        """
+        Switch the ncmc parameter offsets off again if the protocol fails halfway
+        """
+        testsystem = self.setup_imidazole_explicit()
+        compound_integrator = create_compound_gbaoab_integrator(testsystem)
+        driver = ForceFieldProtonDrive(
+            testsystem.temperature,
+            testsystem.topology,
+            testsystem.system,
+            testsystem.forcefield,
+            testsystem.ffxml_filename,
+            pressure=testsystem.pressure,
+            perturbations_per_trial=5,
+        )
+        platform = openmm.Platform.getPlatformByName(self.default_platform)
+        context = openmm.Context(testsystem.system, compound_integrator, platform)
+        context.setPositions(testsystem.positions)  # set to minimized positions
+        context.setVelocitiesToTemperature(testsystem.temperature)
+        driver.attach_context(context)
+        driver.enable_ncmc_parameter_offsets()
+
+        class FailingIntegrator:
+            """Fails after the first propagation of the protocol."""
+
+            def __init__(self, integrator):
+                self.integrator = integrator
+                self.nsteps = 0
+
+            def __getattr__(self, name):
+                return getattr(self.integrator, name)
+
+            def step(self, nsteps):
+                self.nsteps += 1
+                if self.nsteps > 1:
+                    raise RuntimeError("Integration failed.")
+                self.integrator.step(nsteps)
+
+        driver.ncmc_integrator = FailingIntegrator(driver.ncmc_integrator)
+        initial_state = driver.titrationGroups[0].state_index
+        final_state = (initial_state + 1) % len(driver.titrationGroups[0])
+        with pytest.raises(RuntimeError):
+            driver._perform_ncmc_protocol([0], [initial_state], [final_state])
+
+        offsets = driver._ncmc_parameter_offsets
+        assert context.getParameter(offsets.ncmc_parameter_name) == 0.0
+        for atom in driver.titrationGroups[0][initial_state].forces[0]["atoms"]:
+            charge = offsets.force.getParticleParameters(atom["atom_index"])[0]
+            assert np.isclose(
+                charge / unit.elementary_charge, atom["charge"], rtol=0.0, atol=1.0e-12
+            ), "Charges do not match the initial state."
+
+    @pytest.mark.skipif(
+        not hasattr(openmm.NonbondedForce, "addParticleParameterOffset"),
+        reason="OpenMM version does not support parameter offsets.",
+    )
+    def test_imidazole_global_parameter_offsets_energies(self):
+        """
+        Compare energies of imidazole states set using global parameter offsets to setting force parameters
+        """
+        platform = openmm.Platform.getPlatformByName(self.default_platform)
+
+        def create_drive(method):
+            testsystem = self.setup_imidazole_explicit()
+            compound_integrator = create_compound_gbaoab_integrator(testsystem)
+            driver = ForceFieldProtonDrive(
+                testsystem.temperature,
+                testsystem.topology,
+                testsystem.system,
+                testsystem.forcefield,
+                testsystem.ffxml_filename,
+                pressure=testsystem.pressure,
+                perturbations_per_trial=0,
+                parameter_update_method=method,
+            )
+            context = openmm.Context(testsystem.system, compound_integrator, platform)
+            context.setPositions(testsystem.positions)
+            driver.attach_context(context)
+            return driver
+
+        compare_parameter_update_energies(create_drive)
+
     @staticmethod
     def pattern_from_multiline(multiline, pattern):
         """Return only lines that contain the pattern
@@ -1016,6 +1608,41 @@ class TestForceFieldImidazoleExplicitpHAdjusted:
             before_group == after_group
         ), "The deserialized group does not match what was serialized."
 
+    def test_population_table(self):
+        """
+        Look up, interpolate and share the compiled log populations of pKa data.
+        """
+        rows = list()
+        for pH, populations in [(6.0, [0.9, 0.1]), (8.0, [0.1, 0.9])]:
+            for state, population in enumerate(populations):
+                rows.append(
+                    {
+                        "State": state,
+                        "pH": pH,
+                        "Temperature (K)": 298.15,
+                        "Ionic strength (mM)": None,
+                        "log population": np.log(population),
+                    }
+                )
+        pka_data = DataFrame(rows)
+        table = app.driver._PopulationTable.for_residue("TST", pka_data)
+        assert table is app.driver._PopulationTable.for_residue(
+            "TST", pka_data.copy()
+        ), "Tables should be shared for identical data."
+
+        # Tabulated values are returned as is
+        assert np.allclose(table.log_populations(6.0), np.log([0.9, 0.1]))
+        assert np.allclose(
+            table.log_populations(8.0, temperature=298.15, ionic_strength=150.0),
+            np.log([0.1, 0.9]),
+        )
+        # Interpolated values are normalized
+        assert np.allclose(np.exp(table.log_populations(7.0)), [0.5, 0.5])
+
+        for pH, temperature in [(5.0, None), (9.0, None), (7.0, 310.0)]:
+            with pytest.raises(ValueError):
+                table.log_populations(pH, temperature=temperature)
+
 
 class TestForceFieldImidazoleSaltswap:
     """Tests for saltswap dependent functionality on imidazole in explicit solvent."""
@@ -1,7 +1,22 @@
 """This module tests the scripts included with protons."""
 import os
 import pytest
-from protons.scripts import run_parametrize_ligand, run_prep_ffxml, run_simulation, cli
+from protons.scripts import (
+    run_parametrize_ligand,
+    run_prep_ffxml,
+    run_simulation,
+    run_calibration_campaign,
+    cli,
+)
+from protons.scripts.checkpoint import (
+    PeriodicCheckpointer,
+    ProtonsCheckpoint,
+    convert_xml_checkpoint,
+    read_checkpoint,
+    load_progress_checkpoint,
+    netcdf_dimension_sizes,
+    truncate_netcdf,
+)
 from .utilities import (
     hasOpenEye,
     hasCUDA,
@@ -10,6 +25,9 @@ from .utilities import (
 )
 from . import get_test_data
 from shutil import copy, rmtree
+import netCDF4
+import numpy as np
+import toml
 
 
 @pytest.mark.slowtest
@@ -389,6 +407,267 @@ class TestRunScript:
         if TestRunScript.remove_tempfiles:
             rmtree(tmpdir)
 
+    def test_run_binary_checkpoint(self):
+        """Run a calibration from a binary checkpoint, and write a binary checkpoint."""
+        toml_input = os.path.join(TestRunScript.input_dir, "run_calibration.toml")
+        checkpoint_file = os.path.join(
+            TestRunScript.input_dir, "1D-calibration-checkpoint-0.xml"
+        )
+        tmpdir = files_to_tempdir([checkpoint_file, toml_input])
+        olddir = os.getcwd()
+        os.chdir(tmpdir)
+
+        convert_xml_checkpoint(
+            "1D-calibration-checkpoint-0.xml", "1D-calibration-checkpoint-0.chk"
+        )
+        settings = toml.load("run_calibration.toml")
+        binary_input = "{name}-calibration-checkpoint-{previous_run_idx}.chk"
+        settings["input"]["checkpoint"] = binary_input
+        settings["output"]["checkpoint_format"] = "binary"
+        settings["output"]["system_store"] = "systems"
+        with open("run_calibration_binary.toml", "w") as tomlfile:
+            toml.dump(settings, tomlfile)
+
+        run_simulation.run_main("run_calibration_binary.toml")
+
+        output = "output/1D-calibration-checkpoint-1.chk"
+        assert os.path.isfile(output), f"No checkpoint file was produced in {tmpdir}"
+        checkpoint = read_checkpoint(output)
+        assert checkpoint.positions.shape == checkpoint.velocities.shape
+
+        os.chdir(olddir)
+        if TestRunScript.remove_tempfiles:
+            rmtree(tmpdir)
+
+    def test_run_periodic_checkpoints(self):
+        """Run a calibration with periodic checkpoints, which are removed once the run completes."""
+        toml_input = os.path.join(TestRunScript.input_dir, "run_calibration.toml")
+        checkpoint_file = os.path.join(
+            TestRunScript.input_dir, "1D-calibration-checkpoint-0.xml"
+        )
+        tmpdir = files_to_tempdir([checkpoint_file, toml_input])
+        olddir = os.getcwd()
+        os.chdir(tmpdir)
+
+        settings = toml.load("run_calibration.toml")
+        settings["run"]["checkpoint_interval"] = 1
+        settings["run"]["async_checkpoint"] = True
+        with open("run_calibration_periodic.toml", "w") as tomlfile:
+            toml.dump(settings, tomlfile)
+
+        run_simulation.run_main("run_calibration_periodic.toml")
+
+        assert os.path.isfile("output/1D-calibration-checkpoint-1.xml")
+        assert not os.path.isfile(
+            "output/1D-calibration-checkpoint-1-progress.xml"
+        ), "The checkpoint of a completed run should be removed."
+
+        os.chdir(olddir)
+        if TestRunScript.remove_tempfiles:
+            rmtree(tmpdir)
+
+    def test_resume_interrupted_run(self, monkeypatch):
+        """Resume a run from its progress checkpoint, discarding the reports written after it."""
+        toml_input = os.path.join(TestRunScript.input_dir, "run_calibration.toml")
+        checkpoint_file = os.path.join(
+            TestRunScript.input_dir, "1D-calibration-checkpoint-0.xml"
+        )
+        tmpdir = files_to_tempdir([checkpoint_file, toml_input])
+        olddir = os.getcwd()
+        os.chdir(tmpdir)
+
+        settings = toml.load("run_calibration.toml")
+        settings["output"]["checkpoint_format"] = "binary"
+        settings["output"]["system_store"] = "systems"
+        settings["run"]["checkpoint_interval"] = 1
+        settings["run"]["async_checkpoint"] = True
+        with open("run_calibration_resume.toml", "w") as tomlfile:
+            toml.dump(settings, tomlfile)
+
+        # Keep the progress checkpoint, as if the run was interrupted after its last update
+        with monkeypatch.context() as patch:
+            patch.setattr(PeriodicCheckpointer, "remove", lambda self: None)
+            run_simulation.run_main("run_calibration_resume.toml")
+
+        ncfilename = "output/1D-calibration-1.nc"
+        progress_file = "output/1D-calibration-checkpoint-1-progress.chk"
+        with netCDF4.Dataset(ncfilename, "r") as ncfile:
+            complete_sizes = netcdf_dimension_sizes(ncfile)
+            updates = np.array(ncfile["Protons/Titration/update"][:])
+            adaptations = np.array(ncfile["Protons/SAMS/adaptation"][:])
+
+        # The last checkpoint is made before the last iteration, whose reports are extra rows
+        checkpoint = load_progress_checkpoint(progress_file, ncfilename)
+        assert checkpoint is not None
+        assert checkpoint.progress["iteration"] == 2
+        dimensions = checkpoint.progress["netcdf_dimensions"]
+        assert dimensions["/Protons/Titration"]["update"] < updates.size
+        assert dimensions["/Protons/SAMS"]["adaptation"] < adaptations.size
+        # The ion parameters of the System are restored from the saltswap state
+        assert checkpoint.saltswap_state_vector is not None
+        # A checkpoint with more reports than the file is not resumed
+        assert load_progress_checkpoint(progress_file, "missing.nc") is None
+
+        run_simulation.run_main("run_calibration_resume.toml")
+
+        assert os.path.isfile("output/1D-calibration-1-from-2.dcd")
+        assert not os.path.isfile(progress_file)
+        with netCDF4.Dataset(ncfilename, "r") as ncfile:
+            assert netcdf_dimension_sizes(ncfile) == complete_sizes
+            # The resumed run continues the update and adaptation counters
+            assert np.array_equal(ncfile["Protons/Titration/update"][:], updates)
+            assert np.array_equal(ncfile["Protons/SAMS/adaptation"][:], adaptations)
+
+        os.chdir(olddir)
+        if TestRunScript.remove_tempfiles:
+            rmtree(tmpdir)
+
+
+@pytest.mark.slowtest
+class TestCampaignScript:
+    """Test the script that calibrates many residues."""
+
+    prep_dir = get_test_data("prep-cli", "cli-tests")
+    run_dir = get_test_data("run-cli", "cli-tests")
+
+    def test_implicit_campaign(self):
+        """Prepare and calibrate a ligand in implicit solvent, using two successive runs."""
+        tmpdir = files_to_tempdir(
+            [
+                os.path.join(TestCampaignScript.prep_dir, "1D-vacuum.cif"),
+                os.path.join(TestCampaignScript.prep_dir, "1D.xml"),
+                os.path.join(
+                    TestCampaignScript.prep_dir, "prepare_calibration_implicit.toml"
+                ),
+                os.path.join(
+                    TestCampaignScript.run_dir, "run_calibration_implicit.toml"
+                ),
+            ]
+        )
+        olddir = os.getcwd()
+        os.chdir(tmpdir)
+
+        settings = dict(
+            campaign=dict(
+                dir="campaign",
+                prepare="prepare_calibration_implicit.toml",
+                run="run_calibration_implicit.toml",
+                processes=1,
+                max_runs=2,
+                output="free-energies.toml",
+            ),
+            residues={"1D": dict(structure="1D-vacuum.cif")},
+        )
+        with open("campaign.toml", "w") as tomlfile:
+            toml.dump(settings, tomlfile)
+
+        results = run_calibration_campaign.run_campaign_main("campaign.toml")
+
+        # Three updates per run do not reach equilibrium
+        assert results["1D"]["runs"] == 2
+        assert not results["1D"]["converged"]
+        assert os.path.isfile("campaign/1D/1D-checkpoint-2.xml")
+        table = toml.load("free-energies.toml")
+        assert table["reference_free_energies"] == {}
+        assert table["calibrations"]["1D"]["stage"] == results["1D"]["stage"]
+
+        # Rerunning the campaign continues from the existing checkpoints
+        results = run_calibration_campaign.run_campaign_main("campaign.toml")
+        assert results["1D"]["runs"] == 2
+
+        os.chdir(olddir)
+        rmtree(tmpdir)
+
+    def test_campaign_results(self):
+        """Write the results of a campaign, and load the free energies of converged residues."""
+        tmpdir = files_to_tempdir([])
+        filename = os.path.join(tmpdir, "free-energies.toml")
+        results = {
+            "asp": dict(
+                name="asp",
+                residue_type="AS4",
+                stage="equilibrium",
+                adaptation=1000,
+                max_absolute_deviation=0.01,
+                free_energies=[0.0, -1.5, -1.5, -2.0, -2.0],
+                runs=3,
+                converged=True,
+            ),
+            "glu": dict(name="glu", converged=False, error="RuntimeError()"),
+        }
+        run_calibration_campaign.write_campaign_results(filename, results)
+
+        gk_dict = run_calibration_campaign.load_reference_free_energies(filename)
+        assert list(gk_dict) == ["AS4"]
+        assert np.allclose(gk_dict["AS4"], [0.0, -1.5, -1.5, -2.0, -2.0])
+        assert toml.load(filename)["calibrations"]["glu"]["error"] == "RuntimeError()"
+        rmtree(tmpdir)
+
+
+class TestCheckpoint:
+    """Test the conversion between checkpoint formats."""
+
+    input_dir = get_test_data("run-cli", "cli-tests")
+
+    def test_convert_xml_checkpoint(self):
+        """Convert an xml checkpoint to binary and back, without changing the contents."""
+        checkpoint_file = os.path.join(
+            TestCheckpoint.input_dir, "1D-calibration-checkpoint-0.xml"
+        )
+        tmpdir = files_to_tempdir([checkpoint_file])
+        original = ProtonsCheckpoint.from_xml(checkpoint_file)
+
+        binary_file = os.path.join(tmpdir, "checkpoint.chk")
+        convert_xml_checkpoint(checkpoint_file, binary_file, system_store=tmpdir)
+        binary = read_checkpoint(binary_file)
+
+        xml_file = os.path.join(tmpdir, "checkpoint.xml")
+        binary.to_xml(xml_file)
+        exported = read_checkpoint(xml_file)
+
+        for checkpoint in [binary, exported]:
+            assert np.array_equal(checkpoint.positions, original.positions)
+            assert np.array_equal(checkpoint.velocities, original.velocities)
+            assert np.array_equal(checkpoint.box_vectors, original.box_vectors)
+            assert np.array_equal(
+                checkpoint.saltswap_state_vector, original.saltswap_state_vector
+            )
+            assert checkpoint.parameters == original.parameters
+            assert checkpoint.system_xml == original.system_xml
+            assert checkpoint.drive_xml == original.drive_xml
+            assert checkpoint.topology_string == original.topology_string
+
+        # The exported state can be read by openmm
+        exported.system()
+        rmtree(tmpdir)
+
+    def test_truncate_netcdf(self):
+        """Truncate the unlimited dimensions of a file, as is done to resume an interrupted run."""
+        tmpdir = files_to_tempdir([])
+        filename = os.path.join(tmpdir, "reports.nc")
+        with netCDF4.Dataset(filename, "w") as ncfile:
+            grp = ncfile.createGroup("Protons/Titration")
+            grp.createDimension("update", None)
+            grp.createDimension("residue", 2)
+            grp.createVariable("state", int, ("update", "residue"))
+            grp["state"][:5] = np.arange(10).reshape(5, 2)
+            grp.createVariable("residue_names", str, ("residue",))
+            grp["residue_names"][:] = np.asarray(["ASP", "GLU"], dtype=object)
+            ncfile.sync()
+            sizes = netcdf_dimension_sizes(ncfile)
+            assert sizes == {"/Protons/Titration": {"update": 5}}
+            grp["state"][5:8] = np.zeros((3, 2), dtype=int)
+
+        truncate_netcdf(filename, sizes)
+
+        with netCDF4.Dataset(filename, "r") as ncfile:
+            grp = ncfile["Protons/Titration"]
+            assert len(grp.dimensions["update"]) == 5
+            assert grp.dimensions["update"].isunlimited()
+            assert np.array_equal(grp["state"][:], np.arange(10).reshape(5, 2))
+            assert list(grp["residue_names"][:]) == ["ASP", "GLU"]
+        rmtree(tmpdir)
+
 
 class TestCLI:
     pass
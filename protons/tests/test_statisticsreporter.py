@@ -0,0 +1,134 @@
+# coding=utf-8
+"""Test functionality of the StatisticsReporter."""
+from protons import app
+from protons.app import StatisticsReporter
+from simtk import unit, openmm as mm
+from protons.app import GBAOABIntegrator, ForceFieldProtonDrive
+from . import get_test_data
+import uuid
+import json
+import numpy as np
+import os
+import pytest
+
+travis = os.environ.get("TRAVIS", None)
+
+
+@pytest.mark.skipif(travis == "true", reason="Travis segfaulting risk.")
+class TestStatisticsReporter(object):
+    """Tests use cases for the StatisticsReporter"""
+
+    _default_platform = mm.Platform.getPlatformByName("Reference")
+
+    def create_simulation(self):
+        """Create a ConstantPHSimulation at 300K/1 atm for a small peptide, and return it with its drive."""
+
+        pdb = app.PDBxFile(
+            get_test_data(
+                "glu_ala_his-solvated-minimized-renamed.cif", "testsystems/tripeptides"
+            )
+        )
+        forcefield = app.ForceField(
+            "amber10-constph.xml", "ions_tip3p.xml", "tip3p.xml"
+        )
+
+        system = forcefield.createSystem(
+            pdb.topology,
+            nonbondedMethod=app.PME,
+            nonbondedCutoff=1.0 * unit.nanometers,
+            constraints=app.HBonds,
+            rigidWater=True,
+            ewaldErrorTolerance=0.0005,
+        )
+
+        temperature = 300 * unit.kelvin
+        integrator = GBAOABIntegrator(
+            temperature=temperature,
+            collision_rate=1.0 / unit.picoseconds,
+            timestep=2.0 * unit.femtoseconds,
+            constraint_tolerance=1.0e-7,
+            external_work=False,
+        )
+        ncmcintegrator = GBAOABIntegrator(
+            temperature=temperature,
+            collision_rate=1.0 / unit.picoseconds,
+            timestep=2.0 * unit.femtoseconds,
+            constraint_tolerance=1.0e-7,
+            external_work=True,
+        )
+
+        compound_integrator = mm.CompoundIntegrator()
+        compound_integrator.addIntegrator(integrator)
+        compound_integrator.addIntegrator(ncmcintegrator)
+        pressure = 1.0 * unit.atmosphere
+
+        system.addForce(mm.MonteCarloBarostat(pressure, temperature))
+        driver = ForceFieldProtonDrive(
+            temperature,
+            pdb.topology,
+            system,
+            forcefield,
+            ["amber10-constph.xml"],
+            pressure=pressure,
+            perturbations_per_trial=0,
+        )
+
+        simulation = app.ConstantPHSimulation(
+            pdb.topology,
+            system,
+            compound_integrator,
+            driver,
+            platform=self._default_platform,
+        )
+        simulation.context.setPositions(pdb.positions)
+        simulation.context.setVelocitiesToTemperature(temperature)
+        return simulation, driver
+
+    def test_statistics(self):
+        """Keep statistics of a ConstantPHSimulation at 300K/1 atm for a small peptide."""
+        simulation, driver = self.create_simulation()
+        filename = uuid.uuid4().hex + ".json"
+        print("Temporary file: ", filename)
+        reporter = StatisticsReporter(filename, 2)
+        simulation.update_reporters.append(reporter)
+
+        simulation.step(1)
+        simulation.update(6)
+
+        assert reporter.nupdates == 6, "There should be 6 updates recorded."
+        assert np.all(
+            reporter.state_counts.sum(axis=1) == 6
+        ), "Every residue should be counted once per update."
+        assert np.allclose(reporter.state_populations.sum(axis=1), 1.0)
+        attempts = reporter.attempts
+        assert attempts.sum() >= 6, "Every update should change at least one residue."
+        assert np.all(reporter.accepts <= attempts)
+        assert driver.naccepted <= reporter.accepts.sum()
+        rates = reporter.acceptance_rates
+        assert np.all(np.isnan(rates[attempts == 0]))
+        assert np.all((rates[attempts > 0] >= 0.0) & (rates[attempts > 0] <= 1.0))
+
+        with open(filename, "r") as snapshotfile:
+            snapshot = json.load(snapshotfile)
+        assert snapshot["nupdates"] == 6
+        assert np.array_equal(snapshot["attempts"], attempts)
+        os.remove(filename)
+
+    def test_report_before_first_update(self):
+        """Report before any update was attempted, which only counts the current states."""
+        simulation, driver = self.create_simulation()
+        filename = uuid.uuid4().hex + ".json"
+        reporter = StatisticsReporter(filename, 2)
+        assert driver._last_attempt_data is not None
+
+        reporter.report(simulation)
+        assert reporter.nupdates == 1
+        assert np.all(reporter.state_counts.sum(axis=1) == 1)
+        assert reporter.attempts.sum() == 0, "No attempt should be recorded."
+
+        simulation.update_reporters.append(reporter)
+        simulation.update(1)
+        assert reporter.nupdates == 2
+        assert reporter.attempts.sum() >= 1
+        if os.path.isfile(filename):
+            os.remove(filename)
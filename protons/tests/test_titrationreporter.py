@@ -2,6 +2,7 @@
 """Test functionality of the TitrationReporter."""
 from protons import app
 from protons.app import titrationreporter as tr
+from protons.app.reportbuffer import BackgroundWriter
 from simtk import unit, openmm as mm
 from protons.app import GBAOABIntegrator, ForceFieldProtonDrive
 from . import get_test_data
@@ -108,6 +109,181 @@ class TestTitrationReporter(object):
         ), "There should be {} atoms recorded.".format(num_atoms)
         newreporter.ncfile.close()
 
+    def test_buffered_reports(self):
+        """Write buffered reports for a ConstantPHSimulation at 300K/1 atm for a small peptide."""
+
+        pdb = app.PDBxFile(
+            get_test_data(
+                "glu_ala_his-solvated-minimized-renamed.cif", "testsystems/tripeptides"
+            )
+        )
+        num_atoms = pdb.topology.getNumAtoms()
+        forcefield = app.ForceField(
+            "amber10-constph.xml", "ions_tip3p.xml", "tip3p.xml"
+        )
+
+        system = forcefield.createSystem(
+            pdb.topology,
+            nonbondedMethod=app.PME,
+            nonbondedCutoff=1.0 * unit.nanometers,
+            constraints=app.HBonds,
+            rigidWater=True,
+            ewaldErrorTolerance=0.0005,
+        )
+
+        temperature = 300 * unit.kelvin
+        integrator = GBAOABIntegrator(
+            temperature=temperature,
+            collision_rate=1.0 / unit.picoseconds,
+            timestep=2.0 * unit.femtoseconds,
+            constraint_tolerance=1.0e-7,
+            external_work=False,
+        )
+        ncmcintegrator = GBAOABIntegrator(
+            temperature=temperature,
+            collision_rate=1.0 / unit.picoseconds,
+            timestep=2.0 * unit.femtoseconds,
+            constraint_tolerance=1.0e-7,
+            external_work=True,
+        )
+
+        compound_integrator = mm.CompoundIntegrator()
+        compound_integrator.addIntegrator(integrator)
+        compound_integrator.addIntegrator(ncmcintegrator)
+        pressure = 1.0 * unit.atmosphere
+
+        system.addForce(mm.MonteCarloBarostat(pressure, temperature))
+        driver = ForceFieldProtonDrive(
+            temperature,
+            pdb.topology,
+            system,
+            forcefield,
+            ["amber10-constph.xml"],
+            pressure=pressure,
+            perturbations_per_trial=0,
+        )
+
+        num_titratable = len(driver.titrationGroups)
+        simulation = app.ConstantPHSimulation(
+            pdb.topology,
+            system,
+            compound_integrator,
+            driver,
+            platform=self._default_platform,
+        )
+        simulation.context.setPositions(pdb.positions)
+        simulation.context.setVelocitiesToTemperature(temperature)
+        filename = uuid.uuid4().hex + ".nc"
+        print("Temporary file: ", filename)
+        newreporter = tr.TitrationReporter(
+            filename, 2, flush_interval=2, sync_interval=None
+        )
+        simulation.update_reporters.append(newreporter)
+
+        # Regular MD step
+        simulation.step(1)
+        # Update the titration states using the uniform proposal
+        simulation.update(6)
+        # Only complete batches are written before flushing
+        assert (
+            newreporter.ncfile["Protons/Titration"].dimensions["update"].size == 2
+        ), "There should be 2 updates written."
+        newreporter.flush()
+        assert (
+            newreporter.ncfile["Protons/Titration"].dimensions["update"].size == 3
+        ), "There should be 3 updates recorded."
+        assert np.all(
+            newreporter.ncfile["Protons/Titration/update"][:] == [2, 4, 6]
+        ), "Updates should be written in order."
+        assert (
+            newreporter.ncfile["Protons/Titration/state"].chunking()[0] == 2
+        ), "The update dimension should be chunked by the flush interval."
+        newreporter.ncfile.close()
+
+    def test_background_writer_reports(self):
+        """Write reports for a ConstantPHSimulation at 300K/1 atm for a small peptide in a separate thread."""
+
+        pdb = app.PDBxFile(
+            get_test_data(
+                "glu_ala_his-solvated-minimized-renamed.cif", "testsystems/tripeptides"
+            )
+        )
+        num_atoms = pdb.topology.getNumAtoms()
+        forcefield = app.ForceField(
+            "amber10-constph.xml", "ions_tip3p.xml", "tip3p.xml"
+        )
+
+        system = forcefield.createSystem(
+            pdb.topology,
+            nonbondedMethod=app.PME,
+            nonbondedCutoff=1.0 * unit.nanometers,
+            constraints=app.HBonds,
+            rigidWater=True,
+            ewaldErrorTolerance=0.0005,
+        )
+
+        temperature = 300 * unit.kelvin
+        integrator = GBAOABIntegrator(
+            temperature=temperature,
+            collision_rate=1.0 / unit.picoseconds,
+            timestep=2.0 * unit.femtoseconds,
+            constraint_tolerance=1.0e-7,
+            external_work=False,
+        )
+        ncmcintegrator = GBAOABIntegrator(
+            temperature=temperature,
+            collision_rate=1.0 / unit.picoseconds,
+            timestep=2.0 * unit.femtoseconds,
+            constraint_tolerance=1.0e-7,
+            external_work=True,
+        )
+
+        compound_integrator = mm.CompoundIntegrator()
+        compound_integrator.addIntegrator(integrator)
+        compound_integrator.addIntegrator(ncmcintegrator)
+        pressure = 1.0 * unit.atmosphere
+
+        system.addForce(mm.MonteCarloBarostat(pressure, temperature))
+        driver = ForceFieldProtonDrive(
+            temperature,
+            pdb.topology,
+            system,
+            forcefield,
+            ["amber10-constph.xml"],
+            pressure=pressure,
+            perturbations_per_trial=0,
+        )
+
+        num_titratable = len(driver.titrationGroups)
+        simulation = app.ConstantPHSimulation(
+            pdb.topology,
+            system,
+            compound_integrator,
+            driver,
+            platform=self._default_platform,
+        )
+        simulation.context.setPositions(pdb.positions)
+        simulation.context.setVelocitiesToTemperature(temperature)
+        filename = uuid.uuid4().hex + ".nc"
+        print("Temporary file: ", filename)
+        writer = BackgroundWriter(max_pending=1)
+        newreporter = tr.TitrationReporter(filename, 2, writer=writer)
+        simulation.update_reporters.append(newreporter)
+
+        # Regular MD step
+        simulation.step(1)
+        # Update the titration states using the uniform proposal
+        simulation.update(6)
+        newreporter.flush()
+        writer.close()
+        assert (
+            newreporter.ncfile["Protons/Titration"].dimensions["update"].size == 3
+        ), "There should be 3 updates recorded."
+        assert np.all(
+            newreporter.ncfile["Protons/Titration/update"][:] == [2, 4, 6]
+        ), "Updates should be written in order."
+        newreporter.ncfile.close()
+
     def test_reports_with_salt(self):
         """Instantiate a ConstantPHSimulation at 300K/1 atm for a small peptide, with salt."""
 
@@ -411,15 +587,109 @@ class TestTitrationReporter(object):
 
         ncfile.close()
 
+    def test_dense_atom_status_reporting(self):
+        """Test if the atom_status is correctly reported when stored for every atom."""
+
+        pdb = app.PDBxFile(
+            get_test_data(
+                "glu_ala_his-solvated-minimized-renamed.cif", "testsystems/tripeptides"
+            )
+        )
+        forcefield = app.ForceField(
+            "amber10-constph.xml", "ions_tip3p.xml", "tip3p.xml"
+        )
+
+        system = forcefield.createSystem(
+            pdb.topology,
+            nonbondedMethod=app.PME,
+            nonbondedCutoff=1.0 * unit.nanometers,
+            constraints=app.HBonds,
+            rigidWater=True,
+            ewaldErrorTolerance=0.0005,
+        )
+
+        temperature = 300 * unit.kelvin
+        integrator = GBAOABIntegrator(
+            temperature=temperature,
+            collision_rate=1.0 / unit.picoseconds,
+            timestep=2.0 * unit.femtoseconds,
+            constraint_tolerance=1.0e-7,
+            external_work=False,
+        )
+        ncmcintegrator = GBAOABIntegrator(
+            temperature=temperature,
+            collision_rate=1.0 / unit.picoseconds,
+            timestep=2.0 * unit.femtoseconds,
+            constraint_tolerance=1.0e-7,
+            external_work=True,
+        )
+
+        compound_integrator = mm.CompoundIntegrator()
+        compound_integrator.addIntegrator(integrator)
+        compound_integrator.addIntegrator(ncmcintegrator)
+        pressure = 1.0 * unit.atmosphere
+
+        system.addForce(mm.MonteCarloBarostat(pressure, temperature))
+        driver = ForceFieldProtonDrive(
+            temperature,
+            pdb.topology,
+            system,
+            forcefield,
+            ["amber10-constph.xml"],
+            pressure=pressure,
+            perturbations_per_trial=0,
+        )
+
+        simulation = app.ConstantPHSimulation(
+            pdb.topology,
+            system,
+            compound_integrator,
+            driver,
+            platform=self._default_platform,
+        )
+        simulation.context.setPositions(pdb.positions)
+        simulation.context.setVelocitiesToTemperature(temperature)
+        filename = uuid.uuid4().hex + ".nc"
+        ncfile = netCDF4.Dataset(filename, "w")
+        print("Temporary file: ", filename)
+        newreporter = tr.TitrationReporter(ncfile, 2, dense_atom_status=True)
+        simulation.update_reporters.append(newreporter)
+
+        # Regular MD step
+        simulation.step(1)
+        # Update the titration states forcibly from a pregenerated series
+        glu_states = np.asarray(
+            [1, 4, 4, 1, 0, 2, 0, 2, 4, 3, 2, 1, 0, 2, 0, 0, 0, 0, 0, 0, 1, 2, 1, 3, 1]
+        )
+        his_states = np.asarray(
+            [2, 1, 0, 1, 2, 2, 1, 2, 2, 1, 0, 2, 2, 1, 2, 2, 2, 2, 2, 2, 0, 2, 2, 2, 1]
+        )
+
+        for i in range(len(glu_states)):
+            simulation.drive.set_titration_state(
+                0, glu_states[i], updateContextParameters=False
+            )
+            simulation.drive.set_titration_state(
+                1, his_states[i], updateContextParameters=False
+            )
+            simulation.update_reporters[0].report(simulation)
+            # check glu
+            self._verify_atom_status(i, 0, ncfile, simulation)
+            # check his
+            self._verify_atom_status(i, 1, ncfile, simulation)
+
+        ncfile.close()
+
     @staticmethod
     def _verify_atom_status(iteration, group_index, ncfile, simulation):
         """Check the atom status for all atoms in one residue for a single iteration."""
         residue = simulation.drive.titrationGroups[group_index]
         atom_status = residue.atom_status
         atom_ids = residue.atom_indices
+        recorded_status = tr.read_atom_status(ncfile, iteration)[0]
         for id, status in zip(atom_ids, atom_status):
             assert (
-                status == ncfile["Protons/Titration/atom_status"][iteration, id]
+                status == recorded_status[id]
             ), "Residue {} atom status recorded should match the current status.".format(
                 group_index
             )
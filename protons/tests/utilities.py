@@ -6,9 +6,11 @@ from simtk import unit, openmm
 from simtk.openmm import app
 from protons.app.schrodinger import is_schrodinger_suite_installed
 from protons.app.integrators import GHMCIntegrator, GBAOABIntegrator
+from protons.app.driver import ParameterUpdateMethod
+import numpy as np
 import tempfile
 import shutil
-from typing import List
+from typing import Callable, List
 
 
 try:
@@ -295,3 +297,52 @@ def create_compound_gbaoab_integrator(testsystem):
     compound_integrator.addIntegrator(ncmc_propagation_integrator)
     compound_integrator.setCurrentIntegrator(0)
     return compound_integrator
+
+
+def compare_parameter_update_energies(create_drive: Callable, group_index: int = 0):
+    """
+    Compare energies of titration states set using global parameter offsets to setting force parameters.
+
+    Parameters
+    ----------
+    create_drive - function that takes a ParameterUpdateMethod, and returns a drive with a context attached,
+        for a fresh copy of the test system.
+    group_index - the residue that is switched between its states.
+    """
+    drivers = [
+        create_drive(method)
+        for method in [
+            ParameterUpdateMethod.FORCE_PARAMETERS,
+            ParameterUpdateMethod.GLOBAL_PARAMETER_OFFSETS,
+        ]
+    ]
+
+    def energies():
+        return [
+            driver.context.getState(getEnergy=True).getPotentialEnergy()
+            / unit.kilojoule_per_mole
+            for driver in drivers
+        ]
+
+    for state in range(len(drivers[0].titrationGroups[group_index])):
+        for driver in drivers:
+            driver.set_titration_state(group_index, state, updateIons=False)
+        reference, offset = energies()
+        assert np.isclose(
+            reference, offset, rtol=1.0e-6, atol=1.0e-3
+        ), "Energies differ in state {}: {} vs {}".format(state, reference, offset)
+
+    # Fractional states, as visited during NCMC
+    for driver in drivers:
+        driver._update_forces(
+            group_index,
+            1,
+            initial_titration_state_index=0,
+            fractional_titration_state=0.4,
+        )
+        for force_index, force in driver._forces_to_push():
+            force.updateParametersInContext(driver.context)
+    reference, offset = energies()
+    assert np.isclose(
+        reference, offset, rtol=1.0e-6, atol=1.0e-3
+    ), "Energies differ for a fractional state: {} vs {}".format(reference, offset)